@@ -4,17 +4,50 @@ Script de monitoring Freebox
 Récupère les données via l'API Freebox et les expose via une API REST
 """
 
+import argparse
+import base64
+import csv
+import functools
+import gzip
 import hashlib
 import hmac
+import itertools
+import io
 import json
 import time
 import requests
-from flask import Flask, jsonify, render_template_string
+from flask import Flask, Response, jsonify, render_template_string, request, stream_with_context
 from flask_cors import CORS
 import os
+import math
+import mmap
+import socket
 import sqlite3
+import ssl
+import struct
+import sys
+import tempfile
+import queue
+import random
+import shutil
 import threading
+import tracemalloc
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 CORS(app)
@@ -32,6 +65,125 @@ TOKEN_FILE = "/app/data/freebox_token.json" if os.path.exists("/app/data") else
 # Configuration de la base de données
 DB_PATH = '/app/data/freebox_history.db' if os.path.exists("/app/data") else 'freebox_history.db'
 
+# Dossier de l'archive long terme (fichiers colonnes compressés, un dossier par mois)
+ARCHIVE_DIR = '/app/data/archive' if os.path.exists("/app/data") else 'archive'
+
+# Stockage des échantillons bruts : 'sqlite' (bandwidth_history) ou 'mmap'
+# (journal binaire à taille fixe, un segment par jour, pour les collectes très fréquentes)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+SAMPLE_LOG_DIR = '/app/data/samples' if os.path.exists("/app/data") else 'samples'
+SAMPLE_SEGMENT_SECONDS = 86400
+
+# Rétention : 30 jours dans SQLite, puis 1 an dans l'archive
+RETENTION_DAYS = 30
+ARCHIVE_RETENTION_DAYS = 365
+
+# Intervalle de collecte en arrière-plan (secondes)
+COLLECT_INTERVAL = 5
+
+# Période d'interrogation de chaque appel Freebox (secondes, 0 = à chaque échantillon)
+POLL_SCHEDULE = {
+    'connection': 0,
+    'system': 30,
+    'lan': 60,
+    'wifi': 600,
+    'wifi_ap': 600,
+    'switch': 10
+}
+# Si un appel échoue, son dernier résultat valide reste servi pendant ce nombre de périodes
+# (jamais pour les appels de période 0 : un échantillon ne doit pas répéter des débits périmés)
+POLL_MAX_STALE_PERIODS = 3
+
+# Limites de requêtes : par client sur l'API, et globale vers la Freebox
+API_RATE_LIMIT = 10          # requêtes/s par client
+API_RATE_BURST = 30
+INIT_RATE_LIMIT = 1 / 60     # une reconnexion par minute et par client
+INIT_RATE_BURST = 2
+UPSTREAM_RATE_LIMIT = 10     # requêtes/s vers la Freebox
+UPSTREAM_MAX_WAIT = 2        # attente maximale d'un jeton (secondes)
+UPSTREAM_CONNECT_TIMEOUT = 3
+UPSTREAM_READ_TIMEOUT = 10
+
+# Disjoncteur : ouverture après 3 échecs consécutifs, nouvel essai après 5s, 10s, 20s... (max 5 min)
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_BASE_DELAY = 5
+CIRCUIT_MAX_DELAY = 300
+
+# Durée couverte par le tampon mémoire des derniers échantillons (vue temps réel)
+RECENT_BUFFER_SECONDS = 600
+
+# Enregistrement des réponses brutes de l'API (rejouables avec la commande replay)
+RECORD_FILE = os.environ.get('FREEBOX_RECORD_FILE', '')
+RECORD_FLUSH_INTERVAL = 5
+
+# Complément des trous de l'historique depuis la RRD de la Freebox : trous de plus de
+# 5 minutes, recherchés toutes les heures, lus par requêtes couvrant 24 heures
+BACKFILL_MIN_GAP = 300
+BACKFILL_INTERVAL = 3600
+BACKFILL_REQUEST_SPAN = 86400
+
+# Délai avant une nouvelle tentative d'authentification après un échec
+AUTH_RETRY_INTERVAL = 60
+
+# Intervalle entre deux passes de rétention / archivage
+MAINTENANCE_INTERVAL = 24 * 3600
+
+# Intervalle d'interrogation des stations WiFi (plus lent que les débits)
+STATIONS_INTERVAL = 30
+
+# Événements websocket : joignabilité des appareils du réseau local, avec
+# réconciliation complète toutes les 5 minutes
+WS_EVENTS = ('lan_host_l3addr_reachable', 'lan_host_l3addr_unreachable')
+LAN_RECONCILE_INTERVAL = 300
+WS_PING_INTERVAL = 30
+WS_RECONNECT_MAX_DELAY = 300
+
+# Règles d'alerte (optionnel) et webhook de notification
+ALERTS_FILE = "/app/data/alerts.json" if os.path.exists("/app/data") else "alerts.json"
+ALERT_WEBHOOK_URL = os.environ.get('ALERT_WEBHOOK_URL', '')
+
+# Export des échantillons (optionnel) : MQTT (mqtt://utilisateur:motdepasse@hôte:1883/sujet)
+# et InfluxDB (URL d'écriture complète, ex: http://hôte:8086/api/v2/write?org=maison&bucket=freebox)
+MQTT_URL = os.environ.get('MQTT_URL', '')
+INFLUX_URL = os.environ.get('INFLUX_URL', '')
+INFLUX_TOKEN = os.environ.get('INFLUX_TOKEN', '')
+SINK_FLUSH_INTERVAL = 10
+SINK_SPOOL_DIR = "/app/data/spool" if os.path.exists("/app/data") else "spool"
+SINK_SPOOL_MAX_FILES = 10000
+
+# Diagnostic à chaud (profil CPU, diff mémoire) : désactivé sans jeton d'administration
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_SAMPLE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 300
+MEMORY_TRACE_FRAMES = 1
+
+# Périodes d'historique : durée couverte et taille d'agrégation (en secondes)
+HISTORY_PERIODS = {
+    '24h': (24 * 3600, 300),            # Grouper par 5 minutes
+    '7d': (7 * 24 * 3600, 3600),        # Grouper par 1 heure
+    '30d': (30 * 24 * 3600, 14400),     # Grouper par 4 heures
+    '1y': (365 * 24 * 3600, 86400)      # Grouper par jour (archive)
+}
+
+# Agrégats pré-calculés par tranche de 5 minutes, avec quantiles approchés
+ROLLUP_INTERVAL = 300
+HISTORY_QUANTILES = (0.5, 0.95, 0.99)
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 2048
+SKETCH_MIN_VALUE = 1e-6
+
+# Cache mémoire des tranches d'historique fermées (nombre maximal de tranches gardées)
+HISTORY_CACHE_MAX_BUCKETS = 10000
+
+# Métriques génériques : réécriture d'une valeur inchangée au plus toutes les 5 minutes
+METRIC_KEYFRAME_INTERVAL = 300
+# Durée maximale d'une valeur sans réécriture : au-delà, la collecte était interrompue
+METRIC_HOLD_MAX = METRIC_KEYFRAME_INTERVAL + COLLECT_INTERVAL
+METRIC_EXCLUDED_FIELDS = {'timestamp', 'wifi.stations', 'switch.ports'}
+
+# Nombre de lignes lues par lot lors des exports
+EXPORT_CHUNK_SIZE = 1000
+
 def init_database():
     """Initialise la base de données SQLite pour l'historique"""
     conn = sqlite3.connect(DB_PATH)
@@ -49,17 +201,165 @@ def init_database():
     
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON bandwidth_history(timestamp)')
     
+    # Index des partitions de l'archive (sorte, bornes temporelles de chaque fichier)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_files (
+            path TEXT PRIMARY KEY,
+            month TEXT NOT NULL,
+            min_ts INTEGER NOT NULL,
+            max_ts INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'samples'
+        )
+    ''')
+    
+    # Bases créées avant l'archivage des agrégats : toutes les partitions sont des échantillons
+    if 'kind' not in [row[1] for row in cursor.execute('PRAGMA table_info(archive_files)')]:
+        cursor.execute("ALTER TABLE archive_files ADD COLUMN kind TEXT NOT NULL DEFAULT 'samples'")
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archive_range ON archive_files(min_ts, max_ts)')
+    
+    # Agrégats par tranche de 5 minutes (sommes, maximums et sketches de quantiles)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bandwidth_rollup (
+            bucket INTEGER PRIMARY KEY,
+            samples INTEGER NOT NULL,
+            download_sum REAL NOT NULL,
+            download_max REAL NOT NULL,
+            upload_sum REAL NOT NULL,
+            upload_max REAL NOT NULL,
+            temperature_sum REAL NOT NULL,
+            temperature_count INTEGER NOT NULL,
+            download_sketch BLOB,
+            upload_sketch BLOB
+        )
+    ''')
+    
+    # Séries de métriques génériques (noms internés, lignes étroites rangées par métrique)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metric_samples (
+            metric_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (metric_id, timestamp)
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_metric_samples_timestamp ON metric_samples(timestamp)')
+    
+    # Stations WiFi (adresses MAC internées) et historique compact de leurs mesures
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS wifi_stations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mac TEXT NOT NULL UNIQUE,
+            hostname TEXT,
+            last_seen INTEGER
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS wifi_station_history (
+            station_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            ap_id INTEGER,
+            signal INTEGER,
+            tx_rate INTEGER,
+            rx_rate INTEGER,
+            PRIMARY KEY (station_id, timestamp)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Débits par port du switch, calculés à partir des compteurs d'octets
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS switch_port_history (
+            port_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            link_up INTEGER NOT NULL,
+            rx_rate REAL,
+            tx_rate REAL,
+            PRIMARY KEY (port_id, timestamp)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Événements de connexion : périodes d'état, d'adresse IP et redémarrages
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS connection_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            value TEXT,
+            previous TEXT,
+            start_ts INTEGER NOT NULL,
+            end_ts INTEGER
+        )
+    ''')
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_connection_events_start ON connection_events(start_ts)')
+    # Les requêtes par plage partent de la fin des périodes (une période peut durer des mois)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_connection_events_end ON connection_events(end_ts)')
+    
+    # Trous de l'historique déjà complétés depuis la RRD de la Freebox
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_ranges (
+            start_ts INTEGER NOT NULL,
+            end_ts INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            filled_at INTEGER NOT NULL,
+            PRIMARY KEY (start_ts, end_ts)
+        )
+    ''')
+    
+    # Volumes de données par jour et par mois, et dernier relevé des compteurs d'octets
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_totals (
+            granularity TEXT NOT NULL,
+            period TEXT NOT NULL,
+            download_bytes INTEGER NOT NULL,
+            upload_bytes INTEGER NOT NULL,
+            PRIMARY KEY (granularity, period)
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            timestamp INTEGER NOT NULL,
+            rx_bytes INTEGER NOT NULL,
+            tx_bytes INTEGER NOT NULL,
+            uptime INTEGER NOT NULL
+        )
+    ''')
+    
+    # Mode WAL : les lectures longues (exports) ne bloquent pas les écritures
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
+    # Adresses MAC des stations en majuscules, comme elles sont recherchées
+    cursor.execute('UPDATE OR IGNORE wifi_stations SET mac = UPPER(mac) WHERE mac <> UPPER(mac)')
+    
     conn.commit()
     conn.close()
     print("✓ Base de données initialisée")
 
-def save_stats(download_rate, upload_rate, temperature):
-    """Sauvegarde les statistiques dans la base de données"""
+def save_stats(download_rate, upload_rate, temperature, timestamp=None):
+    """Sauvegarde les statistiques dans la base de données (ou le journal mmap)"""
+    if STORAGE_BACKEND == 'mmap':
+        try:
+            sample_log.append(int(timestamp if timestamp is not None else time.time()), download_rate, upload_rate, temperature)
+        except OSError as e:
+            print(f"✗ Erreur journal d'échantillons: {e}")
+        return
+    
     try:
         conn = sqlite3.connect(DB_PATH, timeout=10)
         cursor = conn.cursor()
         
-        timestamp = int(time.time())
+        timestamp = int(timestamp if timestamp is not None else time.time())
         cursor.execute(
             'INSERT INTO bandwidth_history (timestamp, download_rate, upload_rate, temperature) VALUES (?, ?, ?, ?)',
             (timestamp, download_rate, upload_rate, temperature)
@@ -73,23 +373,1034 @@ def save_stats(download_rate, upload_rate, temperature):
         print(f"✗ Erreur sauvegarde stats: {type(e).__name__} - {e}")
 
 def cleanup_old_data():
-    """Nettoie les données de plus de 30 jours"""
+    """Archive puis supprime les données de plus de 30 jours, purge l'archive de plus d'un an"""
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
-        thirty_days_ago = int(time.time()) - (30 * 24 * 3600)
-        cursor.execute('DELETE FROM bandwidth_history WHERE timestamp < ?', (thirty_days_ago,))
+        # Borne alignée sur les tranches d'agrégats pour que SQLite et l'archive ne se recouvrent pas
+        cutoff = int(time.time()) - (RETENTION_DAYS * 24 * 3600)
+        cutoff = (cutoff // ROLLUP_INTERVAL) * ROLLUP_INTERVAL
+        if STORAGE_BACKEND == 'mmap':
+            # Le journal mmap ne supprime que des segments entiers
+            cutoff = (cutoff // SAMPLE_SEGMENT_SECONDS) * SAMPLE_SEGMENT_SECONDS
+        archived = archive_old_rows(conn, cutoff)
+        
+        cursor.execute('DELETE FROM bandwidth_history WHERE timestamp < ?', (cutoff,))
         deleted = cursor.rowcount
+        if STORAGE_BACKEND == 'mmap':
+            removed = sample_log.purge(cutoff)
+            if removed > 0:
+                print(f"✓ Nettoyage: {removed} segments du journal d'échantillons supprimés")
+        cursor.execute('DELETE FROM bandwidth_rollup WHERE bucket < ?', (cutoff,))
+        cursor.execute('DELETE FROM metric_samples WHERE timestamp < ?', (cutoff,))
+        cursor.execute('DELETE FROM wifi_station_history WHERE timestamp < ?', (cutoff,))
+        cursor.execute('DELETE FROM switch_port_history WHERE timestamp < ?', (cutoff,))
         
+        conn.commit()
+        # Les tranches antérieures passent dans l'archive (ou sont purgées)
+        history_cache.invalidate(end_time=cutoff)
+        
+        purged = purge_archive(conn, int(time.time()) - (ARCHIVE_RETENTION_DAYS * 24 * 3600))
+        # Le journal des événements est gardé aussi longtemps que l'archive
+        conn.execute('DELETE FROM connection_events WHERE end_ts < ?', (int(time.time()) - (ARCHIVE_RETENTION_DAYS * 24 * 3600),))
         conn.commit()
         conn.close()
         
+        if archived > 0:
+            print(f"✓ Archivage: {archived} entrées écrites dans {ARCHIVE_DIR}")
         if deleted > 0:
             print(f"✓ Nettoyage: {deleted} entrées supprimées")
+        if purged > 0:
+            print(f"✓ Archive: {purged} partitions expirées supprimées")
     except Exception as e:
         print(f"✗ Erreur nettoyage: {e}")
 
+# Archive long terme
+#
+# Deux sortes de partitions, un dossier par mois : les échantillons bruts (.fbc, pour
+# l'export brut) et les agrégats de 5 minutes avec leurs sketches (.fbr), qui servent
+# les requêtes d'historique sans relire les échantillons. Un fichier contient le magic,
+# un en-tête JSON (colonnes, nombre de lignes, bornes temporelles), puis des blocs d'au
+# plus ARCHIVE_BLOCK_ROWS lignes dont chaque colonne est compressée (zlib) ; les
+# timestamps sont encodés en deltas pour bien se compresser. Les blocs sont lus un par
+# un (ceux hors de la plage demandée sont sautés) : la mémoire utilisée ne dépend pas
+# de la taille du fichier. Un fichier n'est jamais modifié après son écriture, sauf
+# la conversion unique des fichiers FBC1 (une seule colonne compressée par fichier).
+
+ARCHIVE_MAGIC = b'FBC2'
+LEGACY_ARCHIVE_MAGIC = b'FBC1'
+ARCHIVE_BLOCK_ROWS = 8192
+# Colonnes (nom, type array) ; None : blob de taille variable (sketch sérialisé)
+ARCHIVE_COLUMNS = [('timestamp', 'q'), ('download_rate', 'd'), ('upload_rate', 'd'), ('temperature', 'd')]
+ROLLUP_ARCHIVE_COLUMNS = [
+    ('bucket', 'q'), ('samples', 'q'), ('download_sum', 'd'), ('download_max', 'd'),
+    ('upload_sum', 'd'), ('upload_max', 'd'), ('temperature_sum', 'd'), ('temperature_count', 'q'),
+    ('download_sketch', None), ('upload_sketch', None)
+]
+# Sorte de partition -> (préfixe et extension des fichiers, colonnes)
+ARCHIVE_KINDS = {
+    'samples': ('bandwidth', '.fbc', ARCHIVE_COLUMNS),
+    'rollup': ('rollup', '.fbr', ROLLUP_ARCHIVE_COLUMNS)
+}
+
+def encode_archive_block(rows, columns):
+    """Bloc de lignes : nombre de lignes puis chaque colonne compressée"""
+    parts = [struct.pack('<I', len(rows))]
+    for index, (_, typecode) in enumerate(columns):
+        if typecode is None:
+            blobs = [row[index] or b'' for row in rows]
+            payload = array('I', [len(blob) for blob in blobs]).tobytes() + b''.join(blobs)
+        elif index == 0:
+            payload = array(typecode, [b - a for a, b in zip([0] + [row[0] for row in rows], [row[0] for row in rows])]).tobytes()
+        elif typecode == 'd':
+            payload = array(typecode, [math.nan if row[index] is None else row[index] for row in rows]).tobytes()
+        else:
+            payload = array(typecode, [row[index] for row in rows]).tobytes()
+        compressed = zlib.compress(payload, 9)
+        parts.append(struct.pack('<I', len(compressed)))
+        parts.append(compressed)
+    return b''.join(parts)
+
+def write_archive_file(path, rows, columns=ARCHIVE_COLUMNS):
+    """Écrit des lignes triées dans un fichier colonnes, par blocs"""
+    header = json.dumps({
+        'columns': [name for name, _ in columns],
+        'rows': len(rows),
+        'min_ts': rows[0][0],
+        'max_ts': rows[-1][0]
+    }).encode()
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for first in range(0, len(rows), ARCHIVE_BLOCK_ROWS):
+            f.write(encode_archive_block(rows[first:first + ARCHIVE_BLOCK_ROWS], columns))
+    os.replace(tmp_path, path)
+
+def iter_archive_file(path, columns, start_time=0, end_time=None):
+    """Parcourt les lignes d'un fichier colonnes dans [start_time, end_time), bloc par bloc"""
+    with open(path, 'rb') as f:
+        if f.read(4) != ARCHIVE_MAGIC:
+            raise ValueError(f"Fichier d'archive invalide: {path}")
+        header_size, = struct.unpack('<I', f.read(4))
+        f.seek(header_size, os.SEEK_CUR)
+        
+        while True:
+            raw = f.read(4)
+            if not raw:
+                break
+            count, = struct.unpack('<I', raw)
+            block = []
+            for index, (_, typecode) in enumerate(columns):
+                size, = struct.unpack('<I', f.read(4))
+                if index > 0 and block[0] is None:
+                    f.seek(size, os.SEEK_CUR)
+                    continue
+                payload = zlib.decompress(f.read(size))
+                if typecode is None:
+                    lengths = array('I')
+                    lengths.frombytes(payload[:count * lengths.itemsize])
+                    offsets = list(itertools.accumulate(lengths, initial=count * lengths.itemsize))
+                    block.append([payload[offsets[i]:offsets[i + 1]] for i in range(count)])
+                    continue
+                column = array(typecode)
+                column.frombytes(payload)
+                if index == 0:
+                    column = list(itertools.accumulate(column))
+                    # Bloc entièrement hors de la plage : colonnes suivantes sautées
+                    if column[-1] < start_time or (end_time is not None and column[0] >= end_time):
+                        column = None
+                block.append(column)
+            if block[0] is None:
+                continue
+            for row in zip(*block):
+                if row[0] >= start_time and (end_time is None or row[0] < end_time):
+                    yield row
+
+def read_legacy_archive_file(path):
+    """Lit un fichier FBC1 (une seule colonne compressée par fichier) et retourne ses lignes"""
+    with open(path, 'rb') as f:
+        if f.read(4) != LEGACY_ARCHIVE_MAGIC:
+            raise ValueError(f"Fichier d'archive invalide: {path}")
+        header_size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_size))
+        columns = []
+        for _, typecode in ARCHIVE_COLUMNS:
+            payload_size, = struct.unpack('<I', f.read(4))
+            column = array(typecode)
+            column.frombytes(zlib.decompress(f.read(payload_size)))
+            columns.append(column)
+    
+    timestamp = 0
+    rows = []
+    for i in range(header['rows']):
+        timestamp += columns[0][i]
+        temperature = columns[3][i]
+        rows.append((timestamp, columns[1][i], columns[2][i], None if math.isnan(temperature) else temperature))
+    return rows
+
+def archive_rows(conn, kind, rows):
+    """Écrit des lignes triées dans l'archive, une partition par mois ; retourne leur nombre"""
+    prefix, extension, columns = ARCHIVE_KINDS[kind]
+    archived = 0
+    month = None
+    month_rows = []
+    
+    def flush():
+        path = os.path.join(ARCHIVE_DIR, month, f'{prefix}_{month_rows[0][0]}_{month_rows[-1][0]}{extension}')
+        write_archive_file(path, month_rows, columns)
+        conn.execute(
+            'INSERT OR REPLACE INTO archive_files (path, month, min_ts, max_ts, row_count, kind) VALUES (?, ?, ?, ?, ?, ?)',
+            (path, month, month_rows[0][0], month_rows[-1][0], len(month_rows), kind)
+        )
+        return len(month_rows)
+    
+    for row in rows:
+        row_month = time.strftime('%Y-%m', time.gmtime(row[0]))
+        if row_month != month and month_rows:
+            archived += flush()
+            month_rows = []
+        month = row_month
+        month_rows.append(row)
+    
+    if month_rows:
+        archived += flush()
+    
+    return archived
+
+def archive_old_rows(conn, cutoff):
+    """Archive les échantillons et les agrégats de 5 minutes antérieurs à cutoff"""
+    archived = archive_rows(conn, 'samples', iter_sample_rows(conn, 0, cutoff))
+    archive_rows(conn, 'rollup', conn.execute(
+        f'SELECT {ROLLUP_COLUMNS} FROM bandwidth_rollup WHERE bucket < ? ORDER BY bucket', (cutoff,)
+    ).fetchall())
+    return archived
+
+def upgrade_legacy_archive():
+    """Convertit les partitions FBC1 en blocs et archive leurs agrégats de 5 minutes (une seule fois)"""
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    converted = 0
+    try:
+        paths = [row[0] for row in conn.execute("SELECT path FROM archive_files WHERE kind = 'samples' ORDER BY min_ts")]
+        for path in paths:
+            with open(path, 'rb') as f:
+                if f.read(4) != LEGACY_ARCHIVE_MAGIC:
+                    continue
+            rows = read_legacy_archive_file(path)
+            write_archive_file(path, rows)
+            # Les partitions s'arrêtent sur une fin de mois ou une borne de rétention, alignées sur 5 minutes
+            archive_rows(conn, 'rollup', [bucket.to_rollup_row() for bucket in aggregate_rows(rows, ROLLUP_INTERVAL)])
+            conn.commit()
+            converted += 1
+    finally:
+        conn.close()
+    if converted > 0:
+        history_cache.invalidate()
+        print(f"✓ Archive: {converted} partitions converties (blocs et agrégats de 5 minutes)")
+
+def purge_archive(conn, cutoff):
+    """Supprime les partitions de l'archive entièrement antérieures à cutoff"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT path FROM archive_files WHERE max_ts < ?', (cutoff,))
+    paths = [row[0] for row in cursor.fetchall()]
+    
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+        conn.execute('DELETE FROM archive_files WHERE path = ?', (path,))
+    
+    conn.commit()
+    return len(paths)
+
+def iter_archive(conn, kind, start_time, end_time):
+    """Parcourt les lignes archivées d'un intervalle en n'ouvrant que les partitions concernées"""
+    columns = ARCHIVE_KINDS[kind][2]
+    paths = conn.execute('''
+        SELECT path FROM archive_files
+        WHERE kind = ? AND max_ts >= ? AND min_ts < ?
+        ORDER BY min_ts ASC
+    ''', (kind, start_time, end_time)).fetchall()
+    
+    for path, in paths:
+        yield from iter_archive_file(path, columns, start_time, end_time)
+
+def iter_archive_rows(conn, start_time, end_time):
+    """Échantillons bruts archivés (timestamp, download, upload, temperature) d'un intervalle"""
+    for timestamp, download_rate, upload_rate, temperature in iter_archive(conn, 'samples', start_time, end_time):
+        yield timestamp, download_rate, upload_rate, None if math.isnan(temperature) else temperature
+
+def iter_archive_buckets(conn, start_time, end_time):
+    """Tranches de 5 minutes archivées d'un intervalle"""
+    for row in iter_archive(conn, 'rollup', start_time, end_time):
+        yield HistoryBucket.from_rollup_row(row)
+
+# Journal d'échantillons mmap (STORAGE_BACKEND=mmap)
+#
+# Alternative à bandwidth_history pour les collectes très fréquentes : chaque échantillon
+# est un enregistrement binaire de taille fixe (timestamp, download, upload, température)
+# ajouté en fin de segment, un fichier par jour. Les lectures projettent le segment en
+# mémoire et trouvent les bornes par dichotomie ; si NumPy est installé, les agrégats
+# sont calculés sur des vues sans copie. La rétention supprime des segments entiers.
+
+SAMPLE_RECORD = struct.Struct('<qddd')
+SAMPLE_DTYPE = np.dtype([
+    ('timestamp', '<i8'), ('download_rate', '<f8'), ('upload_rate', '<f8'), ('temperature', '<f8')
+]) if np is not None else None
+
+class SampleLog:
+    def __init__(self, directory, segment_seconds):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.handle = None
+        self.handle_segment = None
+        # Lu dans le dernier segment à la première écriture (voir newest_timestamp)
+        self.last_timestamp = None
+        self.lock = threading.Lock()
+
+    def segment_path(self, segment_start):
+        return os.path.join(self.directory, f'samples_{segment_start}.fbs')
+
+    def segments(self, start_time=0, end_time=None):
+        """Débuts des segments qui recouvrent [start_time, end_time), dans l'ordre"""
+        if not os.path.isdir(self.directory):
+            return []
+        starts = sorted(
+            int(name[len('samples_'):-len('.fbs')]) for name in os.listdir(self.directory)
+            if name.startswith('samples_') and name.endswith('.fbs')
+        )
+        return [start for start in starts if start + self.segment_seconds > start_time and (end_time is None or start < end_time)]
+
+    def newest_timestamp(self):
+        """Timestamp du dernier enregistrement complet du segment le plus récent (0 si aucun)"""
+        for segment_start in reversed(self.segments()):
+            with open(self.segment_path(segment_start), 'rb') as f:
+                count = os.fstat(f.fileno()).st_size // SAMPLE_RECORD.size
+                if count:
+                    f.seek((count - 1) * SAMPLE_RECORD.size)
+                    return SAMPLE_RECORD.unpack(f.read(SAMPLE_RECORD.size))[0]
+        return 0
+
+    def append(self, timestamp, download_rate, upload_rate, temperature):
+        with self.lock:
+            if self.last_timestamp is None:
+                self.last_timestamp = self.newest_timestamp()
+            # La dichotomie suppose des timestamps croissants, y compris après un redémarrage
+            timestamp = max(int(timestamp), self.last_timestamp)
+            segment_start = (timestamp // self.segment_seconds) * self.segment_seconds
+            if segment_start != self.handle_segment:
+                if self.handle is not None:
+                    self.handle.close()
+                os.makedirs(self.directory, exist_ok=True)
+                self.handle = open(self.segment_path(segment_start), 'ab')
+                self.handle_segment = segment_start
+                # Écarter un enregistrement incomplet (arrêt pendant une écriture)
+                size = self.handle.tell()
+                if size % SAMPLE_RECORD.size:
+                    self.handle.truncate(size - size % SAMPLE_RECORD.size)
+            self.handle.write(SAMPLE_RECORD.pack(
+                timestamp, download_rate, upload_rate, math.nan if temperature is None else temperature
+            ))
+            self.handle.flush()
+            self.last_timestamp = timestamp
+
+    def lower_bound(self, mapped, count, timestamp):
+        """Index du premier enregistrement dont le timestamp est >= timestamp"""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if struct.unpack_from('<q', mapped, middle * SAMPLE_RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def iter_mapped(self, start_time, end_time, reader):
+        """Applique reader(mapped, count, low, high) à chaque segment projeté en mémoire"""
+        for segment_start in self.segments(start_time, end_time):
+            with open(self.segment_path(segment_start), 'rb') as f:
+                count = os.fstat(f.fileno()).st_size // SAMPLE_RECORD.size
+                if count == 0:
+                    continue
+                with mmap.mmap(f.fileno(), count * SAMPLE_RECORD.size, access=mmap.ACCESS_READ) as mapped:
+                    low = self.lower_bound(mapped, count, start_time)
+                    high = self.lower_bound(mapped, count, end_time)
+                    if low < high:
+                        yield from reader(mapped, count, low, high)
+
+    def iter_rows(self, start_time, end_time):
+        """Parcourt les échantillons (timestamp, download, upload, temperature) d'une plage"""
+        def reader(mapped, count, low, high):
+            for offset in range(low * SAMPLE_RECORD.size, high * SAMPLE_RECORD.size, SAMPLE_RECORD.size):
+                timestamp, download_rate, upload_rate, temperature = SAMPLE_RECORD.unpack_from(mapped, offset)
+                yield timestamp, download_rate, upload_rate, None if math.isnan(temperature) else temperature
+        return self.iter_mapped(start_time, end_time, reader)
+
+    def iter_buckets(self, start_time, end_time, interval):
+        """Agrège une plage par intervalle (vues NumPy si disponible)"""
+        if np is None:
+            return aggregate_rows(self.iter_rows(start_time, end_time), interval)
+        # Une tranche peut couvrir plusieurs segments : fusion des morceaux
+        return regroup_buckets(self.iter_mapped(start_time, end_time, functools.partial(numpy_buckets, interval=interval)), interval)
+
+    def purge(self, cutoff):
+        """Supprime les segments entièrement antérieurs à cutoff"""
+        removed = 0
+        with self.lock:
+            for segment_start in self.segments(0, cutoff):
+                if segment_start + self.segment_seconds <= cutoff and segment_start != self.handle_segment:
+                    os.remove(self.segment_path(segment_start))
+                    removed += 1
+        return removed
+
+def numpy_buckets(mapped, count, low, high, interval):
+    """Tranches d'un segment calculées sur une vue NumPy de l'enregistrement projeté"""
+    records = np.frombuffer(mapped, dtype=SAMPLE_DTYPE, count=count)[low:high]
+    periods = (records['timestamp'] // interval) * interval
+    boundaries = (np.flatnonzero(np.diff(periods)) + 1).tolist()
+    # Sketches de toutes les tranches du segment calculés en une passe
+    bucket_ids = np.zeros(len(records), dtype=np.int64)
+    bucket_ids[boundaries] = 1
+    bucket_ids = np.cumsum(bucket_ids)
+    download_sketches = sketch_counts(records['download_rate'], bucket_ids, len(boundaries) + 1)
+    upload_sketches = sketch_counts(records['upload_rate'], bucket_ids, len(boundaries) + 1)
+    
+    buckets = []
+    for first, last, download_counts, upload_counts in zip(
+            [0] + boundaries, boundaries + [len(records)], download_sketches, upload_sketches):
+        chunk = records[first:last]
+        download, upload, temperature = chunk['download_rate'], chunk['upload_rate'], chunk['temperature']
+        temperature = temperature[~np.isnan(temperature)]
+        
+        bucket = HistoryBucket(int(periods[first]))
+        bucket.samples = last - first
+        bucket.download_sum = float(download.sum())
+        bucket.download_max = max(0.0, float(download.max()))
+        bucket.upload_sum = float(upload.sum())
+        bucket.upload_max = max(0.0, float(upload.max()))
+        bucket.temperature_sum = float(temperature.sum())
+        bucket.temperature_count = len(temperature)
+        bucket.download_sketch.add_counts(*download_counts)
+        bucket.upload_sketch.add_counts(*upload_counts)
+        buckets.append(bucket)
+    # Liste (et non générateur) : aucune vue ne doit survivre à la fermeture du mmap
+    return buckets
+
+def sketch_counts(values, bucket_ids, bucket_count):
+    """Effectifs QuantileSketch (indices, effectifs, valeurs nulles) de chaque tranche d'un tableau"""
+    positive = values > SKETCH_MIN_VALUE
+    zero_counts = np.bincount(bucket_ids[~positive], minlength=bucket_count).tolist()
+    indexes = np.ceil(np.log(values[positive]) / QuantileSketch().log_gamma).astype(np.int64)
+    
+    # Une seule clé (tranche, indice) pour compter toutes les tranches avec un np.unique
+    lowest = int(indexes.min()) if len(indexes) else 0
+    span = int(indexes.max()) - lowest + 1 if len(indexes) else 1
+    keys, counts = np.unique(bucket_ids[positive] * span + (indexes - lowest), return_counts=True)
+    splits = np.searchsorted(keys // span, np.arange(1, bucket_count))
+    return [
+        ((bins + lowest).tolist(), bin_counts.tolist(), zero_count)
+        for bins, bin_counts, zero_count in zip(np.split(keys % span, splits), np.split(counts, splits), zero_counts)
+    ]
+
+sample_log = SampleLog(SAMPLE_LOG_DIR, SAMPLE_SEGMENT_SECONDS)
+
+# Agrégats d'historique
+#
+# Chaque tranche de 5 minutes (ROLLUP_INTERVAL) est pré-agrégée dans bandwidth_rollup :
+# sommes, maximums et un sketch de quantiles par sens (download / upload).
+# Les tranches plus larges et les plages arbitraires sont obtenues en fusionnant
+# ces agrégats, sans relire les échantillons bruts.
+
+class QuantileSketch:
+    """Sketch de quantiles fusionnable (type DDSketch) à erreur relative bornée"""
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= SKETCH_MIN_VALUE:
+            self.zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + count
+            if len(self.bins) > self.max_bins:
+                self.collapse()
+        self.count += count
+
+    def merge(self, other):
+        self.add_counts(other.bins.keys(), other.bins.values(), other.zero_count)
+
+    def add_counts(self, indexes, counts, zero_count=0):
+        """Ajoute des effectifs déjà répartis par indice"""
+        for index, count in zip(indexes, counts):
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += zero_count
+        self.count += zero_count + sum(counts)
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        """Fusionne les plus petits indices pour borner la taille du sketch"""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        merged = sum(self.bins.pop(index) for index in indexes[:excess + 1])
+        self.bins[indexes[excess]] = merged
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_bytes(self):
+        indexes = sorted(self.bins)
+        return zlib.compress(struct.pack(
+            f'<II{len(indexes)}i{len(indexes)}I',
+            self.zero_count, len(indexes), *indexes, *(self.bins[i] for i in indexes)
+        ))
+
+    @classmethod
+    def from_bytes(cls, payload):
+        sketch = cls()
+        if payload:
+            raw = zlib.decompress(payload)
+            zero_count, size = struct.unpack_from('<II', raw)
+            values = struct.unpack_from(f'<{size}i{size}I', raw, 8)
+            sketch.bins = dict(zip(values[:size], values[size:]))
+            sketch.zero_count = zero_count
+            sketch.count = zero_count + sum(values[size:])
+        return sketch
+
+class HistoryBucket:
+    """Agrégat d'une tranche de temps, fusionnable avec une autre tranche"""
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.samples = 0
+        self.download_sum = 0.0
+        self.download_max = 0.0
+        self.upload_sum = 0.0
+        self.upload_max = 0.0
+        self.temperature_sum = 0.0
+        self.temperature_count = 0
+        self.download_sketch = QuantileSketch()
+        self.upload_sketch = QuantileSketch()
+
+    def add_sample(self, download_rate, upload_rate, temperature):
+        self.samples += 1
+        self.download_sum += download_rate
+        self.download_max = max(self.download_max, download_rate)
+        self.upload_sum += upload_rate
+        self.upload_max = max(self.upload_max, upload_rate)
+        if temperature is not None:
+            self.temperature_sum += temperature
+            self.temperature_count += 1
+        self.download_sketch.add(download_rate)
+        self.upload_sketch.add(upload_rate)
+
+    def merge(self, other):
+        self.samples += other.samples
+        self.download_sum += other.download_sum
+        self.download_max = max(self.download_max, other.download_max)
+        self.upload_sum += other.upload_sum
+        self.upload_max = max(self.upload_max, other.upload_max)
+        self.temperature_sum += other.temperature_sum
+        self.temperature_count += other.temperature_count
+        self.download_sketch.merge(other.download_sketch)
+        self.upload_sketch.merge(other.upload_sketch)
+
+    @classmethod
+    def from_rollup_row(cls, row):
+        bucket = cls(row[0])
+        (bucket.samples, bucket.download_sum, bucket.download_max, bucket.upload_sum,
+         bucket.upload_max, bucket.temperature_sum, bucket.temperature_count) = row[1:8]
+        bucket.download_sketch = QuantileSketch.from_bytes(row[8])
+        bucket.upload_sketch = QuantileSketch.from_bytes(row[9])
+        return bucket
+
+    def to_rollup_row(self):
+        return (
+            self.timestamp, self.samples, self.download_sum, self.download_max,
+            self.upload_sum, self.upload_max, self.temperature_sum, self.temperature_count,
+            self.download_sketch.to_bytes(), self.upload_sketch.to_bytes()
+        )
+
+    def to_dict(self):
+        data = {
+            'timestamp': int(self.timestamp),
+            'download_avg': self.download_sum / self.samples,
+            'download_max': self.download_max,
+            'upload_avg': self.upload_sum / self.samples,
+            'upload_max': self.upload_max,
+            'temperature': self.temperature_sum / self.temperature_count if self.temperature_count else None,
+            'samples': self.samples
+        }
+        for q in HISTORY_QUANTILES:
+            data[f'download_p{int(q * 100)}'] = self.download_sketch.quantile(q)
+            data[f'upload_p{int(q * 100)}'] = self.upload_sketch.quantile(q)
+        return data
+
+ROLLUP_COLUMNS = '''bucket, samples, download_sum, download_max, upload_sum, upload_max,
+    temperature_sum, temperature_count, download_sketch, upload_sketch'''
+
+def upsert_rollup(conn, bucket):
+    """Écrit une tranche de 5 minutes en fusionnant avec la ligne existante éventuelle"""
+    row = conn.execute(f'SELECT {ROLLUP_COLUMNS} FROM bandwidth_rollup WHERE bucket = ?', (bucket.timestamp,)).fetchone()
+    if row:
+        existing = HistoryBucket.from_rollup_row(row)
+        existing.merge(bucket)
+        bucket = existing
+    conn.execute(f'INSERT OR REPLACE INTO bandwidth_rollup ({ROLLUP_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 bucket.to_rollup_row())
+
+def rebuild_rollups(conn, start_time, end_time):
+    """Recalcule les tranches de 5 minutes d'une plage à partir des échantillons bruts"""
+    start_time = (start_time // ROLLUP_INTERVAL) * ROLLUP_INTERVAL
+    conn.execute('DELETE FROM bandwidth_rollup WHERE bucket >= ? AND bucket < ?', (start_time, end_time))
+    rebuilt = 0
+    for bucket in iter_sample_buckets(conn, start_time, end_time, ROLLUP_INTERVAL):
+        conn.execute(f'INSERT INTO bandwidth_rollup ({ROLLUP_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     bucket.to_rollup_row())
+        rebuilt += 1
+    conn.commit()
+    history_cache.invalidate(start_time, end_time)
+    return rebuilt
+
+def rebuild_missing_rollups():
+    """Complète les agrégats manquants (migration ou arrêt en cours de tranche)"""
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        last_bucket, = conn.execute('SELECT MAX(bucket) FROM bandwidth_rollup').fetchone()
+        start_time = last_bucket + ROLLUP_INTERVAL if last_bucket is not None else 0
+        rebuilt = rebuild_rollups(conn, start_time, int(time.time()) + 1)
+        if rebuilt > 0:
+            print(f"✓ Agrégats: {rebuilt} tranches de 5 minutes recalculées")
+    finally:
+        conn.close()
+
+class RollupAccumulator:
+    """Tient à jour la tranche de 5 minutes en cours et l'écrit quand elle se termine"""
+
+    def __init__(self):
+        self.current = None
+        self.lock = threading.Lock()
+
+    def add_sample(self, timestamp, download_rate, upload_rate, temperature):
+        bucket_start = (int(timestamp) // ROLLUP_INTERVAL) * ROLLUP_INTERVAL
+        closed = None
+        with self.lock:
+            if self.current is not None and self.current.timestamp != bucket_start:
+                closed = self.current
+                self.current = None
+            if self.current is None:
+                self.current = HistoryBucket(bucket_start)
+            self.current.add_sample(download_rate, upload_rate, temperature)
+        
+        if closed is not None:
+            self.write(closed)
+
+    def write(self, bucket):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+            upsert_rollup(conn, bucket)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"✗ Erreur sauvegarde agrégat: {type(e).__name__} - {e}")
+        # Entre sa fermeture et l'écriture, la tranche n'était ni en cours ni en base :
+        # un historique calculé pendant ce temps ne doit pas rester en cache
+        history_cache.invalidate(bucket.timestamp, bucket.timestamp + ROLLUP_INTERVAL)
+
+    def flush(self):
+        """Écrit la tranche en cours sans attendre sa fin (fin d'un rejeu)"""
+        with self.lock:
+            bucket, self.current = self.current, None
+        if bucket is not None:
+            self.write(bucket)
+
+    def split_rows(self, rows):
+        """Sépare, sans la modifier, les échantillons tardifs de la tranche en cours des autres"""
+        with self.lock:
+            current = self.current.timestamp if self.current is not None else None
+        late = []
+        others = []
+        for row in rows:
+            if (int(row[0]) // ROLLUP_INTERVAL) * ROLLUP_INTERVAL == current:
+                late.append(row)
+            else:
+                others.append(row)
+        return late, others
+
+    def merge_rows(self, rows):
+        """Ajoute à la tranche en cours les échantillons tardifs qui lui appartiennent, retourne les autres"""
+        others = []
+        with self.lock:
+            for row in rows:
+                if self.current is not None and (int(row[0]) // ROLLUP_INTERVAL) * ROLLUP_INTERVAL == self.current.timestamp:
+                    self.current.add_sample(*row[1:])
+                else:
+                    others.append(row)
+        return others
+
+    def open_bucket(self):
+        """Copie de la tranche en cours, pas encore écrite en base"""
+        with self.lock:
+            if self.current is None:
+                return None
+            bucket = HistoryBucket(self.current.timestamp)
+            bucket.merge(self.current)
+            return bucket
+
+rollups = RollupAccumulator()
+
+def aggregate_rows(rows, interval):
+    """Agrège des lignes brutes triées (timestamp, download, upload, temperature) par intervalle"""
+    bucket = None
+    for timestamp, download_rate, upload_rate, temperature in rows:
+        period = (timestamp // interval) * interval
+        if bucket is None or bucket.timestamp != period:
+            if bucket is not None:
+                yield bucket
+            bucket = HistoryBucket(period)
+        bucket.add_sample(download_rate, upload_rate, temperature)
+    if bucket is not None:
+        yield bucket
+
+def regroup_buckets(buckets, interval):
+    """Fusionne des tranches triées dans des tranches plus larges (ou de même période)"""
+    pending = None
+    for bucket in buckets:
+        period = (bucket.timestamp // interval) * interval
+        if pending is not None and pending.timestamp == period:
+            pending.merge(bucket)
+            continue
+        if pending is not None:
+            yield pending
+        pending = HistoryBucket(period)
+        pending.merge(bucket)
+    if pending is not None:
+        yield pending
+
+def iter_rollup_buckets(conn, start_time, end_time):
+    """Parcourt les tranches de 5 minutes pré-agrégées d'une plage"""
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT {ROLLUP_COLUMNS} FROM bandwidth_rollup
+        WHERE bucket >= ? AND bucket < ?
+        ORDER BY bucket ASC
+    ''', (start_time, end_time))
+    
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield HistoryBucket.from_rollup_row(row)
+
+def iter_history_rows(start_time, end_time, interval=None):
+    """Parcourt l'historique par lots (archive puis SQLite), brut ou agrégé par intervalle"""
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        archive_rows = iter_archive_rows(conn, start_time, end_time)
+        if not interval:
+            yield from archive_rows
+            yield from iter_sample_rows(conn, start_time, end_time)
+            return
+        
+        if interval % ROLLUP_INTERVAL == 0:
+            # Fusion des agrégats de 5 minutes (archivés puis en base) et de la tranche en cours
+            archive_buckets = iter_archive_buckets(conn, start_time, end_time)
+            sqlite_buckets = iter_rollup_buckets(conn, start_time, end_time)
+            open_bucket = rollups.open_bucket()
+            if open_bucket is not None and start_time <= open_bucket.timestamp < end_time:
+                sqlite_buckets = itertools.chain(sqlite_buckets, [open_bucket])
+        else:
+            archive_buckets = aggregate_rows(archive_rows, interval)
+            sqlite_buckets = iter_sample_buckets(conn, start_time, end_time, interval)
+        
+        yield from regroup_buckets(itertools.chain(archive_buckets, sqlite_buckets), interval)
+    finally:
+        conn.close()
+
+def iter_sqlite_rows(conn, start_time, end_time):
+    """Parcourt bandwidth_history par lots via un curseur"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT timestamp, download_rate, upload_rate, temperature
+        FROM bandwidth_history
+        WHERE timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp ASC
+    ''', (start_time, end_time))
+    
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+def iter_sample_rows(conn, start_time, end_time):
+    """Parcourt les échantillons bruts non archivés (SQLite ou journal mmap selon STORAGE_BACKEND)"""
+    if STORAGE_BACKEND == 'mmap':
+        return sample_log.iter_rows(start_time, end_time)
+    return iter_sqlite_rows(conn, start_time, end_time)
+
+def iter_sample_buckets(conn, start_time, end_time, interval):
+    """Agrège par intervalle les échantillons bruts non archivés"""
+    if STORAGE_BACKEND == 'mmap':
+        return sample_log.iter_buckets(start_time, end_time, interval)
+    return aggregate_rows(iter_sqlite_rows(conn, start_time, end_time), interval)
+
+# Cache des tranches d'historique
+#
+# Une tranche dont la fenêtre est écoulée ne change plus : son point calculé est gardé
+# en mémoire (clé : intervalle et début de tranche), et seule la tranche en cours est
+# recalculée à chaque requête. Les tranches vides sont gardées aussi, pour ne pas
+# relire les trous. Le nombre de tranches est borné (éviction LRU), et la rétention
+# ou un recalcul d'agrégats invalident les tranches concernées.
+
+def history_point(bucket):
+    """Point d'historique arrondi, tel que renvoyé par l'API"""
+    return {
+        key: round(value, 1 if key == 'temperature' else 2) if isinstance(value, float) else (value or 0)
+        for key, value in bucket.to_dict().items()
+    }
+
+class HistoryCache:
+    def __init__(self, max_buckets, grace):
+        self.max_buckets = max_buckets
+        self.grace = grace
+        self.points = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, start_time, end_time, interval):
+        """Points d'historique de [start_time, end_time), start_time aligné sur l'intervalle"""
+        # Marge pour les échantillons horodatés juste avant la fin d'une tranche
+        closed_before = (min(end_time, int(time.time()) - self.grace) // interval) * interval
+        closed = range(start_time, max(start_time, closed_before), interval)
+        
+        points = {}
+        missing = []
+        with self.lock:
+            generation = self.generation
+            for timestamp in closed:
+                key = (interval, timestamp)
+                if key in self.points:
+                    self.points.move_to_end(key)
+                    points[timestamp] = self.points[key]
+                else:
+                    missing.append(timestamp)
+            self.hits += len(closed) - len(missing)
+            self.misses += len(missing)
+        
+        # Relire les plages contiguës de tranches absentes du cache
+        computed = {}
+        for run_start, run_end in contiguous_ranges(missing, interval):
+            for bucket in iter_history_rows(run_start, run_end, interval):
+                computed[bucket.timestamp] = history_point(bucket)
+        
+        with self.lock:
+            # Une invalidation pendant le calcul rend ces points potentiellement périmés
+            if generation == self.generation:
+                for timestamp in missing:
+                    self.points[(interval, timestamp)] = computed.get(timestamp)
+                while len(self.points) > self.max_buckets:
+                    self.points.popitem(last=False)
+        points.update(computed)
+        
+        result = [points[timestamp] for timestamp in closed if points.get(timestamp) is not None]
+        # Tranche en cours, toujours recalculée
+        if closed.stop < end_time:
+            result.extend(history_point(bucket) for bucket in iter_history_rows(closed.stop, end_time, interval))
+        return result
+
+    def invalidate(self, start_time=None, end_time=None):
+        """Oublie les tranches qui recouvrent [start_time, end_time) (tout par défaut)"""
+        with self.lock:
+            self.generation += 1
+            stale = [
+                key for key in self.points
+                if (end_time is None or key[1] < end_time) and (start_time is None or key[1] + key[0] > start_time)
+            ]
+            for key in stale:
+                del self.points[key]
+
+    def to_dict(self):
+        with self.lock:
+            return {'buckets': len(self.points), 'hits': self.hits, 'misses': self.misses}
+
+def contiguous_ranges(timestamps, interval):
+    """Regroupe des débuts de tranches triés en plages [début, fin) contiguës"""
+    ranges = []
+    for timestamp in timestamps:
+        if ranges and ranges[-1][1] == timestamp:
+            ranges[-1][1] = timestamp + interval
+        else:
+            ranges.append([timestamp, timestamp + interval])
+    return ranges
+
+history_cache = HistoryCache(HISTORY_CACHE_MAX_BUCKETS, COLLECT_INTERVAL * 2)
+
+# Stockage générique des métriques
+#
+# Chaque champ numérique de l'instantané est enregistré sous un nom pointé
+# (ex: system.fan_rpm, system.temp_sensors.temp_cpum, wifi.access_points.0.status.primary_channel).
+# Les noms sont internés dans la table metrics ; metric_samples est une table
+# étroite (metric_id, timestamp, value) rangée par métrique puis par date.
+# Une valeur n'est réécrite que si elle change, ou au moins toutes les
+# METRIC_KEYFRAME_INTERVAL secondes, pour que les métriques quasi constantes
+# (canaux, bande passante...) ne coûtent presque rien.
+# Une valeur vaut donc jusqu'à la ligne suivante : les moyennes par intervalle
+# sont pondérées par la durée de chaque valeur, pas par le nombre de lignes.
+
+def flatten_metrics(data, prefix=''):
+    """Aplatit les champs numériques d'un instantané en {nom pointé: valeur}"""
+    metrics = {}
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = ((item.get('id', i) if isinstance(item, dict) else i, item) for i, item in enumerate(data))
+    else:
+        return metrics
+    
+    for key, value in items:
+        name = f'{prefix}{key}'
+        if key == 'id' or name in METRIC_EXCLUDED_FIELDS:
+            continue
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            metrics[name] = float(value)
+        elif isinstance(value, (dict, list)):
+            metrics.update(flatten_metrics(value, f'{name}.'))
+    return metrics
+
+class MetricStore:
+    def __init__(self):
+        self.ids = {}
+        self.last_written = {}
+        self.lock = threading.Lock()
+
+    def metric_id(self, conn, name):
+        """Retourne l'identifiant interné d'une métrique, en la créant si besoin"""
+        metric_id = self.ids.get(name)
+        if metric_id is None:
+            conn.execute('INSERT OR IGNORE INTO metrics (name) VALUES (?)', (name,))
+            metric_id, = conn.execute('SELECT id FROM metrics WHERE name = ?', (name,)).fetchone()
+            self.ids[name] = metric_id
+        return metric_id
+
+    def record(self, timestamp, metrics):
+        """Enregistre les métriques d'un échantillon en une seule transaction"""
+        timestamp = int(timestamp)
+        with self.lock:
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+            try:
+                rows = []
+                written = {}
+                for name, value in metrics.items():
+                    last = self.last_written.get(name)
+                    if last and last[0] == value and timestamp - last[1] < METRIC_KEYFRAME_INTERVAL:
+                        continue
+                    rows.append((self.metric_id(conn, name), timestamp, value))
+                    written[name] = (value, timestamp)
+                conn.executemany(
+                    'INSERT OR REPLACE INTO metric_samples (metric_id, timestamp, value) VALUES (?, ?, ?)', rows
+                )
+                conn.commit()
+                # Seulement une fois écrites : sinon la valeur serait sautée jusqu'au prochain changement
+                self.last_written.update(written)
+            except Exception as e:
+                # Les métriques créées dans la transaction annulée n'existent pas
+                self.ids = {}
+                print(f"✗ Erreur sauvegarde métriques: {type(e).__name__} - {e}")
+            finally:
+                conn.close()
+
+    def names(self):
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            return [row[0] for row in conn.execute('SELECT name FROM metrics ORDER BY name')]
+        finally:
+            conn.close()
+
+    def query(self, name, start_time, end_time, interval):
+        """Agrège une métrique par intervalle (moyenne pondérée par la durée, minimum, maximum)"""
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            row = conn.execute('SELECT id FROM metrics WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            # La dernière valeur avant le début vaut encore au début de la période
+            cursor = conn.execute('''
+                SELECT timestamp, value FROM (
+                    SELECT timestamp, value FROM metric_samples
+                    WHERE metric_id = ? AND timestamp < ? AND timestamp >= ?
+                    ORDER BY timestamp DESC LIMIT 1
+                )
+                UNION ALL
+                SELECT timestamp, value FROM metric_samples
+                WHERE metric_id = ? AND timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp ASC
+            ''', (row[0], start_time, start_time - METRIC_HOLD_MAX,
+                  row[0], start_time, end_time))
+            
+            periods = {}
+            
+            def hold(timestamp, value, until):
+                # Répartit la durée de la valeur sur les intervalles qu'elle couvre
+                begin = max(timestamp, start_time)
+                until = min(until, timestamp + METRIC_HOLD_MAX, end_time)
+                while begin < until:
+                    period = (begin // interval) * interval
+                    span = min(until, period + interval) - begin
+                    totals = periods.get(period)
+                    if totals is None:
+                        periods[period] = [span * value, span, value, value]
+                    else:
+                        totals[0] += span * value
+                        totals[1] += span
+                        totals[2] = min(totals[2], value)
+                        totals[3] = max(totals[3], value)
+                    begin = period + interval
+            
+            previous = None
+            for timestamp, value in cursor:
+                if previous is not None:
+                    hold(previous[0], previous[1], timestamp)
+                previous = (timestamp, value)
+            if previous is not None:
+                # Dernière valeur : elle vaut encore tant qu'elle n'a pas changé
+                hold(previous[0], previous[1], max(time.time(), previous[0] + COLLECT_INTERVAL))
+            
+            return [{
+                'timestamp': period,
+                'avg': round(total / duration if duration else minimum, 2),
+                'min': minimum,
+                'max': maximum
+            } for period, (total, duration, minimum, maximum) in sorted(periods.items())]
+        finally:
+            conn.close()
+
+metric_store = MetricStore()
+
 # HTML de l'interface intégré
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -390,6 +1701,8 @@ HTML_TEMPLATE = """
             <button class="tab" onclick="switchTab('24h')">📊 24 heures</button>
             <button class="tab" onclick="switchTab('7d')">📈 7 jours</button>
             <button class="tab" onclick="switchTab('30d')">📉 30 jours</button>
+            <button class="tab" onclick="switchTab('1y')">🗄️ 1 an</button>
+            <button class="tab" onclick="switchTab('heatmap')">🗓️ Semaine type</button>
         </div>
 
         <!-- Contenu Temps Réel -->
@@ -427,6 +1740,12 @@ HTML_TEMPLATE = """
             </div>
         </div>
 
+        <!-- Tendance récente (tampon mémoire du serveur) -->
+        <div class="card connection-info" style="margin-bottom: 20px;">
+            <div class="card-title">📈 Tendance récente (10 minutes)</div>
+            <canvas id="recentChart" class="history-chart" style="height: 150px;"></canvas>
+        </div>
+
         <!-- Informations de connexion -->
         <div class="card connection-info">
             <div class="card-title">🌐 Informations de Connexion</div>
@@ -501,6 +1820,14 @@ HTML_TEMPLATE = """
                 <span class="info-value" id="wifiEnabled">--</span>
             </div>
             <div id="wifiAPDetails"></div>
+            <div class="card-title" style="margin-top: 20px;">📶 Stations WiFi (<span id="stationsCount">--</span>)</div>
+            <div id="wifiStations"></div>
+        </div>
+
+        <!-- Ports du switch -->
+        <div class="card connection-info">
+            <div class="card-title">🔀 Ports du switch</div>
+            <div id="switchPorts"></div>
         </div>
 
         <div style="text-align: center;">
@@ -516,6 +1843,12 @@ HTML_TEMPLATE = """
                 <canvas id="history24hChart" class="history-chart"></canvas>
                 <div class="card-label">Moyennes calculées sur 5 minutes</div>
             </div>
+            <div class="card" style="grid-column: 1 / -1;">
+                <div class="card-title">🔀 Ports du switch - 24 heures</div>
+                <select id="switchPortSelect" onchange="loadSwitchHistory('24h')"></select>
+                <canvas id="switchPort24hChart" class="history-chart"></canvas>
+                <div class="card-label">Download : octets émis par le port vers l'appareil, Upload : octets reçus</div>
+            </div>
         </div>
 
         <!-- Contenu 7 jours -->
@@ -536,6 +1869,30 @@ HTML_TEMPLATE = """
             </div>
         </div>
 
+        <!-- Contenu 1 an -->
+        <div id="tab-1y" class="tab-content">
+            <div class="card" style="grid-column: 1 / -1;">
+                <div class="card-title">🗄️ Historique 1 an</div>
+                <canvas id="history1yChart" class="history-chart"></canvas>
+                <div class="card-label">Moyennes calculées par jour (archive incluse)</div>
+            </div>
+        </div>
+
+        <!-- Contenu semaine type -->
+        <div id="tab-heatmap" class="tab-content">
+            <div class="card" style="grid-column: 1 / -1;">
+                <div class="card-title">🗓️ Occupation de la ligne par heure de la semaine</div>
+                <select id="heatmapMetric" onchange="loadHeatmap()">
+                    <option value="download_avg">Download moyen</option>
+                    <option value="download_max">Download maximal</option>
+                    <option value="upload_avg">Upload moyen</option>
+                    <option value="upload_max">Upload maximal</option>
+                </select>
+                <div id="heatmapGrid" style="overflow-x: auto; margin-top: 15px;"></div>
+                <div class="card-label">Débits en Mb/s sur les <span id="heatmapWindow">--</span> derniers jours (heure locale)</div>
+            </div>
+        </div>
+
     </div>
 
     <script>
@@ -543,13 +1900,13 @@ HTML_TEMPLATE = """
         let refreshInterval = null;
         
         // Fonction pour dessiner un graphique d'historique
-        function drawHistoryChart(canvasId, data) {
+        function drawHistoryChart(canvasId, data, outages = []) {
             const canvas = document.getElementById(canvasId);
             if (!canvas || !data || data.length === 0) return;
             
             const ctx = canvas.getContext('2d');
             const width = canvas.width = canvas.offsetWidth;
-            const height = canvas.height = 300;
+            const height = canvas.height = canvas.offsetHeight || 300;
             
             // Fond
             ctx.fillStyle = 'rgba(40, 42, 54, 0.8)';
@@ -564,6 +1921,14 @@ HTML_TEMPLATE = """
             const maxUpload = Math.max(...data.map(d => d.upload_max), 1);
             const maxValue = Math.max(maxDownload, maxUpload);
             
+            // Axe des temps : courbes, labels et coupures placés par horodatage, pour
+            // que les tranches vides (absentes de data) laissent leur place à l'écran
+            const firstTime = data[0].timestamp;
+            const lastTime = data[data.length - 1].timestamp;
+            const xAt = timestamp => lastTime > firstTime
+                ? padding + graphWidth * (timestamp - firstTime) / (lastTime - firstTime)
+                : padding + graphWidth / 2;
+            
             // Dessiner la grille horizontale
             ctx.strokeStyle = 'rgba(98, 114, 164, 0.2)';
             ctx.lineWidth = 1;
@@ -584,7 +1949,7 @@ HTML_TEMPLATE = """
             // Dessiner la grille verticale et labels de temps
             const numTimeLabels = Math.min(6, data.length);
             for (let i = 0; i <= numTimeLabels; i++) {
-                const dataIndex = Math.floor((data.length - 1) * i / numTimeLabels);
+                const labelTime = firstTime + (lastTime - firstTime) * i / numTimeLabels;
                 const x = padding + (graphWidth * i / numTimeLabels);
                 
                 // Ligne verticale
@@ -595,20 +1960,31 @@ HTML_TEMPLATE = """
                 ctx.stroke();
                 
                 // Label de temps
-                if (data[dataIndex]) {
-                    const date = new Date(data[dataIndex].timestamp * 1000);
-                    const timeLabel = date.toLocaleString('fr-FR', { 
-                        day: '2-digit',
-                        month: '2-digit',
-                        hour: '2-digit',
-                        minute: '2-digit'
-                    });
-                    
-                    ctx.fillStyle = '#6272a4';
-                    ctx.font = '10px monospace';
-                    ctx.textAlign = 'center';
-                    ctx.fillText(timeLabel, x, height - padding + 15);
-                }
+                const date = new Date(labelTime * 1000);
+                const timeLabel = date.toLocaleString('fr-FR', { 
+                    day: '2-digit',
+                    month: '2-digit',
+                    hour: '2-digit',
+                    minute: '2-digit'
+                });
+                
+                ctx.fillStyle = '#6272a4';
+                ctx.font = '10px monospace';
+                ctx.textAlign = 'center';
+                ctx.fillText(timeLabel, x, height - padding + 15);
+            }
+            
+            // Marquer les coupures (bandes rouges)
+            if (lastTime > firstTime) {
+                ctx.fillStyle = 'rgba(255, 85, 85, 0.25)';
+                outages.forEach(outage => {
+                    const end = outage.start + outage.duration;
+                    const x1 = xAt(Math.max(outage.start, firstTime));
+                    const x2 = xAt(Math.min(end, lastTime));
+                    if (x2 >= x1) {
+                        ctx.fillRect(x1, padding, Math.max(x2 - x1, 2), graphHeight);
+                    }
+                });
             }
             
             // Dessiner la courbe download
@@ -617,7 +1993,7 @@ HTML_TEMPLATE = """
             ctx.beginPath();
             
             data.forEach((point, i) => {
-                const x = padding + (graphWidth * i / (data.length - 1));
+                const x = xAt(point.timestamp);
                 const y = height - padding - ((point.download_avg / maxValue) * graphHeight);
                 
                 if (i === 0) {
@@ -629,13 +2005,35 @@ HTML_TEMPLATE = """
             
             ctx.stroke();
             
-            // Dessiner la courbe upload
-            ctx.strokeStyle = '#8be9fd';
-            ctx.lineWidth = 2;
-            ctx.beginPath();
+            // Dessiner le 95e percentile du download (pointillés)
+            if (data[0].download_p95 !== undefined) {
+                ctx.strokeStyle = '#ffb86c';
+                ctx.lineWidth = 1;
+                ctx.setLineDash([4, 4]);
+                ctx.beginPath();
+                
+                data.forEach((point, i) => {
+                    const x = xAt(point.timestamp);
+                    const y = height - padding - ((point.download_p95 / maxValue) * graphHeight);
+                    
+                    if (i === 0) {
+                        ctx.moveTo(x, y);
+                    } else {
+                        ctx.lineTo(x, y);
+                    }
+                });
+                
+                ctx.stroke();
+                ctx.setLineDash([]);
+            }
+            
+            // Dessiner la courbe upload
+            ctx.strokeStyle = '#8be9fd';
+            ctx.lineWidth = 2;
+            ctx.beginPath();
             
             data.forEach((point, i) => {
-                const x = padding + (graphWidth * i / (data.length - 1));
+                const x = xAt(point.timestamp);
                 const y = height - padding - ((point.upload_avg / maxValue) * graphHeight);
                 
                 if (i === 0) {
@@ -659,6 +2057,41 @@ HTML_TEMPLATE = """
             ctx.fillRect(padding + 120, 10, 20, 10);
             ctx.fillStyle = '#f8f8f2';
             ctx.fillText('Upload', padding + 145, 19);
+            
+            ctx.fillStyle = '#ffb86c';
+            ctx.fillRect(padding + 220, 10, 20, 10);
+            ctx.fillStyle = '#f8f8f2';
+            ctx.fillText('Download p95', padding + 245, 19);
+            
+            if (outages.length > 0) {
+                ctx.fillStyle = 'rgba(255, 85, 85, 0.6)';
+                ctx.fillRect(padding + 370, 10, 20, 10);
+                ctx.fillStyle = '#f8f8f2';
+                ctx.fillText('Coupure', padding + 395, 19);
+            }
+        }
+        
+        // Graphique temps réel alimenté par /api/recent (aucun accès disque côté serveur)
+        async function loadRecent() {
+            try {
+                const response = await fetch('/api/recent?seconds=600&metrics=stats.rx_rate,stats.tx_rate');
+                const data = await response.json();
+                if (!data.success || data.timestamps.length < 2) return;
+                
+                drawHistoryChart('recentChart', data.timestamps.map((timestamp, i) => {
+                    const down = (data.metrics['stats.rx_rate'][i] || 0) * 8 / 1000000;
+                    const up = (data.metrics['stats.tx_rate'][i] || 0) * 8 / 1000000;
+                    return {
+                        timestamp: timestamp,
+                        download_avg: down,
+                        download_max: down,
+                        upload_avg: up,
+                        upload_max: up
+                    };
+                }));
+            } catch (error) {
+                console.error('Erreur chargement tendance:', error);
+            }
         }
         
         // Fonction pour changer d'onglet
@@ -678,7 +2111,9 @@ HTML_TEMPLATE = """
             event.target.classList.add('active');
             
             // Charger les données d'historique si nécessaire
-            if (tabName !== 'realtime') {
+            if (tabName === 'heatmap') {
+                loadHeatmap();
+            } else if (tabName !== 'realtime') {
                 loadHistory(tabName);
             }
         }
@@ -712,14 +2147,82 @@ HTML_TEMPLATE = """
                 
                 if (data.success && data.data.length > 0) {
                     const canvasId = `history${period.replace('h', 'h').replace('d', 'd')}Chart`;
-                    drawHistoryChart(canvasId, data.data);
+                    const outagesResponse = await fetch(`/api/outages?start=${data.data[0].timestamp}`);
+                    const outages = await outagesResponse.json();
+                    drawHistoryChart(canvasId, data.data, outages.success ? outages.outages : []);
                 } else {
                     console.log('Pas encore assez de données pour', period);
                 }
+                
+                if (period === '24h') {
+                    loadSwitchHistory(period);
+                }
             } catch (error) {
                 console.error('Erreur chargement historique:', error);
             }
         }
+        
+        // Historique des débits d'un port du switch (/api/history/<period>?ports=all)
+        async function loadSwitchHistory(period) {
+            try {
+                const response = await fetch(`/api/history/${period}?ports=all`);
+                const data = await response.json();
+                if (!data.success || !data.ports) return;
+                
+                const select = document.getElementById('switchPortSelect');
+                const selected = select.value;
+                select.replaceChildren(...Object.keys(data.ports).map(portId => new Option(`Port ${portId}`, portId)));
+                if (selected && data.ports[selected]) {
+                    select.value = selected;
+                }
+                
+                const points = data.ports[select.value] || [];
+                drawHistoryChart(`switchPort${period}Chart`, points.map(point => ({
+                    timestamp: point.timestamp,
+                    download_avg: (point.tx_rate_avg || 0) * 8 / 1000000,
+                    download_max: (point.tx_rate_max || 0) * 8 / 1000000,
+                    upload_avg: (point.rx_rate_avg || 0) * 8 / 1000000,
+                    upload_max: (point.rx_rate_max || 0) * 8 / 1000000
+                })));
+            } catch (error) {
+                console.error('Erreur chargement historique switch:', error);
+            }
+        }
+
+        // Semaine type : une case par jour et par heure, d'autant plus claire que le débit est élevé
+        async function loadHeatmap() {
+            try {
+                const response = await fetch('/api/heatmap');
+                const data = await response.json();
+                if (!data.success) return;
+                
+                const metric = document.getElementById('heatmapMetric').value;
+                const matrix = data[metric];
+                const maxValue = Math.max(...matrix.flat().filter(v => v !== null), 0.01);
+                const days = ['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam', 'Dim'];
+                
+                let html = '<table style="border-collapse: collapse; width: 100%; font-size: 0.75em;"><tr><td></td>';
+                for (let hour = 0; hour < 24; hour++) {
+                    html += `<td style="color: #6272a4; text-align: center;">${hour}h</td>`;
+                }
+                html += '</tr>';
+                matrix.forEach((row, day) => {
+                    html += `<tr><td style="color: #6272a4; padding-right: 8px;">${days[day]}</td>`;
+                    row.forEach((value, hour) => {
+                        const alpha = value === null ? 0 : 0.1 + 0.9 * value / maxValue;
+                        const label = value === null ? 'Pas de données' : `${value.toFixed(2)} Mb/s`;
+                        html += `<td title="${days[day]} ${hour}h : ${label}" style="height: 28px; border: 1px solid #282a36; background: rgba(80, 250, 123, ${alpha.toFixed(2)});"></td>`;
+                    });
+                    html += '</tr>';
+                });
+                html += '</table>';
+                
+                document.getElementById('heatmapGrid').innerHTML = html;
+                document.getElementById('heatmapWindow').textContent = data.window_days;
+            } catch (error) {
+                console.error('Erreur chargement semaine type:', error);
+            }
+        }
 
         function showError(message) {
             document.getElementById('errorText').textContent = message;
@@ -732,6 +2235,20 @@ HTML_TEMPLATE = """
             document.getElementById('errorMessage').classList.remove('show');
         }
 
+        function infoRow(label, value) {
+            // Construit une ligne en texte brut : les noms viennent des appareils du réseau
+            const row = document.createElement('div');
+            row.className = 'info-row';
+            const labelSpan = document.createElement('span');
+            labelSpan.className = 'info-label';
+            labelSpan.textContent = label;
+            const valueSpan = document.createElement('span');
+            valueSpan.className = 'info-value';
+            valueSpan.textContent = value;
+            row.append(labelSpan, valueSpan);
+            return row;
+        }
+
         function formatBytes(bytes) {
             const gb = bytes / (1024 * 1024 * 1024);
             return gb.toFixed(2) + ' GB';
@@ -766,14 +2283,16 @@ HTML_TEMPLATE = """
 
             try {
                 const response = await fetch('/api/status');
+                const data = await response.json().catch(() => ({}));
                 
-                if (!response.ok) {
+                if (!response.ok && !data.error) {
                     throw new Error(`Erreur HTTP: ${response.status}`);
                 }
 
-                const data = await response.json();
-
                 if (!data.success) {
+                    if (data.service && data.service.auth === 'pending_authorization') {
+                        throw new Error('Autorisation en attente : appuyez sur le bouton ► de votre Freebox Server');
+                    }
                     throw new Error(data.error || 'Erreur inconnue');
                 }
 
@@ -852,12 +2371,45 @@ HTML_TEMPLATE = """
                     });
                 }
 
+                // Stations WiFi, les plus gourmandes en premier
+                document.getElementById('stationsCount').textContent = data.wifi.stations_count;
+                const stationsDiv = document.getElementById('wifiStations');
+                stationsDiv.innerHTML = '';
+                
+                [...data.wifi.stations]
+                    .sort((a, b) => (b.tx_rate + b.rx_rate) - (a.tx_rate + a.rx_rate))
+                    .slice(0, 10)
+                    .forEach(station => {
+                        const name = station.hostname || station.mac;
+                        const down = (station.tx_rate * 8 / 1000000).toFixed(2);
+                        const up = (station.rx_rate * 8 / 1000000).toFixed(2);
+                        
+                        stationsDiv.appendChild(infoRow(`${name} (${station.signal} dBm)`, `⬇️ ${down} / ⬆️ ${up} Mb/s`));
+                    });
+
+                // Ports du switch : lien, vitesse et débits depuis le relevé précédent
+                const portsDiv = document.getElementById('switchPorts');
+                portsDiv.innerHTML = '';
+                
+                (data.switch ? data.switch.ports : []).forEach(port => {
+                    let value = '🔴 Déconnecté';
+                    if (port.link === 'up') {
+                        const down = ((port.tx_rate || 0) * 8 / 1000000).toFixed(2);
+                        const up = ((port.rx_rate || 0) * 8 / 1000000).toFixed(2);
+                        value = `⬇️ ${down} / ⬆️ ${up} Mb/s`;
+                    }
+                    
+                    portsDiv.appendChild(infoRow(`Port ${port.id}${port.link === 'up' ? ` (${port.speed} Mb/s)` : ''}`, value));
+                });
+
                 document.getElementById('statusBadge').textContent = 'En ligne';
                 document.getElementById('statusBadge').className = 'status-badge';
 
                 const now = new Date();
                 document.getElementById('lastUpdate').textContent = now.toLocaleString('fr-FR');
 
+                loadRecent();
+
             } catch (error) {
                 console.error('Erreur:', error);
                 showError(`Impossible de récupérer les données: ${error.message}`);
@@ -893,12 +2445,178 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# Limitation de débit
+#
+# Chaque client dispose d'un seau à jetons sur les routes de l'API ; au-delà il reçoit
+# un 429 (ou le dernier instantané pour /api/status). Un seau global borne en plus
+# le nombre de requêtes par seconde envoyées à la Freebox, quel que soit l'appelant.
+
+class UpstreamLimitExceeded(Exception):
+    """Trop de requêtes envoyées à la Freebox sur la dernière période"""
+
+class TokenBucket:
+    """Seau à jetons : `rate` jetons par seconde, jusqu'à `burst` en réserve"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        """Prend un jeton si possible, sinon retourne le délai avant le prochain"""
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, timeout):
+        """Attend un jeton au plus `timeout` secondes"""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.consume()
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class ClientRateLimiter:
+    """Un seau à jetons par client (adresse IP), en nombre borné (LRU)"""
+
+    def __init__(self, rate, burst, max_clients=1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, client):
+        """Retourne 0 si la requête est acceptée, sinon le délai d'attente conseillé"""
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = self.buckets[client] = TokenBucket(self.rate, self.burst)
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(client)
+        return bucket.consume()
+
+def rate_limited(limiter, fallback=None):
+    """Décorateur de route : 429 (ou réponse de repli) au-delà de la limite du client"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = limiter.check(request.remote_addr)
+            if retry_after:
+                response = fallback() if fallback else None
+                if response is None:
+                    response = jsonify({'success': False, 'error': 'Trop de requêtes, réessayez plus tard'})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(math.ceil(retry_after))
+                return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+api_limiter = ClientRateLimiter(API_RATE_LIMIT, API_RATE_BURST)
+init_limiter = ClientRateLimiter(INIT_RATE_LIMIT, INIT_RATE_BURST)
+upstream_limiter = TokenBucket(UPSTREAM_RATE_LIMIT, UPSTREAM_RATE_LIMIT)
+
+# Disjoncteur
+#
+# Après CIRCUIT_FAILURE_THRESHOLD échecs réseau consécutifs (Freebox injoignable,
+# en redémarrage...), le circuit s'ouvre : les appels échouent immédiatement au lieu
+# d'attendre chacun leur timeout. Après un délai (doublé à chaque échec, plafonné),
+# une seule requête d'essai est autorisée (half_open) ; si elle réussit le circuit
+# se referme.
+
+class CircuitOpenError(Exception):
+    """Appel refusé : la Freebox est considérée injoignable"""
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, base_delay, max_delay):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = 'closed'
+        self.failures = 0
+        self.delay = base_delay
+        self.opened_at = 0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.delay:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def is_open(self):
+        """Vrai tant que le circuit est ouvert et qu'aucun essai n'est encore permis"""
+        with self.lock:
+            return self.state == 'open' and time.time() - self.opened_at < self.delay
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                print("✓ Freebox de nouveau joignable, circuit refermé")
+            self.state = 'closed'
+            self.failures = 0
+            self.delay = self.base_delay
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open':
+                # L'essai a échoué : nouvelle attente, deux fois plus longue
+                self.delay = min(self.delay * 2, self.max_delay)
+                self.open()
+            elif self.state == 'closed' and self.failures >= self.failure_threshold:
+                self.open()
+
+    def open(self):
+        self.state = 'open'
+        self.opened_at = time.time()
+        self.probe_in_flight = False
+        print(f"⚠ Freebox injoignable, circuit ouvert pour {self.delay}s")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': round(max(0, self.opened_at + self.delay - time.time()), 1) if self.state == 'open' else 0
+            }
+
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_DELAY, CIRCUIT_MAX_DELAY)
+
 class FreeboxAPI:
     def __init__(self):
         self.session_token = None
         self.app_token = None
         self.challenge = None
         self.permissions = {}
+        self.wifi_ap_ids = None
+        # État de l'authentification : idle, connecting, pending_authorization, authorized, denied, error
+        self.auth_state = 'idle'
+        self.track_id = None
+        self.login_lock = threading.Lock()
         self.load_token()
 
     def load_token(self):
@@ -923,7 +2641,6 @@ class FreeboxAPI:
 
     def request_authorization(self):
         """Demande l'autorisation d'accès à la Freebox"""
-        url = f"{FREEBOX_URL}/api/v8/login/authorize"
         data = {
             "app_id": APP_ID,
             "app_name": APP_NAME,
@@ -932,8 +2649,7 @@ class FreeboxAPI:
         }
         
         try:
-            response = requests.post(url, json=data, timeout=10)
-            result = response.json()
+            result = self.api_call('POST', "/api/v8/login/authorize", json=data, auth=False)
             
             if result.get('success'):
                 app_token = result['result']['app_token']
@@ -946,6 +2662,8 @@ class FreeboxAPI:
                 print(f"➤ Track ID: {track_id}")
                 print("="*60 + "\n")
                 
+                self.auth_state = 'pending_authorization'
+                self.track_id = track_id
                 status = self.wait_authorization(track_id)
                 
                 if status == 'granted':
@@ -954,6 +2672,7 @@ class FreeboxAPI:
                     return True
                 else:
                     print(f"✗ Autorisation refusée (status: {status})")
+                    self.auth_state = 'denied'
                     return False
             else:
                 print(f"✗ Erreur: {result}")
@@ -965,13 +2684,11 @@ class FreeboxAPI:
 
     def wait_authorization(self, track_id, timeout=120):
         """Attend que l'utilisateur accepte l'autorisation"""
-        url = f"{FREEBOX_URL}/api/v8/login/authorize/{track_id}"
         start_time = time.time()
         
         while time.time() - start_time < timeout:
             try:
-                response = requests.get(url, timeout=10)
-                result = response.json()
+                result = self.api_call('GET', f"/api/v8/login/authorize/{track_id}", auth=False)
                 
                 if result.get('success'):
                     status = result['result']['status']
@@ -993,16 +2710,31 @@ class FreeboxAPI:
         return 'timeout'
 
     def login(self):
-        """Se connecte à la Freebox et obtient un session_token"""
+        """Se connecte à la Freebox en tenant à jour l'état d'authentification"""
+        # Une seule tentative à la fois : l'autorisation peut attendre 2 minutes
+        if not self.login_lock.acquire(blocking=False):
+            return False
+        
+        try:
+            self.auth_state = 'connecting'
+            if self.open_session():
+                self.auth_state = 'authorized'
+                return True
+            if self.auth_state == 'connecting':
+                self.auth_state = 'error'
+            return False
+        finally:
+            self.login_lock.release()
+
+    def open_session(self):
+        """Obtient un session_token, en demandant l'autorisation si nécessaire"""
         if not self.app_token:
             print("⚠ Pas de token d'application. Demande d'autorisation...")
             if not self.request_authorization():
                 return False
 
         try:
-            url = f"{FREEBOX_URL}/api/v8/login"
-            response = requests.get(url, timeout=10)
-            result = response.json()
+            result = self.api_call('GET', "/api/v8/login", auth=False)
             
             if not result.get('success'):
                 print(f"✗ Erreur lors de la récupération du challenge: {result}")
@@ -1016,14 +2748,12 @@ class FreeboxAPI:
                 hashlib.sha1
             ).hexdigest()
             
-            url = f"{FREEBOX_URL}/api/v8/login/session"
             data = {
                 "app_id": APP_ID,
                 "password": password
             }
             
-            response = requests.post(url, json=data, timeout=10)
-            result = response.json()
+            result = self.api_call('POST', "/api/v8/login/session", json=data, auth=False)
             
             if result.get('success'):
                 self.session_token = result['result']['session_token']
@@ -1042,14 +2772,39 @@ class FreeboxAPI:
             print(f"✗ Erreur lors de la connexion: {e}")
             return False
 
+    def clock(self):
+        """Heure courante (horloge simulée en mode rejeu)"""
+        return time.time()
+
     def get_headers(self):
         return {'X-Fbx-App-Auth': self.session_token}
 
-    def get_system_info(self):
+    def api_call(self, method, path, auth=True, **kwargs):
+        """Appelle l'API Freebox (limite globale de requêtes par seconde et disjoncteur)"""
+        if not upstream_limiter.acquire(timeout=UPSTREAM_MAX_WAIT):
+            raise UpstreamLimitExceeded(f"Limite de {UPSTREAM_RATE_LIMIT} requêtes/s vers la Freebox atteinte")
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError("Freebox injoignable (circuit ouvert)")
+        
+        headers = self.get_headers() if auth else None
         try:
-            url = f"{FREEBOX_URL}/api/v8/system"
-            response = requests.get(url, headers=self.get_headers(), timeout=10)
+            response = requests.request(
+                method, f"{FREEBOX_URL}{path}", headers=headers,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT), **kwargs
+            )
             result = response.json()
+        except (requests.RequestException, ValueError):
+            circuit_breaker.record_failure()
+            raise
+        
+        circuit_breaker.record_success()
+        if recorder is not None and auth:
+            recorder.record(method, path, result)
+        return result
+
+    def get_system_info(self):
+        try:
+            result = self.api_call('GET', "/api/v8/system")
             
             if result.get('success'):
                 # Extraire les températures du tableau sensors
@@ -1079,9 +2834,7 @@ class FreeboxAPI:
 
     def get_connection_status(self):
         try:
-            url = f"{FREEBOX_URL}/api/v8/connection"
-            response = requests.get(url, headers=self.get_headers(), timeout=10)
-            return response.json()
+            return self.api_call('GET', CONNECTION_PATH)
         except Exception as e:
             print(f"✗ Erreur connexion: {e}")
             return None
@@ -1094,35 +2847,53 @@ class FreeboxAPI:
 
     def get_lan_hosts(self):
         try:
-            url = f"{FREEBOX_URL}/api/v8/lan/browser/pub"
-            response = requests.get(url, headers=self.get_headers(), timeout=10)
-            return response.json()
+            return self.api_call('GET', "/api/v8/lan/browser/pub")
         except Exception as e:
             print(f"✗ Erreur LAN: {e}")
             return None
 
+    def get_rrd(self, db, date_start, date_end, fields=None):
+        """Séries RRD de la Freebox (net, temp...) sur une plage"""
+        query = {'db': db, 'date_start': date_start, 'date_end': date_end}
+        if fields:
+            query['fields'] = fields
+        try:
+            return self.api_call('POST', "/api/v8/rrd/", json=query)
+        except Exception as e:
+            print(f"✗ Erreur RRD {db}: {e}")
+            return None
+
     def get_wifi_status(self):
         """Récupère le status WiFi via config (compatible Freebox Ultra/Pop)"""
         try:
-            url = f"{FREEBOX_URL}/api/v8/wifi/config"
-            response = requests.get(url, headers=self.get_headers(), timeout=10)
-            return response.json()
+            return self.api_call('GET', "/api/v8/wifi/config")
         except Exception as e:
             print(f"✗ Erreur WiFi: {e}")
             return None
     
+    def get_wifi_ap_ids(self):
+        """Découvre les identifiants des points d'accès WiFi du modèle (mis en cache)"""
+        if self.wifi_ap_ids is None:
+            try:
+                result = self.api_call('GET', "/api/v8/wifi/ap/")
+                
+                if result.get('success') and result.get('result'):
+                    self.wifi_ap_ids = [ap['id'] for ap in result['result']]
+            except Exception as e:
+                print(f"⚠ Découverte des AP WiFi impossible: {e}")
+        
+        # Sur Freebox Ultra, les IDs sont : 0 (2.4G), 1 (5G), 10 (5G1), 11 (6G)
+        return self.wifi_ap_ids or [0, 1, 10, 11]
+    
     def get_wifi_ap(self):
         """Récupère les informations des points d'accès WiFi (Freebox Ultra)"""
         try:
-            # Sur Freebox Ultra, il faut récupérer chaque AP individuellement
-            # Les IDs sont : 0 (2.4G), 1 (5G), 10 (5G1), 11 (6G)
-            ap_ids = [0, 1, 10, 11]
+            # Il faut récupérer chaque AP individuellement
+            ap_ids = self.get_wifi_ap_ids()
             access_points = []
             
             for ap_id in ap_ids:
-                url = f"{FREEBOX_URL}/api/v8/wifi/ap/{ap_id}"
-                response = requests.get(url, headers=self.get_headers(), timeout=10)
-                result = response.json()
+                result = self.api_call('GET', f"/api/v8/wifi/ap/{ap_id}")
                 
                 if result.get('success') and 'result' in result:
                     access_points.append(result['result'])
@@ -1132,242 +2903,2744 @@ class FreeboxAPI:
             print(f"✗ Erreur WiFi AP: {e}")
             return None
     
+    def get_ap_stations(self, ap_id):
+        """Récupère les stations connectées à un point d'accès"""
+        try:
+            return self.api_call('GET', f"/api/v8/wifi/ap/{ap_id}/stations/")
+        except Exception as e:
+            print(f"✗ Erreur stations WiFi (AP {ap_id}): {e}")
+            return None
+    
     def get_wifi_stations(self):
-        """Récupère la liste des stations WiFi connectées"""
-        # L'endpoint /api/v8/wifi/stations n'existe pas sur Freebox Ultra
-        # On retourne un résultat vide pour compatibilité
-        return {'success': True, 'result': []}
+        """Récupère les stations WiFi connectées en interrogeant tous les AP en parallèle"""
+        ap_ids = self.get_wifi_ap_ids()
+        stations = []
+        
+        with ThreadPoolExecutor(max_workers=len(ap_ids)) as executor:
+            results = executor.map(self.get_ap_stations, ap_ids)
+            for ap_id, result in zip(ap_ids, results):
+                if result and result.get('success'):
+                    for station in result.get('result') or []:
+                        station['ap_id'] = ap_id
+                        stations.append(station)
+        
+        return {'success': True, 'result': stations}
+    
+    def get_switch_status(self):
+        """Récupère l'état des ports du switch (lien, vitesse, duplex)"""
+        try:
+            return self.api_call('GET', "/api/v8/switch/status/")
+        except Exception as e:
+            print(f"✗ Erreur switch: {e}")
+            return None
+    
+    def get_switch_port_stats(self, port_id):
+        """Récupère les compteurs d'un port du switch"""
+        try:
+            return self.api_call('GET', f"/api/v8/switch/port/{port_id}/stats")
+        except Exception as e:
+            print(f"✗ Erreur stats switch (port {port_id}): {e}")
+            return None
+    
+    def get_switch_ports(self):
+        """Récupère l'état et les compteurs de tous les ports du switch, interrogés en parallèle"""
+        status = self.get_switch_status()
+        if not status or not status.get('success'):
+            return status
+        ports = status.get('result') or []
+        if not ports:
+            return {'success': True, 'result': []}
+        
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            results = executor.map(self.get_switch_port_stats, [port['id'] for port in ports])
+            for port, result in zip(ports, results):
+                port['stats'] = result.get('result') if result and result.get('success') else None
+        
+        return {'success': True, 'result': ports}
 
 freebox = FreeboxAPI()
 
-@app.route('/')
-def index():
-    """Sert l'interface web"""
-    return render_template_string(HTML_TEMPLATE)
+# Enregistrement et rejeu
+#
+# Avec FREEBOX_RECORD_FILE, chaque réponse brute de l'API (appels authentifiés
+# uniquement : les échanges de connexion contiennent des secrets) est ajoutée avec son
+# horodatage à un fichier JSON lignes compressé en gzip. La commande `replay` fait
+# ensuite repasser cet enregistrement dans le collecteur, le stockage et les agrégats,
+# en temps réel ou accéléré : chaque appel reçoit la dernière réponse enregistrée pour
+# son chemin, et l'horloge suit les horodatages de l'enregistrement.
 
-@app.route('/api/info')
-def api_info():
-    """Page d'accueil de l'API"""
-    return jsonify({
-        'name': 'Freebox Monitor API',
-        'version': '1.0.0',
-        'endpoints': [
-            '/ - Interface web de monitoring',
-            '/api/status - Récupère toutes les données',
-            '/api/init - Initialise la connexion',
-            '/api/info - Informations sur l\'API'
-        ]
-    })
+# Appel qui ouvre chaque cycle de collecte (voir collect_status)
+CONNECTION_PATH = "/api/v8/connection"
 
-@app.route('/api/status')
-def get_status():
-    """Endpoint pour récupérer toutes les données de monitoring"""
-    
-    # Vérifier si on a une session valide, sinon se reconnecter
-    if not freebox.session_token:
-        print("⚠️ Pas de session, reconnexion...")
-        if not freebox.login():
-            return jsonify({
-                'success': False,
-                'error': 'Impossible de se connecter à la Freebox'
-            }), 500
+class TrafficRecorder:
+    def __init__(self, path, flush_interval):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = None
+        self.last_flush = 0
+        self.lock = threading.Lock()
 
-    try:
-        system_info = freebox.get_system_info()
-        
-        # Si on reçoit une erreur auth_required, le token a expiré
-        if system_info and not system_info.get('success') and system_info.get('error_code') == 'auth_required':
-            print("⚠️ Token expiré, reconnexion...")
-            freebox.session_token = None
-            if not freebox.login():
-                return jsonify({
-                    'success': False,
-                    'error': 'Session expirée, impossible de se reconnecter'
-                }), 500
-            # Réessayer après reconnexion
-            system_info = freebox.get_system_info()
-        
-        connection_status = freebox.get_connection_status()
-        lan_hosts = freebox.get_lan_hosts()
-        wifi_status = freebox.get_wifi_status()
-        
-        # Essayer de récupérer les infos WiFi avancées (peuvent échouer sur certains modèles)
+    def record(self, method, path, response):
+        line = json_dumps({'t': round(time.time(), 3), 'm': method, 'p': path, 'r': response}) + b'\n'
         try:
-            wifi_ap = freebox.get_wifi_ap()
-            wifi_stations = freebox.get_wifi_stations()
-        except:
-            wifi_ap = None
-            wifi_stations = None
+            with self.lock:
+                if self.file is None:
+                    # Chaque lancement ajoute un membre gzip au fichier existant
+                    self.file = gzip.open(self.path, 'ab')
+                self.file.write(line)
+                if time.time() - self.last_flush >= self.flush_interval:
+                    self.file.flush()
+                    self.last_flush = time.time()
+        except OSError as e:
+            print(f"✗ Erreur enregistrement API: {e}")
 
-        # Vérifier que les données essentielles sont valides
-        if not system_info or not system_info.get('success'):
-            return jsonify({
-                'success': False,
-                'error': 'Erreur lors de la récupération des informations système',
-                'details': system_info
-            }), 500
-        
-        if not connection_status or not connection_status.get('success'):
-            return jsonify({
-                'success': False,
-                'error': 'Erreur lors de la récupération du statut de connexion',
-                'details': connection_status
-            }), 500
+recorder = TrafficRecorder(RECORD_FILE, RECORD_FLUSH_INTERVAL) if RECORD_FILE else None
 
-        data = {
-            'success': True,
-            'timestamp': time.time(),
-            'system': {
-                'uptime': system_info['result'].get('uptime', ''),
-                'uptime_val': system_info['result'].get('uptime_val', 0),
-                'temp_avg': system_info['result'].get('temp_avg', 0),
-                'temp_sensors': system_info['result'].get('temp_sensors', {}),
-                'temp_cpum': system_info['result'].get('temp_cpum', 0),
-                'temp_sw': system_info['result'].get('temp_sw', 0),
-                'temp_cpub': system_info['result'].get('temp_cpub', 0),
-                'fan_rpm': system_info['result'].get('fan_rpm', 0),
-                'board_name': system_info['result'].get('board_name', ''),
-                'serial': system_info['result'].get('serial', ''),
-                'firmware_version': system_info['result'].get('firmware_version', '')
-            },
-            'connection': {
-                'state': connection_status['result'].get('state', ''),
-                'type': connection_status['result'].get('type', ''),
-                'media': connection_status['result'].get('media', ''),
-                'ipv4': connection_status['result'].get('ipv4', ''),
-                'ipv6': connection_status['result'].get('ipv6', ''),
-                'rate_down': connection_status['result'].get('rate_down', 0),
-                'rate_up': connection_status['result'].get('rate_up', 0),
-                'bandwidth_down': connection_status['result'].get('bandwidth_down', 0),
-                'bandwidth_up': connection_status['result'].get('bandwidth_up', 0)
-            },
-            'stats': {
-                'rx_bytes': connection_status['result'].get('bytes_down', 0),
-                'tx_bytes': connection_status['result'].get('bytes_up', 0),
-                'rx_rate': connection_status['result'].get('rate_down', 0),
-                'tx_rate': connection_status['result'].get('rate_up', 0)
-            },
-            'lan': {
-                'devices_count': len(lan_hosts['result']) if lan_hosts and lan_hosts.get('success') else 0,
-                'devices_active': len([d for d in lan_hosts['result'] if d.get('active', False)]) if lan_hosts and lan_hosts.get('success') else 0
-            },
-            'wifi': {
-                'enabled': wifi_status['result'].get('enabled', False) if wifi_status and wifi_status.get('success') else False,
-                'access_points': wifi_ap.get('result', []) if wifi_ap and wifi_ap.get('success') else [],
-                'stations': wifi_stations.get('result', []) if wifi_stations and wifi_stations.get('success') else [],
-                'stations_count': len(wifi_stations.get('result', [])) if wifi_stations and wifi_stations.get('success') else 0
-            }
-        }
-        
-        # Sauvegarder les stats dans la base de données
-        download_mbps = (data['stats']['rx_rate'] * 8 / 1000000)
-        upload_mbps = (data['stats']['tx_rate'] * 8 / 1000000)
-        temp = data['system']['temp_avg']
-        save_stats(download_mbps, upload_mbps, temp)
+def iter_recording(path):
+    """Parcourt un enregistrement, y compris s'il a été interrompu en cours d'écriture"""
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                if line.endswith(b'\n'):
+                    yield json.loads(line)
+        except (EOFError, zlib.error):
+            return
 
-        return jsonify(data)
+class ReplayFreebox(FreeboxAPI):
+    """Client Freebox qui répond à partir d'un enregistrement, sur une horloge simulée"""
+
+    def __init__(self):
+        super().__init__()
+        self.responses = {}
+        self.current_time = 0
+        self.session_token = 'replay'
+        self.auth_state = 'authorized'
+
+    def clock(self):
+        return self.current_time
+
+    def login(self):
+        return True
+
+    def api_call(self, method, path, auth=True, **kwargs):
+        response = self.responses.get((method, path))
+        if response is None:
+            raise ConnectionError(f"Aucune réponse enregistrée pour {method} {path}")
+        return response
+
+def replay_recording(path, speed, data_dir=None):
+    """Fait passer un enregistrement dans le collecteur, le stockage et les agrégats"""
+    global freebox
+    freebox = replay = ReplayFreebox()
+    # Jamais dans la base en service, sauf dossier explicite
+    directory = use_data_dir(data_dir or tempfile.mkdtemp(prefix='freebox-replay-'))
+    print(f"✓ Rejeu dans {directory}")
+    # Pas de notification, d'export ni de journal de connexion pendant un rejeu
+    alert_engine.notifier.url = ''
+    export_sinks.clear()
+    collector.listeners.remove(connection_log.process)
+    init_database()
     
-    except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"✗ Erreur dans get_status: {e}")
-        print(error_trace)
+    started = time.time()
+    first_time = None
+    cycle_time = None
+    samples = 0
+    
+    def run_cycle():
+        replay.current_time = cycle_time
+        if speed > 0:
+            time.sleep(max(0, started + (cycle_time - first_time) / speed - time.time()))
+        return 1 if collector.collect_once().get('success') else 0
+    
+    # Un cycle de collecte commence par l'appel du statut de connexion : il est rejoué
+    # quand le suivant commence, une fois toutes ses réponses chargées
+    for record in iter_recording(path):
+        if record['p'] == CONNECTION_PATH:
+            if cycle_time is not None:
+                samples += run_cycle()
+            cycle_time = record['t']
+            if first_time is None:
+                first_time = cycle_time
+        replay.responses[(record['m'], record['p'])] = record['r']
+    if cycle_time is not None:
+        samples += run_cycle()
+    rollups.flush()
+    
+    elapsed = time.time() - started
+    covered = (cycle_time - first_time) if cycle_time is not None else 0
+    print(f"✓ Rejeu terminé: {samples} échantillons, {covered / 3600:.1f} h d'historique en {elapsed:.1f} s")
+    return samples
+
+# Moteur d'alertes
+#
+# Chaque règle est évaluée sur chaque échantillon produit par le collecteur :
+#   - threshold : moyenne glissante d'une métrique comparée à un seuil
+#   - state     : valeur attendue d'un champ texte (ex: connection.state == 'up')
+#   - ratio     : moyenne glissante d'une métrique rapportée à une référence
+#                 (ex: débit descendant / bandwidth_down)
+# Le seuil 'clear' apporte l'hystérésis : une alerte déclenchée n'est notifiée
+# qu'une fois, et ne se résout que lorsque la valeur repasse ce seuil.
+
+DEFAULT_ALERT_RULES = [
+    {'name': 'temperature_elevee', 'type': 'threshold', 'metric': 'system.temp_avg',
+     'op': '>', 'value': 75, 'clear': 70, 'window': 60},
+    {'name': 'ventilateur_lent', 'type': 'threshold', 'metric': 'system.fan_rpm',
+     'op': '<', 'value': 500, 'clear': 800, 'window': 30},
+    {'name': 'connexion_perdue', 'type': 'state', 'metric': 'connection.state', 'expected': 'up'},
+    {'name': 'debit_faible', 'type': 'ratio', 'metric': 'connection.rate_down',
+     'reference': 'connection.bandwidth_down', 'scale': 8, 'below': 0.01, 'clear': 0.02,
+     'window': 300, 'enabled': False}
+]
+
+def get_metric(data, path):
+    """Récupère une valeur dans l'instantané via un chemin pointé (ex: system.temp_sensors.temp_cpum)"""
+    value = data
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+class SlidingWindow:
+    """Moyenne glissante sur une durée, mise à jour en O(1) amorti par échantillon"""
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.samples = deque()
+        self.total = 0.0
+
+    def push(self, timestamp, value):
+        self.samples.append((timestamp, value))
+        self.total += value
+        # Le dernier échantillon est toujours gardé (fenêtre nulle : valeur courante)
+        while len(self.samples) > 1 and self.samples[0][0] <= timestamp - self.duration:
+            _, old_value = self.samples.popleft()
+            self.total -= old_value
+
+    def mean(self):
+        return self.total / len(self.samples) if self.samples else None
+
+class AlertRule:
+    def __init__(self, config):
+        self.config = config
+        self.name = config['name']
+        self.type = config.get('type', 'threshold')
+        self.metric = config['metric']
+        window = float(config.get('window', COLLECT_INTERVAL))
+        if not math.isfinite(window) or window < 0:
+            raise ValueError(f"window invalide: {config.get('window')}")
+        self.window = SlidingWindow(max(window, COLLECT_INTERVAL)) if self.type != 'state' else None
+        self.firing = False
+        self.since = None
+        self.last_value = None
+
+    def evaluate(self, data):
+        """Évalue la règle sur un échantillon, retourne 'firing', 'resolved' ou None"""
+        value = get_metric(data, self.metric)
+        if value is None:
+            return None
         
-        # Log détaillé pour debug
-        print(f"Type d'erreur: {type(e).__name__}")
-        print(f"Message: {str(e)}")
+        if self.type == 'state':
+            self.last_value = value
+            triggered = value != self.config['expected']
+            cleared = not triggered
+        else:
+            if self.type == 'ratio':
+                reference = get_metric(data, self.config['reference'])
+                if not reference:
+                    return None
+                value = value * self.config.get('scale', 1) / reference
+            self.window.push(data['timestamp'], value)
+            self.last_value = mean = self.window.mean()
+            if mean is None:
+                return None
+            
+            if self.type == 'ratio':
+                triggered = mean < self.config['below']
+                cleared = mean >= self.config.get('clear', self.config['below'])
+            elif self.config.get('op', '>') == '>':
+                triggered = mean > self.config['value']
+                cleared = mean <= self.config.get('clear', self.config['value'])
+            else:
+                triggered = mean < self.config['value']
+                cleared = mean >= self.config.get('clear', self.config['value'])
         
-        return jsonify({
-            'success': False,
-            'error': f'Erreur serveur: {str(e)}',
-            'error_type': type(e).__name__
-        }), 500
+        if not self.firing and triggered:
+            self.firing = True
+            self.since = data['timestamp']
+            return 'firing'
+        if self.firing and cleared:
+            self.firing = False
+            self.since = data['timestamp']
+            return 'resolved'
+        return None
 
-@app.route('/api/init')
-def init_freebox():
-    """Endpoint pour initialiser la connexion"""
-    if freebox.login():
-        return jsonify({'success': True, 'message': 'Connexion établie'})
-    else:
-        return jsonify({'success': False, 'message': 'Échec de la connexion'}), 500
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'type': self.type,
+            'metric': self.metric,
+            'firing': self.firing,
+            'since': self.since,
+            'value': self.last_value,
+            'config': self.config
+        }
 
-@app.route('/api/history/<period>')
-def get_history(period):
-    """Récupère l'historique pour une période donnée (24h, 7d, 30d)"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+class WebhookNotifier:
+    """Envoie les notifications en arrière-plan, avec nouvelles tentatives, sans bloquer la collecte"""
+
+    def __init__(self, url, max_attempts=5, queue_size=100):
+        self.url = url
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+    def notify(self, payload):
+        if not self.url:
+            return
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            print(f"⚠ File de notifications pleine, alerte ignorée: {payload['alert']}")
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='webhook-notifier', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            payload = self.queue.get()
+            for attempt in range(self.max_attempts):
+                try:
+                    response = requests.post(self.url, json=payload, timeout=10)
+                    if response.status_code < 500:
+                        break
+                except requests.RequestException as e:
+                    print(f"✗ Erreur webhook (tentative {attempt + 1}): {e}")
+                # Pas d'attente après la dernière tentative : l'alerte suivante attend déjà
+                if attempt < self.max_attempts - 1:
+                    time.sleep(2 ** attempt)
+            else:
+                print(f"✗ Notification abandonnée après {self.max_attempts} tentatives: {payload['alert']}")
+
+class AlertEngine:
+    def __init__(self, rules, notifier):
+        self.rules = []
+        for rule in rules:
+            if not rule.get('enabled', True):
+                continue
+            try:
+                self.rules.append(AlertRule(rule))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"⚠ Règle d'alerte ignorée ({rule.get('name', '?')}): {type(e).__name__} - {e}")
+        self.notifier = notifier
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """Charge les règles et le webhook depuis alerts.json s'il existe"""
+        config = {}
+        if os.path.exists(ALERTS_FILE):
+            try:
+                with open(ALERTS_FILE, 'r') as f:
+                    config = json.load(f)
+                print(f"✓ Règles d'alerte chargées depuis {ALERTS_FILE}")
+            except Exception as e:
+                print(f"⚠ Erreur lors du chargement des alertes: {e}")
+        webhook = ALERT_WEBHOOK_URL or config.get('webhook', '')
+        return cls(config.get('rules', DEFAULT_ALERT_RULES), WebhookNotifier(webhook))
+
+    def process(self, data):
+        """Évalue toutes les règles sur un nouvel échantillon"""
+        with self.lock:
+            for rule in self.rules:
+                # Une règle en erreur ne doit pas empêcher l'évaluation des suivantes
+                try:
+                    status = rule.evaluate(data)
+                except Exception as e:
+                    print(f"✗ Erreur évaluation de l'alerte {rule.name}: {type(e).__name__} - {e}")
+                    continue
+                if status:
+                    print(f"{'🔔' if status == 'firing' else '✓'} Alerte {rule.name}: {status} ({rule.metric} = {rule.last_value})")
+                    self.notifier.notify({
+                        'alert': rule.name,
+                        'status': status,
+                        'metric': rule.metric,
+                        'value': rule.last_value,
+                        'timestamp': data['timestamp'],
+                        'rule': rule.config
+                    })
+
+    def to_list(self):
+        with self.lock:
+            return [rule.to_dict() for rule in self.rules]
+
+alert_engine = AlertEngine.from_config()
+
+# Export vers MQTT et InfluxDB
+#
+# Chaque échantillon (champs numériques aplatis, voir flatten_metrics) est confié aux
+# destinations configurées sans bloquer la collecte : un thread par destination envoie
+# les échantillons accumulés toutes les SINK_FLUSH_INTERVAL secondes. Si la destination
+# est injoignable, le lot est écrit dans un fichier de la file sur disque, et les
+# fichiers sont renvoyés dans l'ordre, avant tout nouveau lot, dès qu'elle répond à
+# nouveau. Un lot renvoyé après un échec partiel peut donc arriver deux fois.
+
+def recv_exact(sock, size):
+    """Lit exactement size octets sur la socket"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connexion fermée par le serveur')
+        data += chunk
+    return data
+
+def mqtt_string(value):
+    """Chaîne MQTT : longueur sur 2 octets puis UTF-8"""
+    encoded = value.encode('utf-8')
+    return struct.pack('!H', len(encoded)) + encoded
+
+def mqtt_packet(header, body):
+    """Paquet MQTT : en-tête fixe, longueur restante (entier variable) puis contenu"""
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes([header]) + bytes(encoded) + body
+
+class MqttSink:
+    """Publie chaque échantillon en JSON sur <topic>/status (MQTT 3.1.1, QoS 1)"""
+    
+    name = 'mqtt'
+
+    def __init__(self, url, client_id='freebox-monitor'):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 1883
+        self.username = parts.username
+        self.password = parts.password
+        self.topic = parts.path.strip('/') or 'freebox'
+        self.client_id = client_id
+
+    def send(self, samples):
+        """Publie un lot sur une connexion dédiée et attend l'accusé de chaque message"""
+        sock = socket.create_connection((self.host, self.port), timeout=UPSTREAM_READ_TIMEOUT)
+        try:
+            flags = 0x02  # Session propre
+            credentials = b''
+            if self.username:
+                flags |= 0x80
+                credentials += mqtt_string(self.username)
+            if self.password:
+                flags |= 0x40
+                credentials += mqtt_string(self.password)
+            sock.sendall(mqtt_packet(0x10, mqtt_string('MQTT') + bytes([4, flags]) + struct.pack('!H', 60)
+                                     + mqtt_string(self.client_id) + credentials))
+            connack = recv_exact(sock, 4)
+            if connack[0] != 0x20 or connack[3] != 0:
+                raise ConnectionError(f"Connexion MQTT refusée (code {connack[3]})")
+            
+            topic = mqtt_string(f'{self.topic}/status')
+            for index, sample in enumerate(samples):
+                packet_id = struct.pack('!H', index % 65535 + 1)
+                sock.sendall(mqtt_packet(0x32, topic + packet_id + json_dumps(sample)))
+            for _ in samples:
+                puback = recv_exact(sock, 4)
+                if puback[0] != 0x40:
+                    raise ConnectionError(f"Réponse MQTT inattendue: {puback[0]:#x}")
+            sock.sendall(mqtt_packet(0xE0, b''))
+        finally:
+            sock.close()
+
+def line_protocol_key(name):
+    """Échappe un nom de champ pour le protocole ligne d'InfluxDB"""
+    return name.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+class InfluxSink:
+    """Écrit les échantillons dans InfluxDB (protocole ligne, horodatage en nanosecondes)"""
+    
+    name = 'influx'
+
+    def __init__(self, url, token='', measurement='freebox'):
+        self.url = url
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if token:
+            self.headers['Authorization'] = f'Token {token}'
+        self.measurement = line_protocol_key(measurement)
+
+    def send(self, samples):
+        lines = []
+        for sample in samples:
+            fields = ','.join(f'{line_protocol_key(name)}={float(value)!r}'
+                              for name, value in sample.items() if name != 'timestamp')
+            if fields:
+                lines.append(f"{self.measurement} {fields} {int(sample['timestamp'] * 1e9)}")
+        response = requests.post(self.url, data='\n'.join(lines).encode('utf-8'), headers=self.headers,
+                                 timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+        response.raise_for_status()
+
+class SpooledSink:
+    """Regroupe les échantillons d'une destination par fenêtre d'envoi, avec file sur disque"""
+
+    def __init__(self, sink, spool_dir, interval, max_files):
+        self.sink = sink
+        self.spool_dir = os.path.join(spool_dir, sink.name)
+        self.interval = interval
+        self.max_files = max_files
+        self.pending = []
+        self.sequence = 0
+        self.sent = 0
+        self.last_error = None
+        self.state = 'idle'
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, sample):
+        with self.lock:
+            self.pending.append(sample)
+
+    def spooled(self):
+        """Fichiers de la file, du plus ancien au plus récent"""
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(os.path.join(self.spool_dir, name) for name in os.listdir(self.spool_dir) if name.endswith('.jsonl'))
+
+    def spool(self, samples):
+        """Met un lot en file sur disque, en supprimant les plus anciens au-delà de max_files"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.sequence += 1
+        path = os.path.join(self.spool_dir, f'{time.time_ns():020d}-{self.sequence:06d}.jsonl')
+        with open(path + '.tmp', 'wb') as f:
+            for sample in samples:
+                f.write(json_dumps(sample) + b'\n')
+        os.replace(path + '.tmp', path)
         
+        files = self.spooled()
+        for old in files[:max(0, len(files) - self.max_files)]:
+            os.remove(old)
+            print(f"⚠ File d'export {self.sink.name} pleine, lot le plus ancien supprimé")
+
+    def flush(self):
+        """Renvoie la file sur disque dans l'ordre, puis le lot courant"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        try:
+            for path in self.spooled():
+                try:
+                    with open(path, 'rb') as f:
+                        samples = [json.loads(line) for line in f if line.strip()]
+                except ValueError as e:
+                    # Lot illisible (écriture interrompue, disque) : écarté pour ne pas bloquer la file
+                    os.replace(path, path + '.bad')
+                    print(f"⚠ Lot d'export {self.sink.name} illisible, mis de côté ({os.path.basename(path)}.bad): {e}")
+                    continue
+                self.sink.send(samples)
+                os.remove(path)
+                self.sent += len(samples)
+            if batch:
+                self.sink.send(batch)
+                self.sent += len(batch)
+            self.state = 'ok'
+        except Exception as e:
+            if self.state != 'spooling':
+                print(f"✗ Export {self.sink.name} indisponible, mise en file sur disque: {type(e).__name__} - {e}")
+            self.state = 'spooling'
+            self.last_error = f"{type(e).__name__}: {e}"
+            if batch:
+                self.spool(batch)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"✗ Erreur export {self.sink.name}: {type(e).__name__} - {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'export-{self.sink.name}', daemon=True)
+        self.thread.start()
+        print(f"✓ Export {self.sink.name} activé (toutes les {self.interval}s)")
+
+    def to_dict(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            'state': self.state,
+            'pending': pending,
+            'spooled_batches': len(self.spooled()),
+            'sent': self.sent,
+            'last_error': self.last_error
+        }
+
+def configured_sinks():
+    """Destinations d'export configurées par variables d'environnement"""
+    sinks = []
+    if MQTT_URL:
+        sinks.append(MqttSink(MQTT_URL))
+    if INFLUX_URL:
+        sinks.append(InfluxSink(INFLUX_URL, INFLUX_TOKEN))
+    return [SpooledSink(sink, SINK_SPOOL_DIR, SINK_FLUSH_INTERVAL, SINK_SPOOL_MAX_FILES) for sink in sinks]
+
+export_sinks = configured_sinks()
+
+def export_sample(data):
+    """Confie l'échantillon (champs numériques aplatis) aux destinations d'export"""
+    if not export_sinks:
+        return
+    sample = dict(flatten_metrics(data), timestamp=data['timestamp'])
+    for sink in export_sinks:
+        sink.add(sample)
+
+class StationTracker:
+    """Interroge les stations WiFi à un rythme plus lent que les débits et historise leurs mesures"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stations = []
+        self.last_poll = 0
+        self.station_ids = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Retourne les stations connues, en les rafraîchissant si l'intervalle est écoulé"""
+        # Le verrou ne protège que la décision : l'appel à la Freebox se fait hors verrou
+        with self.lock:
+            due = freebox.clock() - self.last_poll >= self.interval
+            if due:
+                self.last_poll = freebox.clock()
+                polled = self.last_poll
+        if due:
+            result = freebox.get_wifi_stations()
+            if result and result.get('success'):
+                stations = [compact_station(station) for station in result['result']]
+                self.stations = stations
+                self.record(int(polled), stations)
+        return {'success': True, 'result': self.stations}
+
+    def station_id(self, conn, station):
+        """Retourne l'identifiant interné d'une station (par adresse MAC)"""
+        station_id = self.station_ids.get(station['mac'])
+        if station_id is None:
+            conn.execute('INSERT OR IGNORE INTO wifi_stations (mac) VALUES (?)', (station['mac'],))
+            station_id, = conn.execute('SELECT id FROM wifi_stations WHERE mac = ?', (station['mac'],)).fetchone()
+            self.station_ids[station['mac']] = station_id
+        return station_id
+
+    def record(self, timestamp, stations):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+            rows = []
+            for station in stations:
+                station_id = self.station_id(conn, station)
+                conn.execute('UPDATE wifi_stations SET hostname = ?, last_seen = ? WHERE id = ?',
+                             (station['hostname'], timestamp, station_id))
+                rows.append((station_id, timestamp, station['ap_id'], station['signal'],
+                             station['tx_rate'], station['rx_rate']))
+            conn.executemany('''
+                INSERT OR REPLACE INTO wifi_station_history (station_id, timestamp, ap_id, signal, tx_rate, rx_rate)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"✗ Erreur sauvegarde stations WiFi: {type(e).__name__} - {e}")
+
+def compact_station(station):
+    """Ne garde que les champs utiles d'une station WiFi"""
+    host = station.get('host') or {}
+    return {
+        'mac': (station.get('mac') or '').upper(),
+        'hostname': station.get('hostname') or host.get('primary_name', ''),
+        'ap_id': station.get('ap_id'),
+        'signal': station.get('signal', 0),
+        'tx_rate': station.get('tx_rate', 0),
+        'rx_rate': station.get('rx_rate', 0),
+        'conn_duration': station.get('conn_duration', 0)
+    }
+
+station_tracker = StationTracker(STATIONS_INTERVAL)
+
+# Ports du switch
+#
+# Les compteurs d'octets de chaque port sont relevés selon POLL_SCHEDULE['switch'] ;
+# le débit est l'écart entre deux relevés divisé par le temps écoulé. Un compteur qui
+# diminue (redémarrage, remise à zéro) ne donne pas de débit pour ce relevé.
+
+class SwitchTracker:
+    """Interroge les ports du switch et historise leurs débits, port par port"""
+
+    def __init__(self):
+        self.result = None
+        self.ports = []
+        self.counters = {}
+        self.last_poll = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Retourne les ports connus, rafraîchis selon la planification des appels"""
+        # Appels à la Freebox hors verrou : le verrou ne protège que la mise à jour des compteurs
+        result = poller.get('switch', freebox.get_switch_ports)
+        with self.lock:
+            if result is not self.result and result and result.get('success'):
+                # Nouveau relevé (le planificateur renvoie sinon le même résultat)
+                self.result = result
+                self.last_poll = freebox.clock()
+                self.ports = [self.update(port, self.last_poll) for port in result['result']]
+                self.record(int(self.last_poll), self.ports)
+            return {'success': True, 'result': self.ports}
+
+    def update(self, port, timestamp):
+        """Résumé d'un port, avec ses débits calculés depuis le relevé précédent"""
+        summary = compact_port(port)
+        stats = port.get('stats')
+        if stats is None:
+            return summary
+        
+        counters = (timestamp, int(stats.get('rx_good_bytes', 0)), int(stats.get('tx_bytes', 0)))
+        previous = self.counters.get(summary['id'])
+        self.counters[summary['id']] = counters
+        if previous is not None and counters[0] > previous[0]:
+            elapsed = counters[0] - previous[0]
+            rx_delta = counters[1] - previous[1]
+            tx_delta = counters[2] - previous[2]
+            if rx_delta >= 0 and tx_delta >= 0:
+                summary['rx_rate'] = round(rx_delta / elapsed, 1)
+                summary['tx_rate'] = round(tx_delta / elapsed, 1)
+        return summary
+
+    def record(self, timestamp, ports):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+            conn.executemany('''
+                INSERT OR REPLACE INTO switch_port_history (port_id, timestamp, link_up, rx_rate, tx_rate)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(port['id'], timestamp, int(port['link'] == 'up'), port['rx_rate'], port['tx_rate'])
+                  for port in ports])
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"✗ Erreur sauvegarde ports switch: {type(e).__name__} - {e}")
+
+def compact_port(port):
+    """Ne garde que les champs utiles d'un port du switch (débits en octets/s)"""
+    return {
+        'id': port.get('id'),
+        'name': port.get('name', ''),
+        'link': port.get('link', 'down'),
+        'speed': port.get('speed', ''),
+        'duplex': port.get('duplex', ''),
+        'rx_rate': None,
+        'tx_rate': None
+    }
+
+def port_history(conn, start_time, end_time, interval, port_ids=None):
+    """Débits moyens et maximaux de chaque port par tranche d'interval secondes"""
+    query = '''
+        SELECT
+            port_id,
+            (timestamp / ?) * ? as period,
+            AVG(rx_rate),
+            MAX(rx_rate),
+            AVG(tx_rate),
+            MAX(tx_rate),
+            MAX(link_up)
+        FROM switch_port_history
+        WHERE timestamp >= ? AND timestamp < ?
+    '''
+    params = [interval, interval, start_time, end_time]
+    if port_ids is not None:
+        query += f" AND port_id IN ({', '.join('?' * len(port_ids))})"
+        params += port_ids
+    query += ' GROUP BY port_id, period ORDER BY port_id, period'
+    
+    ports = {}
+    for r in conn.execute(query, params):
+        ports.setdefault(str(r[0]), []).append({
+            'timestamp': r[1],
+            'rx_rate_avg': round(r[2], 1) if r[2] is not None else None,
+            'rx_rate_max': r[3],
+            'tx_rate_avg': round(r[4], 1) if r[4] is not None else None,
+            'tx_rate_max': r[5],
+            'link_up': bool(r[6])
+        })
+    return ports
+
+switch_tracker = SwitchTracker()
+
+class RingBuffer:
+    """Derniers échantillons de toutes les métriques, en mémoire, dans des tableaux de taille fixe"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [math.nan]) * capacity
+        self.columns = {}
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, metrics):
+        with self.lock:
+            index = self.head
+            self.timestamps[index] = timestamp
+            for name, column in self.columns.items():
+                column[index] = metrics.get(name, math.nan)
+            for name, value in metrics.items():
+                if name not in self.columns:
+                    # Nouvelle métrique : colonne complète initialisée à NaN
+                    column = array('d', [math.nan]) * self.capacity
+                    column[index] = value
+                    self.columns[name] = column
+            self.head = (index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def since(self, start_time, names=None):
+        """Retourne les échantillons postérieurs à start_time, du plus ancien au plus récent"""
+        with self.lock:
+            oldest = (self.head - self.count) % self.capacity
+            # Recherche dichotomique dans le tampon circulaire (timestamps croissants)
+            low, high = 0, self.count
+            while low < high:
+                middle = (low + high) // 2
+                if self.timestamps[(oldest + middle) % self.capacity] < start_time:
+                    low = middle + 1
+                else:
+                    high = middle
+            indexes = [(oldest + i) % self.capacity for i in range(low, self.count)]
+            
+            selected = self.columns if names is None else {name: self.columns[name] for name in names if name in self.columns}
+            return {
+                'timestamps': [self.timestamps[i] for i in indexes],
+                'metrics': {
+                    name: [None if math.isnan(column[i]) else column[i] for i in indexes]
+                    for name, column in selected.items()
+                }
+            }
+
+recent_samples = RingBuffer(int(RECENT_BUFFER_SECONDS / COLLECT_INTERVAL) + 1)
+
+# Volumes de données
+#
+# Les compteurs d'octets de la connexion (bytes_down / bytes_up) sont cumulés depuis le
+# démarrage de la Freebox. À chaque échantillon, l'écart avec le relevé précédent est
+# ajouté aux totaux du jour et du mois (heure locale). Si un compteur diminue, ou si
+# l'uptime diminue (redémarrage), le compteur est reparti de zéro et sa valeur entière
+# est comptée. Le dernier relevé est gardé en base pour ne rien perdre entre deux
+# lancements de l'application.
+
+USAGE_GRANULARITIES = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+def split_local_days(start, end):
+    """Découpe [start, end] aux minuits locaux : [(début, durée)] (au moins une partie)"""
+    parts = []
+    while True:
+        day = time.localtime(start)
+        midnight = time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        if end <= midnight:
+            parts.append((start, end - start))
+            return parts
+        parts.append((start, midnight - start))
+        start = midnight
+
+class UsageTracker:
+    def __init__(self):
+        self.last = None
+        self.lock = threading.Lock()
+
+    def process(self, data):
+        """Ajoute aux totaux le volume transféré depuis l'échantillon précédent"""
+        rx_bytes = int(data['stats']['rx_bytes'])
+        tx_bytes = int(data['stats']['tx_bytes'])
+        uptime = int(data['system'].get('uptime_val', 0))
+        try:
+            with self.lock:
+                conn = sqlite3.connect(DB_PATH, timeout=10)
+                if self.last is None:
+                    self.last = conn.execute('SELECT timestamp, rx_bytes, tx_bytes, uptime FROM usage_counters WHERE id = 0').fetchone()
+                
+                if self.last is not None:
+                    last_timestamp, last_rx, last_tx, last_uptime = self.last
+                    rebooted = uptime < last_uptime
+                    download = rx_bytes if rebooted or rx_bytes < last_rx else rx_bytes - last_rx
+                    upload = tx_bytes if rebooted or tx_bytes < last_tx else tx_bytes - last_tx
+                    if download or upload:
+                        conn.executemany('''
+                            INSERT INTO usage_totals (granularity, period, download_bytes, upload_bytes)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT (granularity, period) DO UPDATE SET
+                                download_bytes = download_bytes + excluded.download_bytes,
+                                upload_bytes = upload_bytes + excluded.upload_bytes
+                        ''', self.spread(last_timestamp, data['timestamp'], uptime if rebooted else None, download, upload))
+                
+                conn.execute(
+                    'INSERT OR REPLACE INTO usage_counters (id, timestamp, rx_bytes, tx_bytes, uptime) VALUES (0, ?, ?, ?, ?)',
+                    (int(data['timestamp']), rx_bytes, tx_bytes, uptime)
+                )
+                conn.commit()
+                conn.close()
+                self.last = (int(data['timestamp']), rx_bytes, tx_bytes, uptime)
+        except Exception as e:
+            print(f"✗ Erreur comptage des volumes: {type(e).__name__} - {e}")
+
+    def spread(self, last_timestamp, timestamp, uptime, download, upload):
+        """Lignes (granularité, période, download, upload) d'un volume réparti sur l'écart entre deux relevés"""
+        # Après une interruption du service, le volume est réparti sur les jours de l'écart
+        # au prorata du temps, faute de mieux. Après un redémarrage de la Freebox, seul
+        # l'intervalle depuis le redémarrage compte (le trafic d'avant est perdu).
+        start = last_timestamp if uptime is None else max(last_timestamp, timestamp - uptime)
+        parts = split_local_days(min(start, timestamp), timestamp)
+        duration = sum(length for _, length in parts)
+        
+        totals = {}
+        elapsed = 0
+        previous = (0, 0)
+        for part_start, length in parts:
+            elapsed += length
+            # Répartition cumulée : les arrondis ne perdent aucun octet
+            share = elapsed / duration if duration else 1
+            allocated = (round(download * share), round(upload * share))
+            local_time = time.localtime(part_start)
+            for granularity, fmt in USAGE_GRANULARITIES.items():
+                key = (granularity, time.strftime(fmt, local_time))
+                part_download, part_upload = totals.get(key, (0, 0))
+                totals[key] = (part_download + allocated[0] - previous[0], part_upload + allocated[1] - previous[1])
+            previous = allocated
+        return [key + values for key, values in totals.items()]
+
+    def totals(self, granularity, limit):
+        """Derniers totaux (du plus ancien au plus récent), lus directement par clé"""
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            rows = conn.execute('''
+                SELECT period, download_bytes, upload_bytes FROM usage_totals
+                WHERE granularity = ?
+                ORDER BY period DESC
+                LIMIT ?
+            ''', (granularity, limit)).fetchall()
+        finally:
+            conn.close()
+        return [{
+            'period': period,
+            'download_bytes': download,
+            'upload_bytes': upload,
+            'total_bytes': download + upload
+        } for period, download, upload in reversed(rows)]
+
+usage_tracker = UsageTracker()
+
+# Journal des événements de connexion
+#
+# Une ligne par période : état de la connexion (up, down, going_up...), adresse IPv4 ou
+# IPv6 tenue, ou redémarrage de la Freebox. Une période est ouverte (end_ts NULL) tant
+# que la valeur ne change pas ; au changement suivant elle est fermée et la suivante
+# ouverte. Un redémarrage est détecté quand l'heure de démarrage déduite (timestamp -
+# uptime_val) avance de plus de REBOOT_TOLERANCE : il va du dernier échantillon avant
+# la coupure jusqu'au démarrage. Le dernier
+# relevé est celui gardé en base par les volumes de données (usage_counters), ce qui
+# couvre aussi un redémarrage survenu pendant que l'application était arrêtée.
+
+# Décalage toléré de l'heure de démarrage déduite : uptime_val peut dater de plusieurs
+# périodes d'interrogation du système (résultat conservé en cas d'échec), plus la gigue
+REBOOT_TOLERANCE = POLL_MAX_STALE_PERIODS * POLL_SCHEDULE['system'] + COLLECT_INTERVAL
+
+CONNECTION_EVENT_FIELDS = {'state': ('connection', 'state'), 'ipv4': ('connection', 'ipv4'), 'ipv6': ('connection', 'ipv6')}
+
+class ConnectionEventLog:
+    def __init__(self):
+        self.open = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        """Périodes ouvertes et dernier relevé (timestamp, uptime) avant ce lancement"""
+        self.open = {kind: (event_id, value) for event_id, kind, value in conn.execute(
+            'SELECT id, kind, value FROM connection_events WHERE end_ts IS NULL')}
+        self.last = conn.execute('SELECT timestamp, uptime FROM usage_counters WHERE id = 0').fetchone()
+
+    def process(self, data):
+        """Ferme et ouvre les périodes dont la valeur a changé depuis l'échantillon précédent"""
+        timestamp = int(data['timestamp'])
+        uptime = int(data['system'].get('uptime_val', 0))
+        try:
+            with self.lock:
+                conn = None
+                if self.open is None:
+                    conn = sqlite3.connect(DB_PATH, timeout=10)
+                    self.load(conn)
+                
+                changes = []
+                for kind, (section, field) in CONNECTION_EVENT_FIELDS.items():
+                    value = data[section].get(field) or None
+                    current = self.open.get(kind)
+                    if current is None or current[1] != value:
+                        changes.append((kind, value, current))
+                # Redémarrage : l'heure de démarrage a avancé (pas une simple gigue de l'uptime)
+                rebooted = self.last is not None and (timestamp - uptime) - (self.last[0] - self.last[1]) > REBOOT_TOLERANCE
+                
+                if changes or rebooted:
+                    conn = conn or sqlite3.connect(DB_PATH, timeout=10)
+                    if rebooted:
+                        last_seen = self.last[0]
+                        conn.execute(
+                            'INSERT INTO connection_events (kind, value, previous, start_ts, end_ts) VALUES (?, NULL, ?, ?, ?)',
+                            ('reboot', str(self.last[1]), last_seen, max(last_seen, timestamp - uptime))
+                        )
+                        print(f"⚠ Redémarrage de la Freebox détecté (uptime {self.last[1]}s -> {uptime}s)")
+                    for kind, value, current in changes:
+                        previous = None
+                        if current is not None:
+                            conn.execute('UPDATE connection_events SET end_ts = ? WHERE id = ?', (timestamp, current[0]))
+                            previous = current[1]
+                            print(f"✓ Connexion: {kind} {previous} -> {value}")
+                        cursor = conn.execute(
+                            'INSERT INTO connection_events (kind, value, previous, start_ts, end_ts) VALUES (?, ?, ?, ?, NULL)',
+                            (kind, value, previous, timestamp)
+                        )
+                        self.open[kind] = (cursor.lastrowid, value)
+                    conn.commit()
+                if conn is not None:
+                    conn.close()
+                self.last = (timestamp, uptime)
+        except Exception as e:
+            print(f"✗ Erreur journal de connexion: {type(e).__name__} - {e}")
+
+    def query(self, start_time, end_time, kinds=None):
+        """Périodes qui recoupent [start_time, end_time[, les plus anciennes en premier"""
+        # Deux parties pour utiliser l'index sur end_ts : périodes terminées dans la plage
+        # ou après, et périodes encore ouvertes. Ni ORDER BY ni index sur start_ts (+start_ts) :
+        # SQLite parcourrait sinon tout le journal antérieur à la fin de la plage
+        kind_filter = f" AND kind IN ({', '.join('?' * len(kinds))})" if kinds is not None else ''
+        query = f'''
+            SELECT kind, value, previous, start_ts, end_ts FROM connection_events
+            WHERE end_ts > ? AND +start_ts < ?{kind_filter}
+            UNION ALL
+            SELECT kind, value, previous, start_ts, end_ts FROM connection_events
+            WHERE end_ts IS NULL AND start_ts < ?{kind_filter}
+        '''
+        params = [start_time, end_time] + list(kinds or []) + [end_time] + list(kinds or [])
+        
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            rows = sorted(conn.execute(query, params), key=lambda row: row[3])
+        finally:
+            conn.close()
         now = int(time.time())
+        return [{
+            'kind': kind,
+            'value': value,
+            'previous': previous,
+            'start': start,
+            'end': end,
+            'duration': (end if end is not None else now) - start
+        } for kind, value, previous, start, end in rows]
+
+def is_outage(event):
+    """Coupure : connexion dans un autre état que up, ou redémarrage de la Freebox"""
+    return event['kind'] == 'reboot' or (event['kind'] == 'state' and event['value'] != 'up')
+
+connection_log = ConnectionEventLog()
+
+# Carte horaire de la semaine
+#
+# Débit moyen et maximal pour chacune des 168 heures de la semaine (jour × heure,
+# heure locale) sur la fenêtre de rétention. Les sommes, nombres d'échantillons et
+# maximums sont tenus à jour à chaque échantillon, par heure calendaire et par case :
+# quand une heure sort de la fenêtre, ses sommes sont retranchées de sa case et le
+# maximum de la case est recalculé à partir des heures restantes (une par semaine).
+# Au démarrage, la carte est reconstruite depuis les agrégats de 5 minutes.
+
+HEATMAP_CELLS = 7 * 24
+
+class UsageHeatmap:
+    def __init__(self, window):
+        self.window = window
+        # Totaux : [échantillons, somme down, max down, somme up, max up]
+        # Début d'heure -> (case, totaux de l'heure), par ordre chronologique
+        self.hours = OrderedDict()
+        self.cells = [[0, 0.0, 0.0, 0.0, 0.0] for _ in range(HEATMAP_CELLS)]
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, samples, download_sum, download_max, upload_sum, upload_max):
+        """Ajoute des échantillons (ou un agrégat) à l'heure de timestamp"""
+        hour = (int(timestamp) // 3600) * 3600
+        with self.lock:
+            entry = self.hours.get(hour)
+            if entry is None:
+                if self.hours and hour < next(reversed(self.hours)) - self.window:
+                    return  # Déjà sortie de la fenêtre
+                # Heure complétée après coup (historique de la Freebox) : garder l'ordre chronologique
+                later = list(itertools.takewhile(lambda key: key > hour, reversed(self.hours)))
+                local = datetime.fromtimestamp(hour)
+                entry = self.hours[hour] = (local.weekday() * 24 + local.hour, [0, 0.0, 0.0, 0.0, 0.0])
+                for key in reversed(later):
+                    self.hours.move_to_end(key)
+            index, hour_totals = entry
+            for totals in (hour_totals, self.cells[index]):
+                totals[0] += samples
+                totals[1] += download_sum
+                totals[2] = max(totals[2], download_max)
+                totals[3] += upload_sum
+                totals[4] = max(totals[4], upload_max)
+            self.evict(hour - self.window)
+
+    def add_sample(self, timestamp, download_rate, upload_rate):
+        self.add(timestamp, 1, download_rate, download_rate, upload_rate, upload_rate)
+
+    def add_bucket(self, bucket):
+        self.add(bucket.timestamp, bucket.samples, bucket.download_sum, bucket.download_max,
+                 bucket.upload_sum, bucket.upload_max)
+
+    def evict(self, limit):
+        """Retire les heures antérieures à limit et recalcule le maximum des cases touchées"""
+        touched = set()
+        while self.hours:
+            hour = next(iter(self.hours))
+            if hour >= limit:
+                break
+            index, totals = self.hours.pop(hour)
+            cell = self.cells[index]
+            cell[0] -= totals[0]
+            cell[1] -= totals[1]
+            cell[3] -= totals[3]
+            touched.add(index)
+        
+        for index in touched:
+            remaining = [totals for cell_index, totals in self.hours.values() if cell_index == index]
+            if not remaining:
+                self.cells[index] = [0, 0.0, 0.0, 0.0, 0.0]
+                continue
+            self.cells[index][2] = max(totals[2] for totals in remaining)
+            self.cells[index][4] = max(totals[4] for totals in remaining)
+
+    def load(self, conn, now):
+        """Reconstruit la carte depuis les agrégats de 5 minutes de la fenêtre"""
+        cursor = conn.execute('''
+            SELECT bucket, samples, download_sum, download_max, upload_sum, upload_max
+            FROM bandwidth_rollup WHERE bucket >= ? ORDER BY bucket
+        ''', (now - self.window,))
+        for row in cursor:
+            self.add(*row)
+
+    def to_dict(self):
+        """Matrices 7 × 24 (lundi en premier) des débits moyens et maximaux, en Mb/s"""
+        with self.lock:
+            cells = [list(cell) for cell in self.cells]
+        matrix = lambda value: [[value(cells[day * 24 + hour]) for hour in range(24)] for day in range(7)]
+        return {
+            'window_days': self.window // 86400,
+            'samples': matrix(lambda cell: cell[0]),
+            'download_avg': matrix(lambda cell: round(cell[1] / cell[0], 2) if cell[0] else None),
+            'download_max': matrix(lambda cell: round(cell[2], 2) if cell[0] else None),
+            'upload_avg': matrix(lambda cell: round(cell[3] / cell[0], 2) if cell[0] else None),
+            'upload_max': matrix(lambda cell: round(cell[4], 2) if cell[0] else None)
+        }
+
+heatmap = UsageHeatmap(RETENTION_DAYS * 24 * 3600)
+
+# Événements Freebox
+#
+# Plutôt que d'interroger /lan/browser/pub à chaque échantillon, un abonnement au canal
+# websocket /api/v8/ws/event reçoit les changements de joignabilité des appareils du
+# réseau local. L'état ainsi tenu à jour est réconcilié avec une lecture complète toutes
+# les LAN_RECONCILE_INTERVAL secondes, et après chaque (re)connexion du websocket ;
+# sans abonnement actif, on revient à l'interrogation périodique (POLL_SCHEDULE['lan']).
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class WebSocketClient:
+    """Client websocket minimal (RFC 6455) : messages texte et ping/pong, sans dépendance"""
+
+    def __init__(self, url, headers=None, timeout=10):
+        self.url = url
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.fragments = []
+        self.last_received = 0
+
+    def connect(self):
+        parsed = urlsplit(self.url)
+        secure = parsed.scheme in ('wss', 'https')
+        sock = socket.create_connection((parsed.hostname, parsed.port or (443 if secure else 80)), timeout=self.timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+        
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        lines = [
+            f'GET {path} HTTP/1.1',
+            f'Host: {parsed.netloc}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key}',
+            'Sec-WebSocket-Version: 13'
+        ] + [f'{name}: {value}' for name, value in self.headers.items()]
+        sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = sock.recv(4096)
+            if not chunk:
+                sock.close()
+                raise ConnectionError('Connexion fermée pendant la poignée de main websocket')
+            response += chunk
+        head, self.buffer = response.split(b'\r\n\r\n', 1)
+        status, *header_lines = head.decode('latin-1').split('\r\n')
+        headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in header_lines)}
+        expected = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        if status.split(' ')[1:2] != ['101'] or headers.get('sec-websocket-accept') != expected:
+            sock.close()
+            raise ConnectionError(f'Poignée de main websocket refusée: {status}')
+        
+        self.sock = sock
+        self.last_received = time.time()
+
+    def send_frame(self, opcode, payload):
+        # Les trames envoyées par un client sont toujours masquées
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    def send(self, text):
+        self.send_frame(0x1, text.encode('utf-8'))
+
+    def ping(self):
+        self.send_frame(0x9, b'')
+
+    def parse_frame(self):
+        """Extrait une trame complète du tampon, ou None s'il manque des octets"""
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        first, second = buffer[0], buffer[1]
+        length, offset = second & 0x7f, 2
+        if length == 126:
+            if len(buffer) < 4:
+                return None
+            length, = struct.unpack_from('!H', buffer, 2)
+            offset = 4
+        elif length == 127:
+            if len(buffer) < 10:
+                return None
+            length, = struct.unpack_from('!Q', buffer, 2)
+            offset = 10
+        mask = None
+        if second & 0x80:
+            mask = buffer[offset:offset + 4]
+            offset += 4
+        if len(buffer) < offset + length:
+            return None
+        payload = buffer[offset:offset + length]
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.buffer = buffer[offset + length:]
+        return bool(first & 0x80), first & 0x0f, payload
+
+    def recv(self):
+        """Retourne le prochain message texte, ou None si rien n'arrive avant le timeout"""
+        while True:
+            frame = self.parse_frame()
+            if frame is None:
+                try:
+                    chunk = self.sock.recv(4096)
+                except socket.timeout:
+                    return None
+                if not chunk:
+                    raise ConnectionError('Connexion websocket fermée')
+                self.buffer += chunk
+                continue
+            
+            self.last_received = time.time()
+            fin, opcode, payload = frame
+            if opcode == 0x8:
+                raise ConnectionError('Connexion websocket fermée par la Freebox')
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode in (0x0, 0x1, 0x2):
+                self.fragments.append(payload)
+                if fin:
+                    message = b''.join(self.fragments)
+                    self.fragments = []
+                    return message.decode('utf-8')
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.send_frame(0x8, struct.pack('!H', 1000))
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+
+class LanHostTracker:
+    """Appareils du réseau local, tenus à jour par les événements et réconciliés périodiquement"""
+
+    def __init__(self, reconcile_interval):
+        self.reconcile_interval = reconcile_interval
+        self.hosts = {}
+        self.last_reconcile = 0
+        self.events_live = False
+        self.lock = threading.Lock()
+
+    def reconcile(self, hosts):
+        with self.lock:
+            self.hosts = {host.get('id'): bool(host.get('active', False)) for host in hosts}
+            self.last_reconcile = time.time()
+
+    def invalidate(self):
+        """Force une lecture complète au prochain échantillon (événements possiblement manqués)"""
+        with self.lock:
+            self.last_reconcile = 0
+        poller.invalidate('lan')
+
+    def apply_event(self, event, host):
+        with self.lock:
+            self.hosts[host.get('id')] = bool(host.get('active', event == 'lan_host_l3addr_reachable'))
+
+    def get(self):
+        """Retourne les appareils au format de /lan/browser/pub, en n'interrogeant la Freebox que si nécessaire"""
+        if not self.events_live or time.time() - self.last_reconcile >= self.reconcile_interval:
+            result = poller.get('lan', freebox.get_lan_hosts)
+            if result and result.get('success'):
+                self.reconcile(result.get('result') or [])
+            return result
+        with self.lock:
+            return {'success': True, 'result': [{'id': host_id, 'active': active} for host_id, active in self.hosts.items()]}
+
+class EventSubscriber:
+    """Abonnement au canal d'événements websocket de la Freebox, reconnecté automatiquement"""
+
+    def __init__(self, url, events, tracker):
+        self.url = url
+        self.events = events
+        self.tracker = tracker
+        self.state = 'stopped'
+        self.events_received = 0
+        self.thread = None
+
+    def handle(self, message):
+        event = json.loads(message)
+        if event.get('action') == 'register':
+            if not event.get('success'):
+                raise ConnectionError(f"Abonnement refusé: {event.get('msg') or event.get('error_code')}")
+            self.tracker.invalidate()
+            self.tracker.events_live = True
+            self.state = 'connected'
+            print(f"✓ Abonné aux événements Freebox ({', '.join(self.events)})")
+        elif event.get('action') == 'notification' and event.get('success'):
+            name = f"{event.get('source')}_{event.get('event')}"
+            if name in self.events and isinstance(event.get('result'), dict):
+                self.tracker.apply_event(name, event['result'])
+                self.events_received += 1
+
+    def listen(self):
+        self.state = 'connecting'
+        ws = WebSocketClient(self.url, headers=freebox.get_headers(), timeout=WS_PING_INTERVAL)
+        ws.connect()
+        try:
+            ws.send(json.dumps({'action': 'register', 'events': list(self.events)}))
+            while True:
+                message = ws.recv()
+                if message is not None:
+                    self.handle(message)
+                elif time.time() - ws.last_received > WS_PING_INTERVAL * 2:
+                    raise ConnectionError('Pas de réponse au ping')
+                else:
+                    ws.ping()
+        finally:
+            ws.close()
+
+    def attempt(self):
+        """Une connexion, jusqu'à sa coupure ; retourne True si l'abonnement avait été accepté"""
+        try:
+            self.listen()
+        except Exception as e:
+            print(f"⚠ Événements Freebox indisponibles: {type(e).__name__} - {e}")
+        connected = self.state == 'connected'
+        # Sans abonnement, la collecte revient à l'interrogation complète
+        self.tracker.events_live = False
+        self.state = 'error'
+        return connected
+
+    def run(self):
+        delay = 1
+        while True:
+            if freebox.auth_state != 'authorized' or not freebox.session_token or circuit_breaker.is_open():
+                self.state = 'waiting_auth' if freebox.auth_state != 'authorized' else 'waiting'
+                time.sleep(COLLECT_INTERVAL)
+                continue
+            if self.attempt():
+                delay = 1
+            time.sleep(delay)
+            delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='events', daemon=True)
+            self.thread.start()
+
+    def to_dict(self):
+        return {'state': self.state, 'events_received': self.events_received}
+
+lan_tracker = LanHostTracker(LAN_RECONCILE_INTERVAL)
+event_subscriber = EventSubscriber(FREEBOX_URL.replace('http', 'ws', 1) + '/api/v8/ws/event', WS_EVENTS, lan_tracker)
+
+# Complément de l'historique (RRD de la Freebox)
+#
+# Quand l'application a été arrêtée, l'historique contient un trou. La Freebox garde
+# ses propres séries RRD (débits et températures) : au démarrage puis toutes les heures,
+# les trous de plus de BACKFILL_MIN_GAP secondes sont détectés, la plage manquante est
+# lue en quelques grosses requêtes /api/v8/rrd/, puis fusionnée dans les échantillons
+# bruts et les agrégats. Chaque trou traité est noté dans backfill_ranges, dans la même
+# transaction : un nouveau passage ne l'interroge ni ne l'insère à nouveau.
+
+def find_gaps(conn, start_time, end_time, min_gap):
+    """Trous (dernier échantillon avant, premier après) de plus de min_gap secondes"""
+    gaps = []
+    previous = None
+    for row in iter_sample_rows(conn, start_time, end_time):
+        if previous is not None and row[0] - previous > min_gap:
+            gaps.append((previous, row[0]))
+        previous = row[0]
+    return gaps, previous
+
+def rrd_rows(net_points, temp_points, start_time, end_time):
+    """Échantillons (timestamp, download, upload, temperature) strictement compris dans le trou"""
+    temperatures = []
+    for point in sorted(temp_points, key=lambda p: p.get('time') or 0):
+        sensors = [value for name, value in point.items()
+                   if name != 'time' and 'fan' not in name and isinstance(value, (int, float))]
+        if sensors:
+            temperatures.append((point['time'], sum(sensors) / len(sensors)))
+    
+    rows = {}
+    index = 0
+    temperature = None
+    for point in sorted(net_points, key=lambda p: p.get('time') or 0):
+        timestamp = int(point.get('time') or 0)
+        # Température : dernier relevé connu à cet instant
+        while index < len(temperatures) and temperatures[index][0] <= timestamp:
+            temperature = temperatures[index][1]
+            index += 1
+        if start_time < timestamp < end_time:
+            rows[timestamp] = (
+                timestamp,
+                # Valeurs nulles possibles dans la RRD (relevé manquant)
+                (point.get('rate_down') or 0) * 8 / 1000000,
+                (point.get('rate_up') or 0) * 8 / 1000000,
+                temperature
+            )
+    return [rows[timestamp] for timestamp in sorted(rows)]
+
+class HistoryBackfill:
+    def __init__(self, min_gap, interval, request_span):
+        self.min_gap = min_gap
+        self.interval = interval
+        self.request_span = request_span
+        self.last_sample = None
+        self.state = 'idle'
+        self.filled_rows = 0
+        self.thread = None
+
+    def fetch(self, start_time, end_time):
+        """Lit la RRD de la Freebox sur la plage, par requêtes de request_span secondes"""
+        net_points = []
+        temp_points = []
+        for chunk_start in range(start_time, end_time, self.request_span):
+            chunk_end = min(chunk_start + self.request_span, end_time)
+            net = freebox.get_rrd('net', chunk_start, chunk_end, ['time', 'rate_down', 'rate_up'])
+            if not net or not net.get('success'):
+                return None
+            net_points.extend((net.get('result') or {}).get('data') or [])
+            # Températures facultatives (champs différents selon les modèles)
+            temp = freebox.get_rrd('temp', chunk_start, chunk_end)
+            if temp and temp.get('success'):
+                temp_points.extend((temp.get('result') or {}).get('data') or [])
+        return rrd_rows(net_points, temp_points, start_time, end_time)
+
+    def merge(self, conn, gap_start, gap_end, rows):
+        """Insère les échantillons du trou et met à jour les agrégats, en une transaction"""
+        if STORAGE_BACKEND != 'mmap':
+            # Le journal mmap n'accepte que des ajouts en fin : seuls les agrégats sont complétés
+            conn.executemany('''
+                INSERT INTO bandwidth_history (timestamp, download_rate, upload_rate, temperature)
+                SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM bandwidth_history WHERE timestamp = ?)
+            ''', [row + (row[0],) for row in rows])
+        late, others = rollups.split_rows(rows)
+        for bucket in aggregate_rows(others, ROLLUP_INTERVAL):
+            upsert_rollup(conn, bucket)
+        conn.execute(
+            'INSERT OR REPLACE INTO backfill_ranges (start_ts, end_ts, row_count, filled_at) VALUES (?, ?, ?, ?)',
+            (gap_start, gap_end, len(rows), int(time.time()))
+        )
+        conn.commit()
+        # La tranche en cours n'est complétée qu'une fois le trou validé (sinon un nouvel
+        # essai compterait deux fois ces échantillons) ; si elle s'est refermée entre-temps,
+        # ses échantillons tardifs vont dans sa ligne en base
+        closed = rollups.merge_rows(late)
+        if closed:
+            for bucket in aggregate_rows(closed, ROLLUP_INTERVAL):
+                upsert_rollup(conn, bucket)
+            conn.commit()
+        history_cache.invalidate(gap_start, gap_end)
+        for bucket in aggregate_rows(rows, ROLLUP_INTERVAL):
+            heatmap.add_bucket(bucket)
+
+    def run_once(self):
+        """Détecte les trous depuis le dernier passage et les complète ; retourne le nombre d'échantillons ajoutés"""
+        now = int(time.time())
+        start_time = self.last_sample if self.last_sample is not None else now - RETENTION_DAYS * 24 * 3600
+        added = 0
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        try:
+            gaps, last_sample = find_gaps(conn, start_time, now, self.min_gap)
+            done = conn.execute('SELECT start_ts, end_ts FROM backfill_ranges WHERE end_ts > ?', (start_time,)).fetchall()
+            for gap_start, gap_end in gaps:
+                if any(start <= gap_start and gap_end <= end for start, end in done):
+                    continue
+                rows = self.fetch(gap_start, gap_end)
+                if rows is None:
+                    # Freebox indisponible : ce trou sera retenté au prochain passage
+                    last_sample = min(last_sample, gap_start)
+                    continue
+                self.merge(conn, gap_start, gap_end, rows)
+                added += len(rows)
+                print(f"✓ Historique complété depuis la Freebox: {len(rows)} échantillons "
+                      f"({time.strftime('%d/%m %H:%M', time.localtime(gap_start))} → {time.strftime('%d/%m %H:%M', time.localtime(gap_end))})")
+        finally:
+            conn.close()
+        if last_sample is not None:
+            self.last_sample = last_sample
+        self.filled_rows += added
+        return added
+
+    def run(self):
+        while True:
+            # Attendre un premier échantillon : il referme le trou laissé par l'arrêt
+            if freebox.auth_state == 'authorized' and collector.latest is not None:
+                self.state = 'running'
+                try:
+                    self.run_once()
+                    self.state = 'idle'
+                except Exception as e:
+                    self.state = 'error'
+                    print(f"✗ Erreur complément de l'historique: {type(e).__name__} - {e}")
+                time.sleep(self.interval)
+            else:
+                time.sleep(COLLECT_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='backfill', daemon=True)
+            self.thread.start()
+
+    def to_dict(self):
+        return {'state': self.state, 'filled_rows': self.filled_rows}
+
+backfill = HistoryBackfill(BACKFILL_MIN_GAP, BACKFILL_INTERVAL, BACKFILL_REQUEST_SPAN)
+
+# Instantané pré-sérialisé
+#
+# Chaque nouvel instantané est encodé une seule fois (orjson si installé), avec sa
+# variante gzip. Une requête /api/status n'encode que les quelques champs qui dépendent
+# de l'instant (âge, stale, état du service), concaténés au corps ; pour gzip, ils sont
+# compressés à partir d'une copie de l'état du compresseur, qui produit un flux valide.
+
+def json_dumps(value):
+    """Encode en JSON compact (bytes UTF-8)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+class SerializedSnapshot:
+    def __init__(self, data):
+        self.data = data
+        # Corps sans l'accolade fermante, complété à chaque requête
+        self.prefix = json_dumps(data)[:-1]
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.gzip_prefix = self.compressor.compress(self.prefix) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        # Dernière fin compressée (fin JSON, octets gzip), réutilisée pour une fin identique
+        self.gzip_tail = None
+
+    def render(self, extra, compress=False):
+        """Corps complet avec les champs extra (dict non vide), éventuellement compressé"""
+        tail = b',' + json_dumps(extra)[1:]
+        if not compress:
+            return self.prefix + tail
+        # Copier l'état deflate (fenêtre et tables) coûte environ 75 µs : les requêtes
+        # simultanées, dont l'âge arrondi et l'état du service sont identiques, le partagent
+        cached = self.gzip_tail
+        if cached is not None and cached[0] == tail:
+            return self.gzip_prefix + cached[1]
+        compressor = self.compressor.copy()
+        compressed = compressor.compress(tail) + compressor.flush()
+        self.gzip_tail = (tail, compressed)
+        return self.gzip_prefix + compressed
+
+class Collector:
+    """Collecte l'état de la Freebox à intervalle régulier et diffuse chaque échantillon"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.latest = None
+        self.serialized = None
+        self.listeners = []
+        self.lock = threading.Lock()
+        # Une seule collecte à la fois : les auditeurs voient les échantillons dans l'ordre
+        self.collect_lock = threading.Lock()
+        self.collections = 0
+        self.last_result = None
+        self.thread = None
+        # État de la collecte : stopped, waiting_auth, running, error
+        self.state = 'stopped'
+
+    def add_listener(self, listener):
+        """Ajoute une fonction appelée avec chaque nouvel instantané valide"""
+        self.listeners.append(listener)
+
+    def collect_once(self):
+        """Collecte un instantané, ou réutilise celui d'une collecte terminée pendant l'attente"""
+        collections = self.collections
+        with self.collect_lock:
+            if self.collections != collections:
+                return self.last_result
+            data = collect_status()
+            if data.get('success'):
+                serialized = SerializedSnapshot(data)
+                with self.lock:
+                    self.latest = data
+                    self.serialized = serialized
+                for listener in self.listeners:
+                    try:
+                        listener(data)
+                    except Exception as e:
+                        print(f"✗ Erreur traitement échantillon ({listener.__name__}): {e}")
+            self.last_result = data
+            self.collections += 1
+            return data
+
+    def get_latest(self, max_age):
+        with self.lock:
+            if self.latest and time.time() - self.latest['timestamp'] <= max_age:
+                return self.latest
+        return None
+
+    def run(self):
+        while True:
+            started = time.time()
+            if freebox.auth_state != 'authorized':
+                # Autorisation en attente ou refusée : la connexion se fait en arrière-plan
+                self.state = 'waiting_auth'
+                start_auth_task()
+            else:
+                # Une erreur inattendue ne doit pas arrêter la collecte
+                try:
+                    data = self.collect_once()
+                    self.state = 'running' if data.get('success') else 'error'
+                except Exception as e:
+                    self.state = 'error'
+                    print(f"✗ Erreur collecte: {type(e).__name__} - {e}")
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='collector', daemon=True)
+        self.thread.start()
+
+# Tâches d'arrière-plan
+#
+# Le serveur HTTP démarre immédiatement ; la préparation de la base, l'authentification
+# (qui peut attendre 2 minutes l'appui sur le bouton de la Freebox), la collecte et la
+# rétention tournent dans des threads dédiés. /api/ready expose leur état.
+
+service_state = {'database': 'pending', 'maintenance': 'pending'}
+auth_thread = None
+last_auth_attempt = 0
+
+def start_auth_task(force=False):
+    """Lance la connexion à la Freebox en arrière-plan si aucune n'est en cours"""
+    global auth_thread, last_auth_attempt
+    if auth_thread is not None and auth_thread.is_alive():
+        return
+    # Après un refus ou une erreur, ne pas relancer la demande en boucle
+    if not force and freebox.auth_state in ('denied', 'error') and time.time() - last_auth_attempt < AUTH_RETRY_INTERVAL:
+        return
+    last_auth_attempt = time.time()
+    auth_thread = threading.Thread(target=freebox.login, name='auth', daemon=True)
+    auth_thread.start()
+
+def run_startup_tasks():
+    """Prépare la base, lance l'authentification et la collecte, puis entretient l'historique"""
+    print("\n📡 Connexion à la Freebox en arrière-plan...")
+    start_auth_task(force=True)
+    
+    service_state['database'] = 'migrating'
+    try:
+        init_database()
+        # Compléter les agrégats de 5 minutes manquants avant que le collecteur n'écrive
+        rebuild_missing_rollups()
+        upgrade_legacy_archive()
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        heatmap.load(conn, int(time.time()))
+        conn.close()
+    except Exception as e:
+        service_state['database'] = 'error'
+        print(f"✗ Erreur initialisation base de données: {e}")
+        return
+    service_state['database'] = 'ready'
+    
+    # Démarrer la collecte en arrière-plan (historique et alertes)
+    collector.start()
+    print(f"✓ Collecte démarrée (toutes les {COLLECT_INTERVAL}s)")
+    event_subscriber.start()
+    backfill.start()
+    for sink in export_sinks:
+        sink.start()
+    
+    # Nettoyer les anciennes données au démarrage puis chaque jour
+    while True:
+        service_state['maintenance'] = 'running'
+        cleanup_old_data()
+        service_state['maintenance'] = 'idle'
+        time.sleep(MAINTENANCE_INTERVAL)
+
+def start_background_tasks():
+    threading.Thread(target=run_startup_tasks, name='startup', daemon=True).start()
+
+def get_service_state():
+    """État des tâches d'arrière-plan (base, authentification, collecte)"""
+    latest = collector.latest
+    return {
+        'database': service_state['database'],
+        'maintenance': service_state['maintenance'],
+        'auth': freebox.auth_state,
+        'track_id': freebox.track_id if freebox.auth_state == 'pending_authorization' else None,
+        'collector': collector.state,
+        'circuit': circuit_breaker.to_dict(),
+        'events': event_subscriber.to_dict(),
+        'polls': poller.to_dict(),
+        'backfill': backfill.to_dict(),
+        'sinks': {sink.sink.name: sink.to_dict() for sink in export_sinks},
+        'last_sample': latest['timestamp'] if latest else None
+    }
+
+def record_sample(data):
+    """Sauvegarde les stats d'un échantillon dans la base de données"""
+    download_mbps = (data['stats']['rx_rate'] * 8 / 1000000)
+    upload_mbps = (data['stats']['tx_rate'] * 8 / 1000000)
+    temp = data['system']['temp_avg']
+    save_stats(download_mbps, upload_mbps, temp, data['timestamp'])
+    rollups.add_sample(data['timestamp'], download_mbps, upload_mbps, temp)
+    heatmap.add_sample(data['timestamp'], download_mbps, upload_mbps)
+
+def record_metrics(data):
+    """Enregistre tous les champs numériques de l'échantillon dans les séries génériques"""
+    metric_store.record(data['timestamp'], flatten_metrics(data))
+
+def record_recent(data):
+    """Ajoute l'échantillon au tampon mémoire de la vue temps réel"""
+    recent_samples.append(data['timestamp'], flatten_metrics(data))
+
+collector = Collector(COLLECT_INTERVAL)
+collector.add_listener(record_sample)
+collector.add_listener(record_metrics)
+collector.add_listener(record_recent)
+collector.add_listener(alert_engine.process)
+# Avant usage_tracker : le journal de connexion lit son dernier relevé au premier échantillon
+collector.add_listener(connection_log.process)
+collector.add_listener(usage_tracker.process)
+collector.add_listener(export_sample)
+
+# Diagnostic (administration)
+#
+# Pour examiner le processus en production sans le redémarrer. Les routes
+# /api/admin/* n'existent que si ADMIN_TOKEN est défini, et exigent l'en-tête
+# « Authorization: Bearer <ADMIN_TOKEN> ». Un seul diagnostic tourne à la fois et sa
+# durée est bornée :
+# - le profileur relève la pile de tous les threads toutes les PROFILE_SAMPLE_INTERVAL
+#   secondes (sys._current_frames, aucun traçage des appels) et renvoie des piles
+#   repliées, au format attendu par flamegraph.pl ou speedscope ;
+# - le diff mémoire active tracemalloc le temps de la mesure, compare deux instantanés
+#   et renvoie les lignes de code dont les allocations ont le plus augmenté.
+
+diagnostic_lock = threading.Lock()
+
+def admin_required(view):
+    """Décorateur de route : 404 sans ADMIN_TOKEN, 401 si le jeton fourni ne correspond pas"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'success': False, 'error': 'Diagnostic désactivé (ADMIN_TOKEN non défini)'}), 404
+        provided = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(provided.encode('utf-8'), f'Bearer {ADMIN_TOKEN}'.encode('utf-8')):
+            return jsonify({'success': False, 'error': 'Jeton d\'administration invalide'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def diagnostic_seconds(default):
+    """Durée demandée (?seconds=), bornée à PROFILE_MAX_SECONDS"""
+    seconds = float(request.args.get('seconds', default))
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(f'seconds doit être compris entre 0 et {PROFILE_MAX_SECONDS}')
+    return seconds
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def sample_stacks(seconds, interval):
+    """Relève périodiquement la pile de chaque thread, comptée par pile repliée"""
+    stacks = {}
+    current = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    samples = 0
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f'thread-{ident}'))
+            stack = ';'.join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+def memory_diff(seconds, top):
+    """Les top lignes dont les allocations ont le plus augmenté pendant seconds secondes"""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    
+    # Ignorer les allocations de tracemalloc lui-même
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    differences = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    return {
+        'traced_current_bytes': current,
+        'traced_peak_bytes': peak,
+        'top': [{
+            'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+            'size_diff_bytes': stat.size_diff,
+            'size_bytes': stat.size,
+            'count_diff': stat.count_diff,
+            'count': stat.count
+        } for stat in differences[:top]]
+    }
+
+@app.route('/api/admin/profile')
+@rate_limited(api_limiter)
+@admin_required
+def get_profile():
+    """Profil échantillonné de tous les threads (?seconds=10&format=collapsed|json)"""
+    try:
+        seconds = diagnostic_seconds(10)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not diagnostic_lock.acquire(blocking=False):
+        return jsonify({'success': False, 'error': 'Un diagnostic est déjà en cours'}), 409
+    try:
+        samples, stacks = sample_stacks(seconds, PROFILE_SAMPLE_INTERVAL)
+    finally:
+        diagnostic_lock.release()
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'success': True,
+            'seconds': seconds,
+            'interval': PROFILE_SAMPLE_INTERVAL,
+            'samples': samples,
+            'stacks': stacks
+        })
+    body = ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+    return Response(body, mimetype='text/plain')
+
+@app.route('/api/admin/memory')
+@rate_limited(api_limiter)
+@admin_required
+def get_memory_diff():
+    """Évolution des allocations mémoire pendant ?seconds= secondes (les ?top= plus fortes)"""
+    try:
+        seconds = diagnostic_seconds(30)
+        top = int(request.args.get('top', 20))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not diagnostic_lock.acquire(blocking=False):
+        return jsonify({'success': False, 'error': 'Un diagnostic est déjà en cours'}), 409
+    try:
+        diff = memory_diff(seconds, max(1, top))
+    finally:
+        diagnostic_lock.release()
+    return jsonify(dict(diff, success=True, seconds=seconds))
+
+@app.route('/')
+def index():
+    """Sert l'interface web"""
+    return render_template_string(HTML_TEMPLATE)
+
+@app.route('/api/info')
+def api_info():
+    """Page d'accueil de l'API"""
+    return jsonify({
+        'name': 'Freebox Monitor API',
+        'version': '1.0.0',
+        'endpoints': [
+            '/ - Interface web de monitoring',
+            '/api/status - Récupère toutes les données',
+            '/api/status?fields=stats,system.temp_avg - Seulement les champs demandés',
+            '/api/init - Relance la connexion en arrière-plan',
+            '/api/ready - État de la base, de l\'authentification et de la collecte',
+            '/api/history/<period> - Historique agrégé (24h, 7d, 30d, 1y)',
+            '/api/history/<period>?metrics=a,b - Historique de métriques génériques',
+            '/api/history/<period>?ports=1,2|all - Historique des débits par port du switch',
+            '/api/metrics - Liste des métriques enregistrées',
+            '/api/usage?granularity=day|month - Volumes téléchargés et envoyés',
+            '/api/heatmap - Débits moyens et maximaux par heure de la semaine',
+            '/api/outages?start=&end= - Coupures, redémarrages et changements d\'adresse IP',
+            '/api/recent?seconds=&metrics= - Derniers échantillons en mémoire',
+            '/api/stations - Stations WiFi connectées',
+            '/api/stations/<mac>/history?period= - Historique d\'une station WiFi',
+            '/api/switch - Ports du switch (lien, vitesse, débits)',
+            '/api/alerts - Règles d\'alerte et alertes actives',
+            '/api/export?format=csv|ndjson&start=&end=&resolution= - Export de l\'historique',
+            '/api/admin/profile?seconds=&format=collapsed|json - Profil CPU (ADMIN_TOKEN)',
+            '/api/admin/memory?seconds=&top= - Diff des allocations mémoire (ADMIN_TOKEN)',
+            '/api/info - Informations sur l\'API'
+        ]
+    })
+
+# Planification des appels
+#
+# Chaque appel Freebox a sa propre période (POLL_SCHEDULE) : les débits changent à
+# chaque seconde, alors que le modèle, le firmware ou la configuration des points
+# d'accès ne changent presque jamais. L'instantané est assemblé à partir du dernier
+# résultat valide de chaque appel.
+
+class PollScheduler:
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.results = {}
+        self.calls = {name: 0 for name in schedule}
+        self.fallbacks = {name: 0 for name in schedule}
+        self.lock = threading.Lock()
+
+    def get(self, name, call):
+        """Dernier résultat valide de call, rafraîchi si sa période est écoulée"""
+        period = self.schedule.get(name, 0)
+        with self.lock:
+            cached = self.results.get(name)
+        if cached is not None and freebox.clock() - cached[0] < period:
+            return cached[1]
         
-        if period == '24h':
-            start_time = now - (24 * 3600)
-            # Grouper par 5 minutes
-            interval = 300
-        elif period == '7d':
-            start_time = now - (7 * 24 * 3600)
-            # Grouper par 1 heure
-            interval = 3600
-        elif period == '30d':
-            start_time = now - (30 * 24 * 3600)
-            # Grouper par 4 heures
-            interval = 14400
+        result = call()
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if result and result.get('success'):
+                self.results[name] = (freebox.clock(), result)
+                return result
+            # Session expirée : l'appelant doit le voir pour se reconnecter tout de suite
+            if result and result.get('error_code') == 'auth_required':
+                return result
+            # Autre échec : le dernier résultat valide, s'il n'est pas trop ancien
+            cached = self.results.get(name)
+            if cached is not None and freebox.clock() - cached[0] < POLL_MAX_STALE_PERIODS * period:
+                self.fallbacks[name] = self.fallbacks.get(name, 0) + 1
+                return cached[1]
+        return result
+
+    def invalidate(self, name=None):
+        """Force le prochain appel (tous par défaut), par exemple après une reconnexion"""
+        with self.lock:
+            if name is None:
+                self.results.clear()
+            else:
+                self.results.pop(name, None)
+
+    def to_dict(self):
+        with self.lock:
+            return {'schedule': self.schedule, 'calls': dict(self.calls), 'fallbacks': dict(self.fallbacks)}
+
+poller = PollScheduler(POLL_SCHEDULE)
+
+# Sélection de champs
+#
+# ?fields=stats,system.temp_avg limite la réponse de /api/status aux chemins demandés.
+# Si le dernier instantané du collecteur est trop ancien, la collecte immédiate
+# n'interroge que les endpoints Freebox nécessaires à ces sections.
+
+STATUS_SECTIONS = ('system', 'connection', 'stats', 'lan', 'wifi', 'switch')
+
+def parse_fields(value):
+    """Retourne les chemins pointés demandés, ou None pour l'instantané complet"""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field.split('.')[0] not in STATUS_SECTIONS]
+    if unknown:
+        raise ValueError(f"Champs inconnus: {', '.join(unknown)} (sections: {', '.join(STATUS_SECTIONS)})")
+    return fields or None
+
+def select_fields(data, fields):
+    """Ne garde d'un instantané que les chemins demandés (plus success et timestamp)"""
+    if fields is None or not data.get('success'):
+        return data
+    selected = {key: data[key] for key in ('success', 'timestamp') if key in data}
+    for field in fields:
+        *parents, name = field.split('.')
+        source, target = data, selected
+        for part in parents:
+            source = source.get(part) if isinstance(source, dict) else None
+            target = target.setdefault(part, {})
+        if isinstance(source, dict) and name in source:
+            target[name] = source[name]
+    return selected
+
+def collect_status(sections=None):
+    """Interroge la Freebox et construit l'instantané de monitoring (complet, ou limité à certaines sections)"""
+    
+    # Vérifier si on a une session valide, sinon se reconnecter
+    if not freebox.session_token:
+        print("⚠️ Pas de session, reconnexion...")
+        if not freebox.login():
+            return {
+                'success': False,
+                'error': 'Impossible de se connecter à la Freebox'
+            }
+
+    sections = set(STATUS_SECTIONS if sections is None else sections)
+    try:
+        # Le premier appel sert aussi à détecter l'expiration du token : le statut de
+        # connexion (interrogé à chaque échantillon), sauf si seules les infos système sont demandées
+        if sections & {'connection', 'stats'} or 'system' not in sections:
+            primary_name, primary = 'connection', freebox.get_connection_status
         else:
+            primary_name, primary = 'system', freebox.get_system_info
+        primary_result = poller.get(primary_name, primary)
+        
+        # Si on reçoit une erreur auth_required, le token a expiré
+        if primary_result and not primary_result.get('success') and primary_result.get('error_code') == 'auth_required':
+            print("⚠️ Token expiré, reconnexion...")
+            freebox.session_token = None
+            if not freebox.login():
+                return {
+                    'success': False,
+                    'error': 'Session expirée, impossible de se reconnecter'
+                }
+            # Réessayer après reconnexion
+            poller.invalidate()
+            primary_result = poller.get(primary_name, primary)
+        
+        system_info = None
+        if 'system' in sections:
+            system_info = primary_result if primary_name == 'system' else poller.get('system', freebox.get_system_info)
+        connection_status = primary_result if primary_name == 'connection' and sections & {'connection', 'stats'} else None
+        lan_hosts = lan_tracker.get() if 'lan' in sections else None
+        wifi_status = wifi_ap = wifi_stations = None
+        if 'wifi' in sections:
+            wifi_status = poller.get('wifi', freebox.get_wifi_status)
+            
+            # Essayer de récupérer les infos WiFi avancées (peuvent échouer sur certains modèles)
+            try:
+                wifi_ap = poller.get('wifi_ap', freebox.get_wifi_ap)
+                wifi_stations = station_tracker.get()
+            except:
+                wifi_ap = None
+                wifi_stations = None
+        switch_ports = switch_tracker.get() if 'switch' in sections else None
+
+        # Vérifier que les données essentielles sont valides
+        if 'system' in sections and (not system_info or not system_info.get('success')):
+            return {
+                'success': False,
+                'error': 'Erreur lors de la récupération des informations système',
+                'details': system_info
+            }
+        
+        if connection_status is not None and not connection_status.get('success'):
+            return {
+                'success': False,
+                'error': 'Erreur lors de la récupération du statut de connexion',
+                'details': connection_status
+            }
+
+        data = {
+            'success': True,
+            'timestamp': freebox.clock()
+        }
+        if 'system' in sections:
+            data['system'] = {
+                'uptime': system_info['result'].get('uptime', ''),
+                'uptime_val': system_info['result'].get('uptime_val', 0),
+                'temp_avg': system_info['result'].get('temp_avg', 0),
+                'temp_sensors': system_info['result'].get('temp_sensors', {}),
+                'temp_cpum': system_info['result'].get('temp_cpum', 0),
+                'temp_sw': system_info['result'].get('temp_sw', 0),
+                'temp_cpub': system_info['result'].get('temp_cpub', 0),
+                'fan_rpm': system_info['result'].get('fan_rpm', 0),
+                'board_name': system_info['result'].get('board_name', ''),
+                'serial': system_info['result'].get('serial', ''),
+                'firmware_version': system_info['result'].get('firmware_version', '')
+            }
+        if 'connection' in sections:
+            data['connection'] = {
+                'state': connection_status['result'].get('state', ''),
+                'type': connection_status['result'].get('type', ''),
+                'media': connection_status['result'].get('media', ''),
+                'ipv4': connection_status['result'].get('ipv4', ''),
+                'ipv6': connection_status['result'].get('ipv6', ''),
+                'rate_down': connection_status['result'].get('rate_down', 0),
+                'rate_up': connection_status['result'].get('rate_up', 0),
+                'bandwidth_down': connection_status['result'].get('bandwidth_down', 0),
+                'bandwidth_up': connection_status['result'].get('bandwidth_up', 0)
+            }
+        if 'stats' in sections:
+            data['stats'] = {
+                'rx_bytes': connection_status['result'].get('bytes_down', 0),
+                'tx_bytes': connection_status['result'].get('bytes_up', 0),
+                'rx_rate': connection_status['result'].get('rate_down', 0),
+                'tx_rate': connection_status['result'].get('rate_up', 0)
+            }
+        if 'lan' in sections:
+            data['lan'] = {
+                'devices_count': len(lan_hosts['result']) if lan_hosts and lan_hosts.get('success') else 0,
+                'devices_active': len([d for d in lan_hosts['result'] if d.get('active', False)]) if lan_hosts and lan_hosts.get('success') else 0
+            }
+        if 'wifi' in sections:
+            data['wifi'] = {
+                'enabled': wifi_status['result'].get('enabled', False) if wifi_status and wifi_status.get('success') else False,
+                'access_points': wifi_ap.get('result', []) if wifi_ap and wifi_ap.get('success') else [],
+                'stations': wifi_stations.get('result', []) if wifi_stations and wifi_stations.get('success') else [],
+                'stations_count': len(wifi_stations.get('result', [])) if wifi_stations and wifi_stations.get('success') else 0
+            }
+        if 'switch' in sections:
+            data['switch'] = {
+                'ports': switch_ports.get('result', []) if switch_ports and switch_ports.get('success') else []
+            }
+
+        return data
+    
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"✗ Erreur dans collect_status: {e}")
+        print(error_trace)
+        
+        # Log détaillé pour debug
+        print(f"Type d'erreur: {type(e).__name__}")
+        print(f"Message: {str(e)}")
+        
+        return {
+            'success': False,
+            'error': f'Erreur serveur: {str(e)}',
+            'error_type': type(e).__name__
+        }
+
+def status_fields(data, **extra):
+    """Champs qui dépendent de l'instant de la requête : âge, indicateur stale, état du service"""
+    age = time.time() - data['timestamp']
+    stale = age > COLLECT_INTERVAL * 3 or circuit_breaker.state != 'closed'
+    return dict(age=round(age, 1), stale=stale, service=get_service_state(), **extra)
+
+def status_payload(data, **extra):
+    """Ajoute à un instantané son âge, l'indicateur stale et l'état du service"""
+    return dict(data, **status_fields(data, **extra))
+
+def status_response(data, fields, **extra):
+    """Réponse /api/status : octets pré-sérialisés pour l'instantané complet du collecteur"""
+    snapshot = collector.serialized
+    if fields is not None or snapshot is None or snapshot.data is not data:
+        return jsonify(status_payload(select_fields(data, fields), **extra))
+    
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = Response(snapshot.render(status_fields(data, **extra), compress), mimetype='application/json')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def cached_status_response():
+    """Dernier instantané connu, servi aux clients qui dépassent leur limite"""
+    data = collector.latest
+    if data is None:
+        return None
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError:
+        fields = None
+    return status_response(data, fields, rate_limited=True)
+
+@app.route('/api/status')
+@rate_limited(api_limiter, fallback=cached_status_response)
+def get_status():
+    """Endpoint pour récupérer toutes les données de monitoring (?fields= pour une partie seulement)"""
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # Servir le dernier instantané du collecteur, sinon collecter immédiatement
+    data = collector.get_latest(max_age=COLLECT_INTERVAL * 3)
+    if data is None:
+        # Ne jamais bloquer une requête HTTP sur l'autorisation
+        if freebox.auth_state != 'authorized':
+            start_auth_task()
+            return jsonify({
+                'success': False,
+                'error': 'Connexion à la Freebox en cours',
+                'service': get_service_state()
+            }), 503
+        # Circuit ouvert : Freebox injoignable, répondre immédiatement avec le dernier instantané
+        if not circuit_breaker.is_open():
+            if fields is None:
+                data = collector.collect_once()
+            else:
+                # Collecte partielle : seulement les appels utiles, sans alimenter le collecteur
+                data = collect_status({field.split('.')[0] for field in fields})
+        if (data is None or not data.get('success')) and collector.latest is not None:
+            data = collector.latest
+    
+    if data is None:
+        return jsonify({
+            'success': False,
+            'error': 'Freebox injoignable',
+            'service': get_service_state()
+        }), 503
+    if not data.get('success'):
+        return jsonify(dict(data, service=get_service_state())), 500
+    return status_response(data, fields)
+
+@app.route('/api/ready')
+def get_ready():
+    """Indique si la base, l'authentification et la collecte sont opérationnelles"""
+    state = get_service_state()
+    ready = state['database'] == 'ready' and state['auth'] == 'authorized' and state['collector'] == 'running'
+    return jsonify(dict(state, ready=ready)), 200 if ready else 503
+
+@app.route('/api/alerts')
+@rate_limited(api_limiter)
+def get_alerts():
+    """Liste les règles d'alerte et leur état courant"""
+    rules = alert_engine.to_list()
+    return jsonify({
+        'success': True,
+        'webhook': bool(alert_engine.notifier.url),
+        'active': [rule['name'] for rule in rules if rule['firing']],
+        'rules': rules
+    })
+
+@app.route('/api/init')
+@rate_limited(init_limiter)
+def init_freebox():
+    """Endpoint pour (re)lancer la connexion en arrière-plan"""
+    if freebox.auth_state == 'denied':
+        # Nouvelle demande d'autorisation
+        freebox.app_token = None
+    start_auth_task(force=True)
+    return jsonify({
+        'success': True,
+        'message': 'Connexion en cours',
+        'auth': freebox.auth_state
+    }), 202
+
+@app.route('/api/history/<period>')
+@rate_limited(api_limiter)
+def get_history(period):
+    """Récupère l'historique pour une période donnée (24h, 7d, 30d, 1y)"""
+    try:
+        now = int(time.time())
+        
+        if period not in HISTORY_PERIODS:
             return jsonify({'success': False, 'error': 'Période invalide'}), 400
         
-        # Récupérer les données agrégées
-        cursor.execute('''
-            SELECT 
+        duration, interval = HISTORY_PERIODS[period]
+        # Début aligné sur l'intervalle : la première tranche est complète et peut être mise en cache
+        start_time = ((now - duration) // interval) * interval
+        
+        # Données agrégées (SQLite et archive si la période dépasse la rétention), tranches fermées en cache
+        data = {
+            'success': True,
+            'period': period,
+            'data': history_cache.get(start_time, now + 1, interval)
+        }
+        
+        # Séries génériques demandées (?metrics=system.fan_rpm,system.temp_sensors.temp_cpum)
+        metric_names = [name for name in request.args.get('metrics', '').split(',') if name]
+        if metric_names:
+            data['metrics'] = {}
+            for name in metric_names:
+                series = metric_store.query(name, start_time, now + 1, interval)
+                if series is None:
+                    return jsonify({'success': False, 'error': f'Métrique inconnue: {name}'}), 404
+                data['metrics'][name] = series
+        
+        # Débits par port du switch (?ports=1,2 ou ?ports=all)
+        ports = request.args.get('ports', '')
+        if ports:
+            try:
+                port_ids = None if ports == 'all' else [int(port) for port in ports.split(',') if port]
+            except ValueError:
+                return jsonify({'success': False, 'error': f'Ports invalides: {ports}'}), 400
+            conn = sqlite3.connect(DB_PATH, timeout=10)
+            data['ports'] = port_history(conn, start_time, now + 1, interval, port_ids)
+            conn.close()
+        
+        return jsonify(data)
+        
+    except Exception as e:
+        print(f"✗ Erreur historique: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/stations')
+@rate_limited(api_limiter)
+def get_stations():
+    """Liste les stations WiFi connectées, triées par débit"""
+    stations = sorted(station_tracker.stations, key=lambda s: s['tx_rate'] + s['rx_rate'], reverse=True)
+    return jsonify({
+        'success': True,
+        'timestamp': station_tracker.last_poll,
+        'stations': stations
+    })
+
+@app.route('/api/heatmap')
+@rate_limited(api_limiter)
+def get_heatmap():
+    """Débits moyens et maximaux par jour de la semaine et heure (fenêtre de rétention)"""
+    return jsonify(dict(heatmap.to_dict(), success=True))
+
+@app.route('/api/switch')
+@rate_limited(api_limiter)
+def get_switch():
+    """Liste les ports du switch avec leur lien et leurs derniers débits"""
+    return jsonify({
+        'success': True,
+        'timestamp': switch_tracker.last_poll,
+        'ports': switch_tracker.ports
+    })
+
+@app.route('/api/stations/<mac>/history')
+@rate_limited(api_limiter)
+def get_station_history(mac):
+    """Historique d'une station WiFi (signal et débits) sur une période (24h, 7d, 30d)"""
+    period = request.args.get('period', '24h')
+    if period not in HISTORY_PERIODS:
+        return jsonify({'success': False, 'error': 'Période invalide'}), 400
+    
+    try:
+        duration, interval = HISTORY_PERIODS[period]
+        start_time = int(time.time()) - duration
+        
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        row = conn.execute('SELECT id, hostname FROM wifi_stations WHERE mac = ?', (mac.upper(),)).fetchone()
+        if row is None:
+            conn.close()
+            return jsonify({'success': False, 'error': 'Station inconnue'}), 404
+        
+        cursor = conn.execute('''
+            SELECT
                 (timestamp / ?) * ? as period,
-                AVG(download_rate) as avg_download,
-                MAX(download_rate) as max_download,
-                AVG(upload_rate) as avg_upload,
-                MAX(upload_rate) as max_upload,
-                AVG(temperature) as avg_temp
-            FROM bandwidth_history
-            WHERE timestamp >= ?
+                AVG(signal),
+                MIN(signal),
+                AVG(tx_rate),
+                MAX(tx_rate),
+                AVG(rx_rate),
+                MAX(rx_rate),
+                MAX(ap_id)
+            FROM wifi_station_history
+            WHERE station_id = ? AND timestamp >= ?
             GROUP BY period
             ORDER BY period ASC
-        ''', (interval, interval, start_time))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        ''', (interval, interval, row[0], start_time))
         
         data = {
             'success': True,
+            'mac': mac.upper(),
+            'hostname': row[1],
             'period': period,
             'data': [{
-                'timestamp': int(row[0]),
-                'download_avg': round(row[1], 2),
-                'download_max': round(row[2], 2),
-                'upload_avg': round(row[3], 2),
-                'upload_max': round(row[4], 2),
-                'temperature': round(row[5], 1) if row[5] else 0
-            } for row in rows]
+                'timestamp': r[0],
+                'signal_avg': round(r[1], 1) if r[1] is not None else None,
+                'signal_min': r[2],
+                'tx_rate_avg': round(r[3], 2) if r[3] is not None else None,
+                'tx_rate_max': r[4],
+                'rx_rate_avg': round(r[5], 2) if r[5] is not None else None,
+                'rx_rate_max': r[6],
+                'ap_id': r[7]
+            } for r in cursor.fetchall()]
         }
+        conn.close()
         
         return jsonify(data)
         
     except Exception as e:
-        print(f"✗ Erreur historique: {e}")
+        print(f"✗ Erreur historique station: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-if __name__ == '__main__':
-    print("\n" + "="*60)
-    print("🚀 Freebox Monitor API")
-    print("="*60)
+@app.route('/api/recent')
+@rate_limited(api_limiter)
+def get_recent():
+    """Derniers échantillons en mémoire (sans accès disque), pour les graphiques temps réel"""
+    try:
+        seconds = float(request.args.get('seconds', RECENT_BUFFER_SECONDS))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Paramètre seconds invalide'}), 400
+    # float() accepte aussi nan et inf, qui ne sont pas du JSON valide
+    if not math.isfinite(seconds) or seconds < 0:
+        return jsonify({'success': False, 'error': 'Paramètre seconds invalide'}), 400
+    
+    names = [name for name in request.args.get('metrics', '').split(',') if name] or None
+    data = recent_samples.since(time.time() - seconds, names)
+    
+    return jsonify({
+        'success': True,
+        'seconds': seconds,
+        'interval': COLLECT_INTERVAL,
+        'timestamps': data['timestamps'],
+        'metrics': data['metrics']
+    })
+
+@app.route('/api/metrics')
+@rate_limited(api_limiter)
+def list_metrics():
+    """Liste les métriques enregistrées, interrogeables via /api/history/<period>?metrics="""
+    try:
+        return jsonify({'success': True, 'metrics': metric_store.names()})
+    except Exception as e:
+        print(f"✗ Erreur métriques: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/usage')
+@rate_limited(api_limiter)
+def get_usage():
+    """Volumes téléchargés et envoyés par jour ou par mois (?granularity=day|month&limit=)"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in USAGE_GRANULARITIES:
+        return jsonify({'success': False, 'error': 'Granularité invalide (day ou month)'}), 400
+    try:
+        limit = int(request.args.get('limit', 31 if granularity == 'day' else 12))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Paramètre limit invalide'}), 400
+    
+    try:
+        return jsonify({
+            'success': True,
+            'granularity': granularity,
+            'data': usage_tracker.totals(granularity, limit)
+        })
+    except Exception as e:
+        print(f"✗ Erreur volumes: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/outages')
+@rate_limited(api_limiter)
+def get_outages():
+    """Coupures et changements d'adresse IP sur une période (?start=&end=, 24 dernières heures par défaut)"""
+    try:
+        now = int(time.time())
+        end_time = parse_time_param(request.args.get('end'), now)
+        start_time = parse_time_param(request.args.get('start'), end_time - 24 * 3600)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Paramètre invalide: {e}'}), 400
+    if start_time >= end_time:
+        return jsonify({'success': False, 'error': 'start doit précéder end'}), 400
+    
+    try:
+        events = connection_log.query(start_time, end_time)
+    except Exception as e:
+        print(f"✗ Erreur journal de connexion: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    outages = [event for event in events if is_outage(event)]
+    
+    # Durée cumulée des coupures dans la période (un redémarrage recoupe souvent un état down)
+    downtime = 0
+    covered_until = start_time
+    for event in outages:
+        start = max(event['start'], covered_until)
+        end = min(event['start'] + event['duration'], end_time)
+        if end > start:
+            downtime += end - start
+            covered_until = end
     
-    # Initialiser la base de données
+    return jsonify({
+        'success': True,
+        'start': start_time,
+        'end': end_time,
+        'downtime': downtime,
+        'outages': outages,
+        'addresses': [event for event in events if event['kind'] in ('ipv4', 'ipv6')]
+    })
+
+def parse_time_param(value, default):
+    """Convertit un paramètre de temps (timestamp Unix ou date ISO 8601) en timestamp"""
+    if value is None or value == '':
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp())
+
+EXPORT_COLUMNS = {
+    'raw': ['timestamp', 'download_rate', 'upload_rate', 'temperature'],
+    'aggregated': ['timestamp', 'download_avg', 'download_max', 'upload_avg', 'upload_max', 'temperature', 'samples']
+                  + [f'{direction}_p{int(q * 100)}' for direction in ('download', 'upload') for q in HISTORY_QUANTILES]
+}
+
+@app.route('/api/export')
+@rate_limited(api_limiter)
+def export_history():
+    """Exporte l'historique brut ou agrégé en CSV ou NDJSON, en streaming"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'Format invalide (csv ou ndjson)'}), 400
+    
+    try:
+        now = int(time.time())
+        end_time = parse_time_param(request.args.get('end'), now)
+        start_time = parse_time_param(request.args.get('start'), end_time - 24 * 3600)
+        resolution = request.args.get('resolution', 'raw')
+        interval = 0 if resolution in ('', 'raw') else int(resolution)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Paramètre invalide: {e}'}), 400
+    
+    if interval < 0 or start_time >= end_time:
+        return jsonify({'success': False, 'error': 'Intervalle de temps invalide'}), 400
+    
+    columns = EXPORT_COLUMNS['aggregated' if interval else 'raw']
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+        
+        count = 0
+        for row in iter_history_rows(start_time, end_time, interval):
+            if interval:
+                bucket = row.to_dict()
+                row = [bucket[column] for column in columns]
+            if export_format == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+            
+            count += 1
+            if count % EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    extension = 'csv' if export_format == 'csv' else 'ndjson'
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f'freebox_history_{start_time}_{end_time}.{extension}'
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+# Banc d'essai
+#
+# `benchmark` génère un historique synthétique (dans un dossier temporaire ou --data-dir)
+# puis mesure le chargement, le calcul des agrégats, l'insertion échantillon par
+# échantillon, chaque période d'historique (sans puis avec cache), la rétention et
+# l'historique une fois archivé. Les durées sont écrites en JSON et comparées à une
+# référence : une mesure plus lente que la référence au-delà de la tolérance fait
+# échouer la commande (code de sortie 1).
+
+BENCHMARK_BATCH_SIZE = 10000
+BENCHMARK_SAVE_SAMPLES = 1000
+BENCHMARK_NOISE_FLOOR = 0.005  # écart absolu (secondes) en dessous duquel on ne conclut pas
+
+def synthetic_rows(start_time, end_time, cadence, seed=0):
+    """Échantillons réalistes : cycle journalier du débit, pics aléatoires, température lente"""
+    rng = random.Random(seed)
+    for timestamp in range(start_time, end_time, cadence):
+        hour = (timestamp % 86400) / 3600
+        download = max(0.0, rng.gauss(50 + 40 * math.sin((hour - 15) / 24 * 2 * math.pi), 15))
+        if rng.random() < 0.01:
+            download *= 10
+        upload = download * rng.uniform(0.05, 0.2)
+        temperature = 55 + 5 * math.sin(timestamp / 7200) + rng.uniform(-0.5, 0.5)
+        yield timestamp, round(download, 2), round(upload, 2), round(temperature, 1)
+
+def load_synthetic_rows(rows):
+    """Charge des échantillons en masse dans le stockage configuré, retourne leur nombre"""
+    count = 0
+    if STORAGE_BACKEND == 'mmap':
+        for row in rows:
+            sample_log.append(*row)
+            count += 1
+        return count
+    
+    conn = sqlite3.connect(DB_PATH)
+    while True:
+        batch = list(itertools.islice(rows, BENCHMARK_BATCH_SIZE))
+        if not batch:
+            break
+        conn.executemany(
+            'INSERT INTO bandwidth_history (timestamp, download_rate, upload_rate, temperature) VALUES (?, ?, ?, ?)', batch
+        )
+        count += len(batch)
+    conn.commit()
+    conn.close()
+    return count
+
+def timed(timings, name, function, *args):
+    """Exécute function et enregistre sa durée (secondes) sous name"""
+    started = time.perf_counter()
+    result = function(*args)
+    timings[name] = round(time.perf_counter() - started, 4)
+    print(f"  {name:<24} {timings[name]:>10.3f} s")
+    return result
+
+def compare_benchmark(timings, baseline, tolerance):
+    """Liste les mesures plus lentes que la référence au-delà de la tolérance"""
+    regressions = []
+    for name, reference in baseline.get('timings', {}).items():
+        value = timings.get(name)
+        if value is None:
+            continue
+        if value > reference * (1 + tolerance) and value - reference > BENCHMARK_NOISE_FLOOR:
+            regressions.append({'name': name, 'value': value, 'baseline': reference, 'ratio': round(value / reference, 2)})
+    return regressions
+
+def use_data_dir(directory):
+    """Place la base, l'archive et le journal d'échantillons dans un autre dossier"""
+    global DB_PATH, ARCHIVE_DIR, SAMPLE_LOG_DIR, sample_log
+    os.makedirs(directory, exist_ok=True)
+    DB_PATH = os.path.join(directory, 'freebox_history.db')
+    ARCHIVE_DIR = os.path.join(directory, 'archive')
+    SAMPLE_LOG_DIR = os.path.join(directory, 'samples')
+    sample_log = SampleLog(SAMPLE_LOG_DIR, SAMPLE_SEGMENT_SECONDS)
+    return directory
+
+def run_benchmark(days, cadence, data_dir=None, output_path=None, baseline_path=None, tolerance=0.25):
+    """Génère un historique synthétique et mesure le stockage ; retourne le code de sortie"""
+    directory = use_data_dir(data_dir or tempfile.mkdtemp(prefix='freebox-benchmark-'))
     init_database()
     
-    # Nettoyer les anciennes données au démarrage
-    cleanup_old_data()
+    now = (int(time.time()) // ROLLUP_INTERVAL) * ROLLUP_INTERVAL
+    start_time = now - int(days * 86400)
+    config = {'days': days, 'cadence': cadence, 'backend': STORAGE_BACKEND, 'rows': (now - start_time) // cadence}
+    print(f"\n⏱  Banc d'essai: {days} jours à {cadence} s ({config['rows']} échantillons, stockage {STORAGE_BACKEND}) dans {directory}")
+    
+    timings = {}
+    rows = timed(timings, 'load', load_synthetic_rows, synthetic_rows(start_time, now, cadence))
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    timed(timings, 'rollups', rebuild_rollups, conn, start_time, now)
+    conn.close()
+    
+    # Chemin réel de la collecte : une écriture par échantillon, après la plage générée
+    def save_samples():
+        for timestamp, download, upload, temperature in synthetic_rows(now, now + BENCHMARK_SAVE_SAMPLES * cadence, cadence, seed=1):
+            save_stats(download, upload, temperature, timestamp)
+    timed(timings, 'save_stats', save_samples)
+    
+    for period, (duration, interval) in HISTORY_PERIODS.items():
+        period_start = ((now - duration) // interval) * interval
+        timed(timings, f'history_{period}', lambda: list(iter_history_rows(period_start, now + 1, interval)))
+        history_cache.get(period_start, now + 1, interval)
+        timed(timings, f'history_{period}_cached', history_cache.get, period_start, now + 1, interval)
+    
+    timed(timings, 'retention', cleanup_old_data)
+    duration, interval = HISTORY_PERIODS['1y']
+    timed(timings, 'history_1y_archived', lambda: list(iter_history_rows(now - duration, now + 1, interval)))
     
-    print("\n📡 Tentative de connexion à la Freebox...")
-    freebox.login()
+    results = {
+        'config': config,
+        'timings': timings,
+        'rates': {
+            'load_rows_per_s': round(rows / timings['load']) if timings['load'] else None,
+            'save_stats_per_s': round(BENCHMARK_SAVE_SAMPLES / timings['save_stats']) if timings['save_stats'] else None
+        }
+    }
+    
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print(f"⚠ Configuration différente de la référence: {baseline.get('config')}")
+        results['regressions'] = compare_benchmark(timings, baseline, tolerance)
+        for regression in results['regressions']:
+            print(f"✗ Régression {regression['name']}: {regression['value']:.3f} s contre {regression['baseline']:.3f} s (x{regression['ratio']})")
+        if results['regressions']:
+            exit_code = 1
+        else:
+            print(f"✓ Aucune régression par rapport à {baseline_path} (tolérance {tolerance:.0%})")
+    
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"✓ Résultats écrits dans {output_path}")
+    if data_dir is None:
+        shutil.rmtree(directory, ignore_errors=True)
+    return exit_code
+
+def run_server():
+    print("\n" + "="*60)
+    print("🚀 Freebox Monitor API")
+    print("="*60)
+    
+    # Base de données, authentification, collecte et rétention en arrière-plan
+    start_background_tasks()
     
     print("\n🌐 Démarrage du serveur sur http://0.0.0.0:5000")
     print("📊 Interface web disponible sur http://localhost:5000")
     print("="*60 + "\n")
     
     app.run(host='0.0.0.0', port=5000, debug=False)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Monitoring Freebox (sans commande : serveur web)")
+    commands = parser.add_subparsers(dest='command')
+    
+    replay_parser = commands.add_parser('replay', help="Rejoue un enregistrement de l'API dans le stockage et les agrégats")
+    replay_parser.add_argument('file', help='Fichier enregistré avec FREEBOX_RECORD_FILE')
+    replay_parser.add_argument('--speed', type=float, default=1000,
+                               help='Facteur d\'accélération (1 = temps réel, 0 = sans attente, défaut: 1000)')
+    replay_parser.add_argument('--data-dir', help='Dossier de la base alimentée par le rejeu, temporaire par défaut')
+    
+    benchmark_parser = commands.add_parser('benchmark', help='Mesure le stockage sur un historique synthétique')
+    benchmark_parser.add_argument('--days', type=float, default=30, help='Durée générée en jours (défaut: 30)')
+    benchmark_parser.add_argument('--cadence', type=int, default=5, help='Secondes entre deux échantillons (défaut: 5)')
+    benchmark_parser.add_argument('--data-dir', help='Dossier de la base générée (conservé), temporaire par défaut')
+    benchmark_parser.add_argument('--output', help='Fichier JSON des résultats')
+    benchmark_parser.add_argument('--baseline', help='Résultats de référence (JSON) à comparer')
+    benchmark_parser.add_argument('--tolerance', type=float, default=0.25,
+                                  help='Ralentissement toléré par rapport à la référence (défaut: 0.25 = 25%%)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'replay':
+        replay_recording(args.file, args.speed, args.data_dir)
+    elif args.command == 'benchmark':
+        raise SystemExit(run_benchmark(args.days, args.cadence, args.data_dir, args.output, args.baseline, args.tolerance))
+    else:
+        run_server()
@@ -0,0 +1,63 @@
+"""Journal des événements de connexion : détection des redémarrages de la Freebox"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import freebox_monitor_standalone as monitor
+
+DAY = 86400
+
+
+def sample(timestamp, uptime):
+    return {
+        'timestamp': timestamp,
+        'connection': {'state': 'up', 'ipv4': '192.0.2.1', 'ipv6': None},
+        'system': {'uptime_val': uptime}
+    }
+
+
+class ConnectionEventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = monitor.DB_PATH
+        monitor.DB_PATH = os.path.join(self.directory.name, 'freebox_history.db')
+        monitor.init_database()
+        self.log = monitor.ConnectionEventLog()
+
+    def tearDown(self):
+        monitor.DB_PATH = self.db_path
+        self.directory.cleanup()
+
+    def reboots(self):
+        return [event for event in self.log.query(0, 100 * DAY) if event['kind'] == 'reboot']
+
+    def test_reboot_while_stopped(self):
+        # Dernier relevé il y a 10 jours avec 8 jours d'uptime, puis 3 jours d'uptime
+        now = 50 * DAY
+        self.log.process(sample(now - 10 * DAY, 8 * DAY))
+        self.log.process(sample(now, 3 * DAY))
+
+        reboots = self.reboots()
+        self.assertEqual(len(reboots), 1)
+        self.assertEqual(reboots[0]['start'], now - 10 * DAY)
+        self.assertEqual(reboots[0]['end'], now - 3 * DAY)
+
+    def test_reboot_between_samples(self):
+        self.log.process(sample(1000, 5000))
+        self.log.process(sample(1100, 30))
+        self.assertEqual(len(self.reboots()), 1)
+
+    def test_uptime_jitter_is_not_a_reboot(self):
+        self.log.process(sample(1000, 5000))
+        # Uptime en retard (relevé système conservé) puis légèrement en avance
+        self.log.process(sample(1005, 4990))
+        self.log.process(sample(1095, 5000))
+        self.log.process(sample(1100, 5101))
+        self.assertEqual(self.reboots(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
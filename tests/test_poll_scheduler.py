@@ -0,0 +1,41 @@
+"""Planification des appels Freebox : résultat conservé en cas d'échec"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import freebox_monitor_standalone as monitor
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.clock = monitor.freebox.clock
+        monitor.freebox.clock = lambda: self.now
+        self.poller = monitor.PollScheduler({'system': 30})
+        self.valid = {'success': True, 'result': {'uptime_val': 100}}
+        self.poller.get('system', lambda: self.valid)
+
+    def tearDown(self):
+        monitor.freebox.clock = self.clock
+
+    def test_failure_falls_back_to_recent_valid_result(self):
+        self.now = 40
+        self.assertIs(self.poller.get('system', lambda: {'success': False}), self.valid)
+        self.assertEqual(self.poller.to_dict()['fallbacks']['system'], 1)
+
+    def test_failure_after_staleness_bound_is_returned(self):
+        self.now = 30 * monitor.POLL_MAX_STALE_PERIODS
+        failure = {'success': False}
+        self.assertIs(self.poller.get('system', lambda: failure), failure)
+
+    def test_auth_required_is_never_masked(self):
+        self.now = 40
+        expired = {'success': False, 'error_code': 'auth_required'}
+        self.assertIs(self.poller.get('system', lambda: expired), expired)
+        self.assertEqual(self.poller.to_dict()['fallbacks']['system'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""Client websocket (événements Freebox) contre un serveur local"""
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import freebox_monitor_standalone as monitor
+
+
+def server_frame(opcode, payload, fin=True):
+    """Trame envoyée par le serveur (jamais masquée)"""
+    first = (0x80 if fin else 0) | opcode
+    if len(payload) < 126:
+        return struct.pack('!BB', first, len(payload)) + payload
+    return struct.pack('!BBH', first, 126, len(payload)) + payload
+
+
+def read_client_frame(sock):
+    """Lit une trame du client : (opcode, contenu démasqué, masquée ?)"""
+    first, second = monitor.recv_exact(sock, 2)
+    length = second & 0x7f
+    if length == 126:
+        length, = struct.unpack('!H', monitor.recv_exact(sock, 2))
+    elif length == 127:
+        length, = struct.unpack('!Q', monitor.recv_exact(sock, 8))
+    mask = monitor.recv_exact(sock, 4) if second & 0x80 else b'\0\0\0\0'
+    payload = monitor.recv_exact(sock, length)
+    return first & 0x0f, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)), bool(second & 0x80)
+
+
+class WebSocketServer:
+    """Accepte une connexion, répond à la poignée de main puis exécute script(conn)"""
+
+    def __init__(self, script, accept=None):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.script = script
+        self.accept = accept
+        self.request = None
+        self.error = None
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        conn, _ = self.server.accept()
+        with conn:
+            request = b''
+            while b'\r\n\r\n' not in request:
+                request += conn.recv(4096)
+            self.request = request.decode()
+            key = next(line.split(':', 1)[1].strip() for line in self.request.split('\r\n')
+                       if line.lower().startswith('sec-websocket-key'))
+            accept = self.accept or base64.b64encode(hashlib.sha1((key + monitor.WEBSOCKET_GUID).encode()).digest()).decode()
+            conn.sendall(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                          f'Connection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+            try:
+                self.script(conn)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.thread.join(timeout=5)
+        self.server.close()
+
+
+class WebSocketClientTest(unittest.TestCase):
+    def test_handshake_and_messages(self):
+        received = []
+
+        def script(conn):
+            # Message fragmenté, ping au milieu, puis message à longueur sur 16 bits
+            conn.sendall(server_frame(0x1, b'{"event": ', fin=False) + server_frame(0x9, b'p')
+                         + server_frame(0x0, b'"lan"}'))
+            received.append(read_client_frame(conn))
+            conn.sendall(server_frame(0x1, b'x' * 300))
+            received.append(read_client_frame(conn))
+
+        server = WebSocketServer(script)
+        client = monitor.WebSocketClient(f'ws://127.0.0.1:{server.port}/api/v8/ws/event',
+                                         headers={'X-Fbx-App-Auth': 'session'})
+        client.connect()
+        self.assertEqual(client.recv(), '{"event": "lan"}')
+        self.assertEqual(client.recv(), 'x' * 300)
+        client.send('{"action": "register"}')
+        server.close()
+        client.sock.close()
+
+        self.assertIsNone(server.error)
+        self.assertTrue(server.request.startswith('GET /api/v8/ws/event HTTP/1.1\r\n'))
+        self.assertIn('X-Fbx-App-Auth: session', server.request)
+        # Pong avec le contenu du ping, puis message texte : trames client masquées
+        self.assertEqual(received, [(0xA, b'p', True), (0x1, b'{"action": "register"}', True)])
+
+    def test_recv_returns_none_on_timeout(self):
+        done = threading.Event()
+        server = WebSocketServer(lambda conn: done.wait(5))
+        client = monitor.WebSocketClient(f'ws://127.0.0.1:{server.port}/', timeout=0.2)
+        client.connect()
+        self.assertIsNone(client.recv())
+        done.set()
+        server.close()
+        client.sock.close()
+
+    def test_close_frame_raises(self):
+        server = WebSocketServer(lambda conn: conn.sendall(server_frame(0x8, struct.pack('!H', 1000))))
+        client = monitor.WebSocketClient(f'ws://127.0.0.1:{server.port}/')
+        client.connect()
+        with self.assertRaises(ConnectionError):
+            client.recv()
+        server.close()
+        client.sock.close()
+
+    def test_wrong_accept_key_is_refused(self):
+        server = WebSocketServer(lambda conn: None, accept='invalide')
+        client = monitor.WebSocketClient(f'ws://127.0.0.1:{server.port}/')
+        with self.assertRaises(ConnectionError):
+            client.connect()
+        server.close()
+
+
+def notification(event, host):
+    source, name = event.split('_l3addr_')
+    return json.dumps({'action': 'notification', 'success': True, 'source': source,
+                       'event': 'l3addr_' + name, 'result': host}).encode()
+
+
+class EventSubscriberTest(unittest.TestCase):
+    def setUp(self):
+        self.session_token = monitor.freebox.session_token
+        self.get_lan_hosts = monitor.freebox.get_lan_hosts
+        monitor.freebox.session_token = 'session'
+        self.tracker = monitor.LanHostTracker(monitor.LAN_RECONCILE_INTERVAL)
+        self.tracker.reconcile([{'id': 'a', 'active': False}, {'id': 'b', 'active': True}])
+
+    def tearDown(self):
+        monitor.freebox.session_token = self.session_token
+        monitor.freebox.get_lan_hosts = self.get_lan_hosts
+
+    def subscribe(self, *messages):
+        """Une connexion : abonnement, messages du serveur, puis fermeture par le serveur"""
+        registered, live = [], []
+
+        def script(conn):
+            registered.append(json.loads(read_client_frame(conn)[1]))
+            for message in messages:
+                conn.sendall(server_frame(0x1, message))
+            # Le pong garantit que les messages précédents ont été traités ; sinon le client a fermé
+            conn.sendall(server_frame(0x9, b'sync'))
+            if read_client_frame(conn)[0] != 0xA:
+                return
+            live.append((dict(self.tracker.hosts), self.tracker.events_live, subscriber.to_dict()))
+            conn.sendall(server_frame(0x8, struct.pack('!H', 1000)))
+
+        server = WebSocketServer(script)
+        subscriber = monitor.EventSubscriber(f'ws://127.0.0.1:{server.port}/api/v8/ws/event',
+                                             monitor.WS_EVENTS, self.tracker)
+        connected = subscriber.attempt()
+        server.close()
+        self.assertIsNone(server.error)
+        self.assertIn('X-Fbx-App-Auth: session', server.request)
+        return connected, registered, live, subscriber
+
+    def test_notifications_update_hosts_until_disconnect(self):
+        connected, registered, live, subscriber = self.subscribe(
+            b'{"action": "register", "success": true}',
+            notification('lan_host_l3addr_reachable', {'id': 'a'}),
+            notification('lan_host_l3addr_unreachable', {'id': 'b', 'active': False}),
+            notification('lan_host_l3addr_reachable', {'id': 'c', 'active': True}))
+
+        self.assertTrue(connected)
+        self.assertEqual(registered, [{'action': 'register', 'events': list(monitor.WS_EVENTS)}])
+        self.assertEqual(live, [({'a': True, 'b': False, 'c': True}, True,
+                                 {'state': 'connected', 'events_received': 3})])
+        # Coupure : retour à l'interrogation complète de la Freebox
+        self.assertFalse(self.tracker.events_live)
+        self.assertEqual(subscriber.to_dict(), {'state': 'error', 'events_received': 3})
+
+    def test_refused_registration_keeps_polling(self):
+        connected, _, live, subscriber = self.subscribe(
+            b'{"action": "register", "success": false, "error_code": "insufficient_rights"}')
+
+        self.assertFalse(connected)
+        self.assertEqual(live, [])
+        self.assertFalse(self.tracker.events_live)
+        self.assertEqual(subscriber.to_dict(), {'state': 'error', 'events_received': 0})
+
+    def test_reconnect_reconciles_missed_events(self):
+        self.subscribe(b'{"action": "register", "success": true}')
+        # Événement manqué pendant la coupure : la Freebox est la référence après reconnexion
+        monitor.freebox.get_lan_hosts = lambda: {'success': True, 'result': [{'id': 'a', 'active': True}]}
+        _, _, live, _ = self.subscribe(b'{"action": "register", "success": true}')
+
+        hosts, events_live, status = live[0]
+        self.assertTrue(events_live)
+        self.assertEqual(status['state'], 'connected')
+        self.assertEqual(self.tracker.last_reconcile, 0)
+
+        self.tracker.events_live = True
+        self.assertEqual(self.tracker.get(), {'success': True, 'result': [{'id': 'a', 'active': True}]})
+        self.assertEqual(self.tracker.hosts, {'a': True})
+        self.assertGreater(self.tracker.last_reconcile, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()